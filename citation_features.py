@@ -0,0 +1,271 @@
+#!/usr/bin/env python3
+import os
+import sys
+import logging
+import argparse
+
+import numpy as np
+from scipy import sparse
+
+from citation_graph import CitationGraph
+
+'''
+Citation network features computed with sparse matrix products over a graph
+store written by citation_graph.py. A is the adjacency matrix with a row for
+each citing node and a column for each cited node, so:
+    out degree - row sums of A
+    in degree - column sums of A
+    co-citation - A^T A, the number of papers citing both of two papers
+    bibliographic coupling - A A^T, the number of references two papers share
+'''
+
+def adjacency_matrices(graph):
+    ''' Wraps a graph store's CSR arrays as scipy matrices without copying
+        the index arrays more than once
+    params
+        graph - a CitationGraph
+    returns
+        a tuple of CSR matrices (A, A^T)
+    '''
+    n = graph.num_nodes()
+
+    def csr(indptr, indices):
+        data = np.ones(len(indices), dtype=np.int32)
+        return sparse.csr_matrix((data, np.asarray(indices, dtype=np.int32),
+                                    np.asarray(indptr, dtype=np.int64)), shape=(n, n))
+
+    return (csr(graph.out_indptr, graph.out_indices), csr(graph.in_indptr, graph.in_indices))
+
+def pagerank(graph, damping=0.85, tol=1e-10, max_iter=100):
+    ''' Computes PageRank by power iteration. Each iteration is a single
+        sparse matrix-vector product, and the rank of nodes with no references
+        is spread evenly over all nodes
+    params
+        graph - a CitationGraph
+        damping - the damping factor
+        tol - stop once the L1 change in ranks falls below this
+        max_iter - the maximum number of iterations
+    returns
+        a float64 numpy array of ranks in node order, summing to 1
+    '''
+    logger = logging.getLogger(__name__)
+    n = graph.num_nodes()
+    if n == 0:
+        return np.zeros(0, dtype=np.float64)
+
+    _, a_t = adjacency_matrices(graph)
+    out_degree = np.diff(np.asarray(graph.out_indptr)).astype(np.float64)
+    dangling = out_degree == 0
+    inverse_degree = np.divide(1.0, out_degree, out=np.zeros(n), where=~dangling)
+
+    ranks = np.full(n, 1.0 / n)
+    for iteration in range(1, max_iter + 1):
+        spread = a_t @ (ranks * inverse_degree)
+        new_ranks = damping * (spread + ranks[dangling].sum() / n) + (1.0 - damping) / n
+        change = np.abs(new_ranks - ranks).sum()
+        ranks = new_ranks
+        if change < tol:
+            logger.info(f"PageRank converged after {iteration} iterations")
+            break
+    else:
+        logger.warning(f"PageRank did not converge after {max_iter} iterations, change {change}")
+
+    return ranks
+
+def product_blocks(left, right, max_entries):
+    ''' Splits the rows of left into blocks whose product with right is
+        expected to hold at most max_entries entries before duplicates are
+        summed. A single row over the budget gets a block of its own
+    params
+        left - a CSR matrix
+        right - a CSR matrix
+        max_entries - the budget for each block
+    returns
+        yields tuples (start_row, end_row)
+    '''
+    # Each entry (i, j) of left contributes the length of row j of right
+    cost = np.zeros(left.nnz + 1, dtype=np.int64)
+    np.cumsum(np.diff(right.indptr)[left.indices], out=cost[1:])
+    cumulative = cost[left.indptr[1:]]
+
+    start = 0
+    while start < left.shape[0]:
+        offset = cumulative[start - 1] if start else 0
+        end = int(np.searchsorted(cumulative, offset + max_entries, side="right"))
+        end = max(end, start + 1)
+        yield (start, end)
+        start = end
+
+def top_k_rows(block, k, row_offset):
+    ''' Gets the k largest entries of each row of a CSR block, ties broken by
+        the lower column index
+    params
+        block - a CSR matrix holding rows row_offset onwards
+        k - the number of entries to keep per row
+        row_offset - the row of the full matrix the block starts at
+    returns
+        a tuple of numpy arrays (rows, cols, values), sorted by row and then
+        by descending value
+    '''
+    block.sort_indices()
+    lengths = np.diff(block.indptr)
+    rows = np.repeat(np.arange(block.shape[0]), lengths)
+    order = np.lexsort((block.indices, -block.data, rows))
+    rank = np.arange(len(order)) - np.repeat(block.indptr[:-1], lengths)
+    keep = order[rank < k]
+
+    return (rows[keep] + row_offset, block.indices[keep], block.data[keep])
+
+def top_k_products(left, right, k=10, max_entries=50000000, exclude_self=True):
+    ''' Computes the top k entries of each row of left @ right one block of
+        rows at a time, so the full product is never held in memory
+    params
+        left - a CSR matrix
+        right - a CSR matrix
+        k - the number of neighbours to keep per row
+        max_entries - the product size budget for each block, see product_blocks
+        exclude_self - drop the diagonal, a node is always its own neighbour
+    returns
+        yields tuples of numpy arrays (rows, cols, values) for each block
+    '''
+    logger = logging.getLogger(__name__)
+
+    for start, end in product_blocks(left, right, max_entries):
+        block = (left[start:end] @ right).tocsr()
+        if exclude_self:
+            block = block.tocoo()
+            off_diagonal = block.row + start != block.col
+            block = sparse.csr_matrix((block.data[off_diagonal], (block.row[off_diagonal],
+                                        block.col[off_diagonal])), shape=block.shape)
+        logger.debug(f"Rows {start} to {end}, {block.nnz} nonzero products")
+        yield top_k_rows(block, k, start)
+
+def drop_shared_hubs(left, right, max_shared):
+    ''' Removes the nodes shared between left and right (the columns of left
+        and rows of right) that link to more than max_shared nodes. A paper
+        cited by 100,000 others would otherwise add 10^10 bibliographic
+        coupling products while saying little about any pair of them
+    returns
+        a tuple of CSR matrices (left, right)
+    '''
+    if max_shared is None:
+        return (left, right)
+
+    keep = (np.diff(right.indptr) <= max_shared).astype(np.int32)
+    mask = sparse.diags(keep, dtype=np.int32)
+    left = (left @ mask).tocsr()
+    left.eliminate_zeros()
+    right = (mask @ right).tocsr()
+    right.eliminate_zeros()
+
+    return (left, right)
+
+def co_citation(graph, k=10, max_entries=50000000, max_shared=None):
+    ''' Top k co-cited neighbours of each node, from A^T A
+    params
+        graph - a CitationGraph
+        k - the number of neighbours to keep per node
+        max_entries - the product size budget for each block of rows
+        max_shared - ignore citing papers with more references than this,
+            None to use all
+    returns
+        yields tuples of numpy arrays (rows, cols, counts) of node IDs
+    '''
+    a, a_t = adjacency_matrices(graph)
+    left, right = drop_shared_hubs(a_t, a, max_shared)
+    return top_k_products(left, right, k, max_entries)
+
+def bibliographic_coupling(graph, k=10, max_entries=50000000, max_shared=None):
+    ''' Top k bibliographically coupled neighbours of each node, from A A^T
+    params
+        graph - a CitationGraph
+        k - the number of neighbours to keep per node
+        max_entries - the product size budget for each block of rows
+        max_shared - ignore cited papers with more citers than this, None to
+            use all
+    returns
+        yields tuples of numpy arrays (rows, cols, counts) of node IDs
+    '''
+    a, a_t = adjacency_matrices(graph)
+    left, right = drop_shared_hubs(a, a_t, max_shared)
+    return top_k_products(left, right, k, max_entries)
+
+def write_node_features(graph, out_path, damping=0.85):
+    ''' Writes a TSV of PMID, in degree, out degree and PageRank for every node
+    '''
+    ranks = pagerank(graph, damping)
+    in_degree = graph.degree(direction="in")
+    out_degree = graph.degree(direction="out")
+
+    with open(out_path, "w") as out:
+        out.write("pmid\tin_degree\tout_degree\tpagerank\n")
+        for pmid, in_deg, out_deg, rank in zip(graph.nodes.tolist(), in_degree.tolist(),
+                                                out_degree.tolist(), ranks.tolist()):
+            out.write(f"{pmid}\t{in_deg}\t{out_deg}\t{rank:.6e}\n")
+
+def write_neighbours(graph, blocks, out_path):
+    ''' Writes top k neighbour blocks as a TSV of PMID, neighbour PMID, count
+    '''
+    with open(out_path, "w") as out:
+        out.write("pmid\tneighbour\tcount\n")
+        for rows, cols, values in blocks:
+            pmids = graph.nodes[rows].tolist()
+            neighbours = graph.nodes[cols].tolist()
+            for pmid, neighbour, value in zip(pmids, neighbours, values.tolist()):
+                out.write(f"{pmid}\t{neighbour}\t{value}\n")
+
+def main():
+    # Get command line args
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-g", "--graph", help="A graph store directory written by " \
+                    "citation_graph.py", required=True, type=str)
+    parser.add_argument("-o", "--output", help="Directory to write the feature TSVs to",
+                    required=True, type=str)
+    parser.add_argument("-k", "--top", help="The number of co-citation and bibliographic " \
+                    "coupling neighbours to keep for each paper", type=int, default=10)
+    parser.add_argument("-d", "--damping", help="The PageRank damping factor",
+                    type=float, default=0.85)
+    parser.add_argument("-b", "--block-entries", help="The number of intermediate products " \
+                    "computed at a time, bounds memory use", type=int, default=50000000)
+    parser.add_argument("-m", "--max-shared", help="Ignore papers with more than this many " \
+                    "citers (for coupling) or references (for co-citation) when counting shared " \
+                    "links, 0 to use all", type=int, default=10000)
+    parser.add_argument("-q", "--quiet", help="Suppress printing of log messages to STDOUT. " \
+                    "Warning: exceptions will not be printed to console", action="store_true")
+    args = parser.parse_args()
+
+    # Set up logging
+    logger = logging.getLogger(__name__)
+    logger.setLevel(logging.INFO)
+    handler = logging.FileHandler("citation_features.log")
+    formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+    handler.setFormatter(formatter)
+    logger.addHandler(handler)
+
+    if not args.quiet:
+        handler = logging.StreamHandler(sys.stdout)
+        handler.setLevel(logging.INFO)
+        formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+        handler.setFormatter(formatter)
+        logger.addHandler(handler)
+
+    os.makedirs(args.output, exist_ok=True)
+    graph = CitationGraph(args.graph)
+    logger.info(f"Loaded graph with {graph.num_nodes()} nodes and {graph.num_edges()} edges")
+
+    write_node_features(graph, os.path.join(args.output, "node_features.tsv"), args.damping)
+    logger.info("Wrote degrees and PageRank")
+
+    max_shared = args.max_shared or None
+
+    write_neighbours(graph, co_citation(graph, args.top, args.block_entries, max_shared),
+                        os.path.join(args.output, "co_citation.tsv"))
+    logger.info("Wrote co-citation neighbours")
+
+    write_neighbours(graph, bibliographic_coupling(graph, args.top, args.block_entries,
+                        max_shared),
+                        os.path.join(args.output, "bibliographic_coupling.tsv"))
+    logger.info("Wrote bibliographic coupling neighbours")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,310 @@
+#!/usr/bin/env python3
+import os
+import sys
+import json
+import logging
+import argparse
+from array import array
+
+import numpy as np
+
+from edge_store import read_edge_store
+from compressed_io import open_file
+
+'''
+The graph store is a directory of .npy arrays, loaded memory-mapped:
+    nodes.npy - the PMID of each node, sorted, node IDs are indices into it
+    out_indptr.npy, out_indices.npy - CSR arrays of each node's references
+    in_indptr.npy, in_indices.npy - CSR arrays of each node's citers
+    meta.json - node and edge counts
+Node IDs and PMIDs are stored as uint32 and edges are deduplicated
+'''
+
+def read_edge_arrays(fp, delim=",", lines_per_chunk=1000000):
+    ''' Reads an edge list written by citation_network.py into PMID arrays
+        without building a Python tuple for each edge
+    params
+        fp - path to the edge list
+        delim - the delimiter between the nodes of each edge
+        lines_per_chunk - the number of lines converted at a time
+    returns
+        a tuple of uint32 numpy arrays (citing_pmids, cited_pmids)
+    '''
+    chunks = []
+    with open_file(fp, "r") as handle:
+        while True:
+            lines = handle.readlines(lines_per_chunk * 16)
+            if not lines:
+                break
+            values = np.array("".join(lines).replace(delim, "\n").split(), dtype=np.uint64)
+            chunks.append(values)
+
+    if not chunks:
+        empty = np.zeros(0, dtype=np.uint32)
+        return (empty, empty)
+
+    values = np.concatenate(chunks)
+    if len(values) % 2:
+        raise ValueError(f"{fp} has a line that is not a pair of PMIDs")
+    if len(values) and values.max() > np.iinfo(np.uint32).max:
+        raise ValueError("PMIDs larger than 2^32 - 1 are not supported")
+    values = values.astype(np.uint32)
+
+    return (values[0::2], values[1::2])
+
+def edges_to_arrays(edges):
+    ''' Packs an iterable of (citing_PMID, cited_PMID) string tuples, like the
+        output of citation_network.edge_generator, into uint32 arrays
+    params
+        edges - an iterable of edge tuples
+    returns
+        a tuple of uint32 numpy arrays (citing_pmids, cited_pmids)
+    '''
+    src = array("I")
+    dst = array("I")
+    for edge in edges:
+        src.append(int(edge[0]))
+        dst.append(int(edge[1]))
+
+    return (np.frombuffer(src, dtype=np.uint32), np.frombuffer(dst, dtype=np.uint32))
+
+def csr_from_sorted(rows, cols, num_nodes):
+    ''' Builds CSR arrays from edges already sorted by row
+    returns
+        a tuple (indptr, indices)
+    '''
+    indptr = np.zeros(num_nodes + 1, dtype=np.int64)
+    np.cumsum(np.bincount(rows, minlength=num_nodes), out=indptr[1:])
+
+    return (indptr, cols.astype(np.uint32))
+
+def build_citation_graph(src, dst, out_dir):
+    ''' Builds the graph store from PMID arrays. PMIDs are interned to
+        dense uint32 node IDs and duplicate edges are dropped
+    params
+        src - a numpy array of citing PMIDs
+        dst - a numpy array of cited PMIDs, the same length as src
+        out_dir - directory to write the store to, created if needed
+    returns
+        a tuple (num_nodes, num_edges)
+    '''
+    logger = logging.getLogger(__name__)
+    os.makedirs(out_dir, exist_ok=True)
+
+    nodes = np.unique(np.concatenate([src, dst])).astype(np.uint32)
+    num_nodes = len(nodes)
+
+    # Packing (src, dst) into one uint64 key dedupes and sorts by src then dst
+    keys = np.searchsorted(nodes, src).astype(np.uint64) << np.uint64(32)
+    keys |= np.searchsorted(nodes, dst).astype(np.uint64)
+    keys = np.unique(keys)
+    rows = (keys >> np.uint64(32)).astype(np.uint32)
+    cols = (keys & np.uint64(0xFFFFFFFF)).astype(np.uint32)
+    del keys
+
+    out_indptr, out_indices = csr_from_sorted(rows, cols, num_nodes)
+
+    # A stable sort by cited node keeps each node's citers in ID order
+    order = np.argsort(cols, kind="stable")
+    in_indptr, in_indices = csr_from_sorted(cols[order], rows[order], num_nodes)
+    del order
+
+    np.save(os.path.join(out_dir, "nodes.npy"), nodes)
+    np.save(os.path.join(out_dir, "out_indptr.npy"), out_indptr)
+    np.save(os.path.join(out_dir, "out_indices.npy"), out_indices)
+    np.save(os.path.join(out_dir, "in_indptr.npy"), in_indptr)
+    np.save(os.path.join(out_dir, "in_indices.npy"), in_indices)
+
+    with open(os.path.join(out_dir, "meta.json"), "w") as out:
+        json.dump({"num_nodes": int(num_nodes), "num_edges": int(len(rows))}, out)
+
+    logger.info(f"Built citation graph with {num_nodes} nodes and {len(rows)} edges "
+                f"from {len(src)} raw edges")
+
+    return (num_nodes, len(rows))
+
+def gather_neighbours(indptr, indices, node_ids):
+    ''' Concatenates the neighbour lists of several nodes without a Python
+        loop over the nodes
+    params
+        indptr - CSR index pointer array
+        indices - CSR indices array
+        node_ids - a numpy array of node IDs
+    returns
+        a numpy array of neighbour node IDs, with repeats
+    '''
+    starts = indptr[node_ids]
+    lengths = indptr[node_ids + 1] - starts
+    total = int(lengths.sum())
+    if total == 0:
+        return np.zeros(0, dtype=np.uint32)
+
+    # Offset of each position within its own neighbour list
+    offsets = np.arange(total, dtype=np.int64) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+
+    return np.asarray(indices[np.repeat(starts, lengths) + offsets])
+
+class CitationGraph:
+    ''' Read-only access to a graph store written by build_citation_graph.
+        The arrays are memory-mapped, so opening a store is cheap and queries
+        only touch the pages they need
+    params
+        graph_dir - the directory of the store
+    '''
+    directions = ("out", "in", "both")
+
+    def __init__(self, graph_dir):
+        def load(name):
+            return np.load(os.path.join(graph_dir, f"{name}.npy"), mmap_mode="r")
+
+        self.nodes = load("nodes")
+        self.out_indptr = load("out_indptr")
+        self.out_indices = load("out_indices")
+        self.in_indptr = load("in_indptr")
+        self.in_indices = load("in_indices")
+
+    def num_nodes(self):
+        return len(self.nodes)
+
+    def num_edges(self):
+        return len(self.out_indices)
+
+    def node_ids(self, pmids):
+        ''' Maps PMIDs to node IDs
+        params
+            pmids - a PMID or an array-like of PMIDs, as ints or strings
+        returns
+            a numpy array of node IDs, -1 for PMIDs not in the graph
+        '''
+        pmids = np.atleast_1d(np.asarray(pmids, dtype=np.int64))
+        ids = np.searchsorted(self.nodes, pmids)
+        found = ids < len(self.nodes)
+        found[found] = self.nodes[ids[found]] == pmids[found]
+
+        return np.where(found, ids, -1)
+
+    def _csr(self, direction):
+        if direction == "out":
+            return [(self.out_indptr, self.out_indices)]
+        elif direction == "in":
+            return [(self.in_indptr, self.in_indices)]
+        elif direction == "both":
+            return [(self.out_indptr, self.out_indices), (self.in_indptr, self.in_indices)]
+
+        raise ValueError(f"direction must be one of {self.directions}")
+
+    def degree(self, pmids=None, direction="out"):
+        ''' Gets node degrees
+        params
+            pmids - PMIDs to get degrees for, all nodes in node order if None
+            direction - 'out' for the number of references, 'in' for the
+                number of citers, 'both' for their sum
+        returns
+            a numpy array of degrees, 0 for PMIDs not in the graph
+        '''
+        degrees = None
+        for indptr, _ in self._csr(direction):
+            if pmids is None:
+                deg = np.diff(indptr)
+            else:
+                ids = self.node_ids(pmids)
+                deg = np.where(ids >= 0, indptr[ids + 1] - indptr[np.maximum(ids, 0)], 0)
+            degrees = deg if degrees is None else degrees + deg
+
+        return degrees
+
+    def neighbours(self, pmid, direction="out"):
+        ''' Gets the neighbours of a node
+        params
+            pmid - the PMID of the node
+            direction - 'out' for references, 'in' for citers, 'both' for both
+        returns
+            a numpy array of neighbour PMIDs, empty if the PMID is not in the graph
+        '''
+        return self.nodes[self.neighbour_ids(self.node_ids(pmid), direction)]
+
+    def neighbour_ids(self, node_ids, direction="out"):
+        ''' Gets the unique neighbours of a set of nodes by node ID
+        params
+            node_ids - a numpy array of node IDs, negative IDs are ignored
+            direction - 'out', 'in' or 'both'
+        returns
+            a sorted numpy array of node IDs
+        '''
+        node_ids = np.asarray(node_ids, dtype=np.int64)
+        node_ids = node_ids[node_ids >= 0]
+
+        found = [gather_neighbours(indptr, indices, node_ids)
+                    for indptr, indices in self._csr(direction)]
+
+        return np.unique(np.concatenate(found)).astype(np.int64)
+
+    def k_hop(self, pmids, k, direction="out"):
+        ''' Expands a set of nodes by up to k hops, one vectorized frontier
+            expansion per hop
+        params
+            pmids - the PMIDs to start from
+            k - the number of hops
+            direction - 'out', 'in' or 'both'
+        returns
+            a tuple of numpy arrays (pmids, hops) giving every node reached
+            within k hops, other than the start nodes, and the number of hops
+            to reach it
+        '''
+        seen = np.zeros(len(self.nodes), dtype=bool)
+        frontier = self.node_ids(pmids)
+        frontier = np.unique(frontier[frontier >= 0])
+        seen[frontier] = True
+
+        reached = []
+        hops = []
+        for hop in range(1, k + 1):
+            if len(frontier) == 0:
+                break
+            frontier = self.neighbour_ids(frontier, direction)
+            frontier = frontier[~seen[frontier]]
+            seen[frontier] = True
+            reached.append(frontier)
+            hops.append(np.full(len(frontier), hop, dtype=np.int64))
+
+        if not reached:
+            return (np.zeros(0, dtype=np.uint32), np.zeros(0, dtype=np.int64))
+
+        return (self.nodes[np.concatenate(reached)], np.concatenate(hops))
+
+def main():
+    # Get command line args
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-i", "--input", help="An edge list written by citation_network.py, " \
+                    "or an edge store directory written by edge_store.py", required=True, type=str)
+    parser.add_argument("-o", "--output", help="Directory to write the graph store to",
+                    required=True, type=str)
+    parser.add_argument("-d", "--delim", help="Delimiter between the nodes of each edge",
+                    default=",")
+    parser.add_argument("-q", "--quiet", help="Suppress printing of log messages to STDOUT. " \
+                    "Warning: exceptions will not be printed to console", action="store_true")
+    args = parser.parse_args()
+
+    # Set up logging
+    logger = logging.getLogger(__name__)
+    logger.setLevel(logging.INFO)
+    handler = logging.FileHandler("citation_graph.log")
+    formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+    handler.setFormatter(formatter)
+    logger.addHandler(handler)
+
+    if not args.quiet:
+        handler = logging.StreamHandler(sys.stdout)
+        handler.setLevel(logging.INFO)
+        formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+        handler.setFormatter(formatter)
+        logger.addHandler(handler)
+
+    if os.path.isdir(args.input):
+        src, dst = read_edge_store(args.input)
+    else:
+        src, dst = read_edge_arrays(args.input, args.delim)
+    build_citation_graph(src, dst, args.output)
+
+if __name__ == "__main__":
+    main()
@@ -7,21 +7,217 @@ import logging
 import argparse
 import traceback
 from pathlib import Path
+from functools import partial
+from itertools import chain
+from multiprocessing import Pool
 
-def edge_generator(file_list, verbose=True):
-    ''' Generates the edges from PMC full-text XML files. These edges
-        comprise the citation network. Tested on XMLs retrieved from the 
-        Pubmed API as well as the bulk files from the Pubmed FTP site.
+from oa_bulk import is_archive, get_archive_list, archive_generator
+from edge_sort import sort_edges, sort_edge_arrays
+from compressed_io import open_file
+
+class ReferenceScanner:
+    ''' An incremental scanner that finds an article's PMID and the PMIDs of
+        its references in a single forward pass over a PMC XML, without
+        holding the whole article in memory. Text is passed in with feed() in
+        blocks of any size and the result is taken from close().
+
+        The results match those of the whole-article regexes this replaced:
+        the article PMID is the last <article-id pub-id-type="pmid"> between
+        the first <front> and the last </front>, and the references are read
+        from the text between the last <ref-list and the last </ref-list>
+        that precede the last </back> (after the first <back>). That text is
+        split on "<ref" and the first pmid <pub-id> of each piece is kept
+
+        If a resolver (an id_index.IdResolver) is given, a piece with no pmid
+        <pub-id> falls back to the first of its doi or pmcid <pub-id>s that
+        the resolver can map to a PMID
+    '''
+    # Every branch is a literal or a digit run, so there is no backtracking.
+    # ref-list has to be tried before ref
+    tokens = re.compile(r'<(?:(front>)|(/front>)|(back>)|(/back>)|(ref-list)|(/ref-list>)|(ref)|'
+                        r'article-id pub-id-type="pmid">(\d+)</article-id>|'
+                        r'pub-id pub-id-type="pmid">(\d+)</pub-id>)')
+    resolving_tokens = re.compile(tokens.pattern[:-1] +
+                        r'|pub-id pub-id-type="doi">([^<]*)</pub-id>|'
+                        r'pub-id pub-id-type="pmcid">([^<]*)</pub-id>)')
+    # Matches ending within this many characters of the end of the buffer are
+    # held back until more text arrives, as they could still be extended
+    lookahead = 1024
+
+    def __init__(self, resolver=None):
+        self.buffer = ""
+        self.resolver = resolver
+        self.tokens = self.tokens if resolver is None else self.resolving_tokens
+
+        self.seen_front = False
+        self.front_candidate = None
+        self.article_id = None
+
+        self.seen_back = False
+        # PMIDs found since the most recent <ref-list, and whether the current
+        # piece (text since the last "<ref") has already given one
+        self.segment = None
+        self.piece_has_pmid = False
+        # A resolved doi or pmcid for the current piece, added to the segment
+        # when the piece ends if the piece has no pmid of its own
+        self.piece_fallback = None
+        # (segment, length) at the last </ref-list>, and at the last </back>
+        self.pending = None
+        self.confirmed = None
+
+    def feed(self, text):
+        self.buffer += text
+        self._scan(final=False)
+
+    def close(self):
+        ''' Scans any remaining text
+        returns
+            a tuple (article_id, refs) where article_id is the article's PMID
+            or None, and refs is a list of reference PMIDs, or None if the
+            article has no reference list
+        '''
+        self._scan(final=True)
+        self.buffer = ""
+
+        refs = None
+        if self.confirmed is not None:
+            segment, length = self.confirmed
+            refs = segment[:length]
+
+        return (self.article_id, refs)
+
+    def _scan(self, final):
+        buffer = self.buffer
+        limit = len(buffer) if final else len(buffer) - self.lookahead
+        keep = max(limit, 0)
+
+        for match in self.tokens.finditer(buffer):
+            if match.end() > limit:
+                keep = match.start()
+                break
+            self._handle(match)
+            keep = max(match.end(), limit)
+
+        self.buffer = buffer[keep:]
+
+    def _handle(self, match):
+        group = match.lastindex
+
+        if group == 1:
+            self.seen_front = True
+        elif group == 2:
+            if self.front_candidate is not None:
+                self.article_id = self.front_candidate
+        elif group == 3:
+            self.seen_back = True
+        elif group == 4:
+            if self.pending is not None:
+                self.confirmed = self.pending
+        elif group == 5:
+            if self.seen_back:
+                self.segment = []
+                self.piece_has_pmid = False
+                self.piece_fallback = None
+        elif group == 6:
+            if self.segment is not None:
+                self._end_piece()
+                self.pending = (self.segment, len(self.segment))
+        elif group == 7:
+            self._end_piece()
+            self.piece_has_pmid = False
+        elif group == 8:
+            if self.seen_front:
+                self.front_candidate = match.group(8)
+        elif group == 9:
+            if self.segment is not None and not self.piece_has_pmid:
+                self.segment.append(match.group(9))
+                self.piece_has_pmid = True
+        elif group in (10, 11):
+            if (self.segment is not None and not self.piece_has_pmid
+                    and self.piece_fallback is None):
+                if group == 10:
+                    self.piece_fallback = self.resolver.resolve_doi(match.group(10))
+                else:
+                    self.piece_fallback = self.resolver.resolve_pmcid(match.group(11))
+
+    def _end_piece(self):
+        if self.piece_fallback is not None:
+            if self.segment is not None and not self.piece_has_pmid:
+                self.segment.append(self.piece_fallback)
+                self.piece_has_pmid = True
+            self.piece_fallback = None
+
+def scan_article(handle, block_size=2**20, resolver=None):
+    ''' Finds an article's PMID and reference PMIDs with a ReferenceScanner
     params
-        file_list - A list of XMLs to parse
-        verbose - Boolean, print logging and exceptions to console
+        handle - a text mode file handle for a PMC XML
+        block_size - the number of characters to read at a time
+        resolver - an id_index.IdResolver to resolve doi and pmcid references
+            with, or None to keep only pmid references
     returns
-        yields single directed edges as tuples in the format
-        (article_PMID, reference_PMID)
-        where the article with PMID article_PMID cites the article
-        with PMID reference_PMID
+        a tuple (article_id, refs), see ReferenceScanner.close
+    '''
+    scanner = ReferenceScanner(resolver)
+    block = handle.read(block_size)
+    while block:
+        scanner.feed(block)
+        block = handle.read(block_size)
+
+    return scanner.close()
+
+def get_edges(xml_file, resolver=None):
+    ''' Gets the edges for a single PMC full-text XML
+    params
+        xml_file - path to the XML, which may be gzip or zstd compressed
+        resolver - an id_index.IdResolver, or None
+    returns
+        a list of directed edges as tuples (article_PMID, reference_PMID), or
+        None if the article has no PMID or no reference list
+    '''
+    with open_file(xml_file, "r") as handle:
+        return get_handle_edges(handle, resolver)
+
+def get_handle_edges(handle, resolver=None):
+    ''' Gets the edges for a single PMC full-text XML from an open handle
+    params
+        handle - a text mode handle for the XML
+        resolver - an id_index.IdResolver, or None
+    returns
+        a list of edges as for get_edges, or None
+    '''
+    article_id, refs = scan_article(handle, resolver=resolver)
+
+    if article_id and refs is not None:
+        return [(article_id, ref) for ref in refs]
+
+    return None
+
+def archive_member_edges(member_name, handle, resolver=None):
+    ''' Gets the edges for an XML streamed from an archive, for use with
+        oa_bulk.archive_generator
+    '''
+    return get_handle_edges(handle, resolver)
+
+def edge_worker(xml_file, resolver=None):
+    ''' A multiprocessing worker for parallel_edge_generator. Exceptions are
+        caught here and passed back so they can be logged by the parent
+    params
+        xml_file - path to the XML
+        resolver - an id_index.IdResolver, or None
+    returns
+        a tuple (edges, error) where edges is the result of get_edges and
+        error is None or a tuple (repr, traceback)
+    '''
+    try:
+        return (get_edges(xml_file, resolver), None)
+    except Exception as e:
+        return (None, (repr(e), traceback.format_exc()))
+
+def initialize_logger(verbose=True):
+    ''' Sets up logging to edge_list_builder.log and, if verbose, STDOUT
+    returns
+        a logger
     '''
-    # Set up logging
     logger = logging.getLogger(__name__)
     logger.setLevel(logging.INFO)
     handler = logging.FileHandler("edge_list_builder.log")
@@ -36,10 +232,25 @@ def edge_generator(file_list, verbose=True):
         handler.setFormatter(formatter)
         logger.addHandler(handler)
 
-    article_pmid = re.compile(r'<front>[\s\S]*<article-id pub-id-type="pmid">(\d+)</article-id>[\s\S]*</front>')
-    article_refs_list = re.compile(r'<back>[\s\S]*<ref-list([\s\S]*)</ref-list>[\s\S]*</back>')
-    article_ref_pmid = re.compile(r'<pub-id pub-id-type="pmid">(\d+)</pub-id>')
-    
+    return logger
+
+def edge_generator(file_list, verbose=True, resolver=None):
+    ''' Generates the edges from PMC full-text XML files. These edges
+        comprise the citation network. Tested on XMLs retrieved from the 
+        Pubmed API as well as the bulk files from the Pubmed FTP site.
+    params
+        file_list - A list of XMLs to parse
+        verbose - Boolean, print logging and exceptions to console
+        resolver - an id_index.IdResolver to also keep references that only
+            have a DOI or PMCID, or None
+    returns
+        yields single directed edges as tuples in the format
+        (article_PMID, reference_PMID)
+        where the article with PMID article_PMID cites the article
+        with PMID reference_PMID
+    '''
+    logger = initialize_logger(verbose)
+
     logger.info("Starting edge list generator")
 
     edge_count = 0
@@ -47,25 +258,14 @@ def edge_generator(file_list, verbose=True):
 
     for xml_file in file_list:
         try:
-            with open(xml_file, "r") as handle:
-                article = handle.readlines()
-
-            article = "".join(article)
-            
-            article_id_match = article_pmid.search(article)
-            refs_match = article_refs_list.search(article)
-
-            if article_id_match and refs_match:
-                article_id = article_id_match.group(1)
-                refs = refs_match.group(1)
-                refs = refs.split("<ref")
+            edges = get_edges(xml_file, resolver)
+
+            if edges is not None:
                 doc_count += 1
 
-                for ref in refs:
-                    ref_match = article_ref_pmid.search(ref)
-                    if ref_match:
-                        edge_count += 1
-                        yield (article_id, ref_match.group(1))
+                for edge in edges:
+                    edge_count += 1
+                    yield edge
                 
         except Exception as e:
             trace = traceback.format_exc()
@@ -74,18 +274,122 @@ def edge_generator(file_list, verbose=True):
 
     logger.info(f"Generated {edge_count} edges from {doc_count} documents")
 
-def build_edge_list(file_list, verbose=True):
+def parallel_edge_generator(file_list, workers=None, ordered=True, chunksize=64, verbose=True,
+                                resolver=None):
+    ''' Generates the same edges as edge_generator, but parses the XMLs in a
+        pool of worker processes. Files are handed to the workers in chunks and
+        each file's edges come back as one batch
+    params
+        file_list - A list of XMLs to parse
+        workers - the number of worker processes, defaults to the CPU count
+        ordered - Boolean, yield edges in the order of file_list, as
+            edge_generator does. If False, edges are yielded as soon as any
+            worker finishes a file
+        chunksize - the number of files sent to a worker per task
+        verbose - Boolean, print logging and exceptions to console
+        resolver - an id_index.IdResolver, or None
+    returns
+        yields single directed edges as tuples (article_PMID, reference_PMID)
+    '''
+    logger = initialize_logger(verbose)
+
+    logger.info(f"Starting parallel edge list generator with {workers or os.cpu_count()} workers")
+
+    edge_count = 0
+    doc_count = 0
+
+    # Resolvers pickle as their index path, each worker maps the index itself
+    worker = partial(edge_worker, resolver=resolver)
+
+    with Pool(workers) as pool:
+        if ordered:
+            results = pool.imap(worker, file_list, chunksize)
+        else:
+            results = pool.imap_unordered(worker, file_list, chunksize)
+
+        for edges, error in results:
+            if error is not None:
+                logger.error(error[0])
+                logger.critical(error[1])
+            elif edges is not None:
+                doc_count += 1
+
+                for edge in edges:
+                    edge_count += 1
+                    yield edge
+
+    logger.info(f"Generated {edge_count} edges from {doc_count} documents")
+
+def archive_edge_generator(archives, workers=1, limit=None, verbose=True, resolver=None):
+    ''' Generates edges from the XMLs in PMC oa_bulk tar archives, streaming
+        the members without extracting them to disk
+    params
+        archives - a list of paths to .tar.gz archives
+        workers - the number of archives to read in parallel
+        limit - the maximum number of XMLs to parse, all if None
+        verbose - Boolean, print logging and exceptions to console
+        resolver - an id_index.IdResolver, or None
+    returns
+        yields single directed edges as tuples (article_PMID, reference_PMID)
+    '''
+    logger = initialize_logger(verbose)
+
+    logger.info(f"Starting edge list generator on {len(archives)} archives")
+
+    edge_count = 0
+    doc_count = 0
+    member_count = 0
+
+    member_function = partial(archive_member_edges, resolver=resolver)
+
+    for member_name, edges, error in archive_generator(archives, member_function, workers):
+        if error is not None:
+            logger.error(f"{member_name}: {error[0]}")
+            logger.critical(error[1])
+        elif edges is not None:
+            doc_count += 1
+
+            for edge in edges:
+                edge_count += 1
+                yield edge
+
+        member_count += 1
+        if limit and member_count >= limit:
+            break
+
+    logger.info(f"Generated {edge_count} edges from {doc_count} documents")
+
+def get_edge_generator(file_list, verbose=True, workers=1, ordered=True, resolver=None):
+    ''' Picks the serial or parallel edge generator
+    params
+        file_list - A list of XMLs to parse
+        verbose - Boolean, print logging and exceptions to console
+        workers - the number of worker processes, 1 parses in this process
+        ordered - Boolean, keep the order of file_list when parsing in parallel
+        resolver - an id_index.IdResolver, or None
+    returns
+        an edge generator
+    '''
+    if workers == 1:
+        return edge_generator(file_list, verbose, resolver)
+
+    return parallel_edge_generator(file_list, workers, ordered, verbose=verbose, resolver=resolver)
+
+def build_edge_list(file_list, verbose=True, workers=1, ordered=True, resolver=None):
     ''' A wrapper for the generator in cases where a list is needed
     params
         file_list - A list of XMLs to parse
         verbose - Boolean, print logging and exceptions to console
+        workers - the number of worker processes, 1 parses in this process
+        ordered - Boolean, keep the order of file_list when parsing in parallel
+        resolver - an id_index.IdResolver, or None
     returns
         returns a list of directed edges as tuples in the format
         (article_PMID, reference_PMID)
         where the article with PMID article_PMID cites the article
         with PMID reference_PMID
     '''
-    gen = edge_generator(file_list, verbose)
+    gen = get_edge_generator(file_list, verbose, workers, ordered, resolver)
 
     edge_list = []
     for edge in gen:
@@ -93,17 +397,21 @@ def build_edge_list(file_list, verbose=True):
 
     return edge_list
 
-def write_edge_list(file_list, out_path, delim=",", verbose=True):
+def write_edge_list(file_list, out_path, delim=",", verbose=True, workers=1, ordered=True,
+                    resolver=None):
     ''' A wrapper for the generator that writes to an output file
     params
         file_list - A list of XMLs to parse
         out_path - Output path to write edge list to
         delim - delimiter to separate nodes for each edge
         verbose - Boolean, print logging and exceptions to console
+        workers - the number of worker processes, 1 parses in this process
+        ordered - Boolean, keep the order of file_list when parsing in parallel
+        resolver - an id_index.IdResolver, or None
     '''
 
-    gen = edge_generator(file_list, verbose)
-    with open(out_path, "w") as out:
+    gen = get_edge_generator(file_list, verbose, workers, ordered, resolver)
+    with open_file(out_path, "w") as out:
         for edge in gen:
             out.write("".join([edge[0], delim, edge[1], "\n"]))
 
@@ -112,19 +420,59 @@ def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("-i", "--input", help="A directory, can be relative to cwd, containing " \
                     "XMLs to build an edge list from. Does not recursively search child directories, " \
-                    "all XMLs should be at the top level of the directory", 
+                    "all XMLs should be at the top level of the directory. oa_bulk .tar.gz archives in " \
+                    "the directory, or a single archive given instead, are read without extracting", 
                     required=True, type=str)
     parser.add_argument("-o", "--output", help="Output file path to write edge list to, stdout " \
                     "if no path provided")
     parser.add_argument("-n", "--number", help="The number of documents to parse", type=int)
     parser.add_argument("-q", "--quiet", help="Suppress printing of log messages to STDOUT. " \
                     "Warning: exceptions will not be printed to console", action="store_true")
+    parser.add_argument("-w", "--workers", help="Number of worker processes to parse XMLs with",
+                    type=int, default=1)
+    parser.add_argument("-u", "--unordered", help="When using multiple workers, write edges as " \
+                    "soon as they are parsed instead of in input order", action="store_true")
+    parser.add_argument("-s", "--store", help="An edge store directory to update incrementally, " \
+                    "only new or changed XMLs are parsed. The store's live edges are then " \
+                    "written to the output")
+    parser.add_argument("-r", "--resolve", help="An ID index directory written by id_index.py. " \
+                    "References with no PMID are kept if their DOI or PMCID maps to one")
+    parser.add_argument("-d", "--dedupe", help="Write deduplicated edges sorted by PMID, using " \
+                    "a bounded-memory external sort. Requires an output path", action="store_true")
+    parser.add_argument("--shards", help="With --dedupe, partition edges by citing PMID into " \
+                    "this many files, {output}.0, {output}.1, ...", type=int, default=1)
+    parser.add_argument("--memory", help="Memory budget for --dedupe in MB", type=int, default=1024)
+    parser.add_argument("--temp-dir", help="Directory for the sorted runs of --dedupe, the " \
+                    "system temp directory by default")
     args = parser.parse_args()
 
-    if args.number:
-        xmls = os.listdir(args.input)[:args.number]
+    if args.workers < 1:
+        parser.error("-w/--workers must be at least 1")
+    if args.dedupe and not args.output:
+        parser.error("--dedupe requires an output path")
+    if args.store and args.number:
+        # The store drops every file not in the list it is given, so a
+        # partial listing would remove the edges of the rest
+        parser.error("-n/--number can't be used with --store")
+    sort_args = (args.output, args.shards, ",", args.memory, args.temp_dir)
+
+    resolver = None
+    if args.resolve:
+        from id_index import IdResolver
+        resolver = IdResolver(args.resolve)
+
+    archives = get_archive_list(args.input)
+    if archives and args.store:
+        # The store's manifest tracks files on disk, not archive members
+        parser.error("--store can't be used with oa_bulk archive input")
+
+    if os.path.isfile(args.input):
+        xmls = []
     else:
-        xmls = os.listdir(args.input)
+        # Archives are streamed below rather than parsed as XMLs
+        xmls = [xml for xml in os.listdir(args.input) if not is_archive(xml)]
+    if args.number:
+        xmls = xmls[:args.number]
 
     # Make filepaths absolute
     xml_containing_dir = Path(args.input).resolve()
@@ -135,14 +483,43 @@ def main():
     # Check to make sure paths are files and not dirs
     xmls_to_parse = [path for path in xmls_to_parse if os.path.isfile(path)]
 
-    if args.output:
-        if args.quiet:
-            write_edge_list(xmls_to_parse, args.output, verbose=False)
+    if args.store:
+        # Imported here as edge_store imports from this module
+        import edge_store
+        logger = edge_store.initialize_logger(args.quiet or not args.output)
+        counts = edge_store.update_edge_store(xmls_to_parse, args.store, args.workers,
+                                                resolver=resolver)
+        logger.info(f"Parsed {counts['parsed']}, unchanged {counts['unchanged']}, " \
+                    f"removed {counts['removed']}, failed {counts['failed']}")
+        if args.dedupe:
+            sort_edge_arrays(*edge_store.read_edge_store(args.store), *sort_args)
         else:
-            write_edge_list(xmls_to_parse, args.output, verbose=True)
+            edge_store.write_store_edges(args.store, args.output)
+        return
+
+    # Verbose only with an output path, as stdout is intended primarily for piping
+    verbose = bool(args.output) and not args.quiet
+    # Input order is lost in sorting, so there's no need to keep it
+    ordered = not args.unordered and not args.dedupe
+
+    # The edges of the XMLs come first, then those of the archive members
+    generators = []
+    if xmls_to_parse:
+        generators.append(get_edge_generator(xmls_to_parse, verbose, args.workers, ordered,
+                                                resolver))
+    limit = args.number - len(xmls_to_parse) if args.number else None
+    if archives and (limit is None or limit > 0):
+        generators.append(archive_edge_generator(archives, args.workers, limit, verbose,
+                                                    resolver))
+    gen = chain(*generators)
+
+    if args.dedupe:
+        sort_edges(gen, *sort_args)
+    elif args.output:
+        with open_file(args.output, "w") as out:
+            for edge in gen:
+                out.write("".join([edge[0], ",", edge[1], "\n"]))
     else:
-        # Verbose set to false here, as this is intended primarily for piping output
-        gen = edge_generator(xmls_to_parse, verbose=False)
         for edge in gen:
             sys.stdout.write("".join([edge[0], ",", edge[1], "\n"]))
 
@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+import io
+import gzip
+import json
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+'''
+Transparent reading and writing of gzip and zstd compressed files, so the
+tools can work straight from compressed corpora like the PubMed baseline. On
+read, the compression is detected from the file's magic bytes, and on write
+from the path's extension unless it is given. Streams are wrapped in large
+buffers, as decompressing in small reads spends most of its time in call
+overhead. zstd needs the optional zstandard package
+'''
+
+codec_extensions = {"none": "", "gzip": ".gz", "zstd": ".zst"}
+codec_magic = {"gzip": b"\x1f\x8b", "zstd": b"\x28\xb5\x2f\xfd"}
+
+buffer_size = 2**20
+
+def check_codec(compression):
+    if compression not in codec_extensions:
+        raise ValueError(f"Unknown compression '{compression}', use one of " \
+                            f"{list(codec_extensions)}")
+    if compression == "zstd" and zstandard is None:
+        raise ImportError("zstd compression requires the zstandard package")
+
+def compression_from_path(path):
+    ''' returns the compression a path's extension implies, 'none' if no codec's '''
+    for compression, extension in codec_extensions.items():
+        if extension and str(path).endswith(extension):
+            return compression
+    return "none"
+
+def compression_from_data(data):
+    ''' returns the compression the first bytes of a file imply '''
+    for compression, magic in codec_magic.items():
+        if data.startswith(magic):
+            return compression
+    return "none"
+
+def detect_compression(path):
+    ''' Gets the compression of an existing file from its magic bytes '''
+    with open(path, "rb") as handle:
+        return compression_from_data(handle.read(4))
+
+def compress_block(data, compression, level=None):
+    ''' Compresses bytes as a single gzip member or zstd frame '''
+    if compression == "gzip":
+        # mtime=0 keeps the output the same from run to run
+        return gzip.compress(data, compresslevel=level or 6, mtime=0)
+    if compression == "zstd":
+        return zstandard.ZstdCompressor(level=level or 3).compress(data)
+    return data
+
+def decompress_block(data, compression=None):
+    ''' Decompresses bytes, which may hold several gzip members or zstd
+        frames. The compression is detected if not given
+    '''
+    compression = compression or compression_from_data(data)
+    if compression == "gzip":
+        return gzip.decompress(data)
+    if compression == "zstd":
+        check_codec(compression)
+        reader = zstandard.ZstdDecompressor().stream_reader(io.BytesIO(data),
+                                                            read_across_frames=True)
+        return reader.read()
+    return data
+
+def open_file(path, mode="r", compression=None, level=None, encoding=None, newline=None):
+    ''' Opens a file like open() does, compressed or not
+    params
+        path - the file path
+        mode - 'r', 'w' or 'a', with 'b' for binary mode
+        compression - 'none', 'gzip' or 'zstd'. When reading it is detected
+            from the file if None, and when writing taken from the extension
+        level - the compression level for writing, the codec default if None
+        encoding - the text encoding, the locale's as with open() if None
+        newline - newline handling in text mode, as with open()
+    returns
+        a buffered file object, text mode unless 'b' is in mode
+    '''
+    binary = "b" in mode
+    base_mode = mode.replace("b", "").replace("t", "")
+    if base_mode not in ("r", "w", "a"):
+        raise ValueError(f"Unsupported mode '{mode}'")
+
+    if compression is None:
+        if base_mode == "r":
+            compression = detect_compression(path)
+        else:
+            compression = compression_from_path(path)
+    check_codec(compression)
+
+    if compression == "none":
+        if binary:
+            return open(path, mode, buffering=buffer_size)
+        return open(path, base_mode, buffering=buffer_size, encoding=encoding,
+                    newline=newline)
+
+    if compression == "gzip":
+        stream = gzip.open(path, f"{base_mode}b", compresslevel=level or 6)
+    elif base_mode == "r":
+        # read_across_frames as blocks written by compress_block are
+        # separate frames
+        stream = zstandard.ZstdDecompressor().stream_reader(open(path, "rb"),
+                    read_size=buffer_size, read_across_frames=True, closefd=True)
+    else:
+        stream = zstandard.ZstdCompressor(level=level or 3).stream_writer(
+                    open(path, f"{base_mode}b"), closefd=True)
+
+    if base_mode == "r":
+        stream = io.BufferedReader(stream, buffer_size)
+    else:
+        stream = io.BufferedWriter(stream, buffer_size)
+
+    if binary:
+        return stream
+    return io.TextIOWrapper(stream, encoding=encoding, newline=newline)
+
+def read_text(path):
+    ''' Reads a text file, or the sections of a JSON file written by pmc_parser,
+        either may be compressed
+    '''
+    with open_file(path, "r") as handle:
+        if any(path.endswith(f".json{extension}") for extension in codec_extensions.values()):
+            return "\n".join(json.load(handle).values())
+        return handle.read()
@@ -0,0 +1,311 @@
+#!/usr/bin/env python3
+import os
+import sys
+import shutil
+import logging
+import argparse
+import tempfile
+from array import array
+
+import numpy as np
+
+from compressed_io import open_file, compression_from_path
+
+'''
+Bounded-memory external sort for edge lists. Each edge is packed into one
+uint64 key (citing_PMID << 32 | cited_PMID), so sorting the keys sorts the
+edges by citing and then cited PMID, and equal keys are duplicate edges.
+Keys are collected into sorted, deduplicated runs on disk, which are then
+merged and written to one or more hash-partitioned shards
+'''
+
+shift = np.uint64(32)
+low_mask = np.uint64(0xFFFFFFFF)
+
+# Edges are formatted and written this many at a time, so the text of a
+# whole merged block is never held at once
+write_keys = 2**16
+
+def pack_edges(src, dst):
+    src = np.asarray(src, dtype=np.uint64)
+    dst = np.asarray(dst, dtype=np.uint64)
+    if len(src) and max(src.max(), dst.max()) > low_mask:
+        raise ValueError("PMIDs larger than 2^32 - 1 are not supported")
+    return (src << shift) | dst
+
+def sort_unique(keys):
+    ''' Sorts keys in place and drops repeats. Faster than np.unique, which
+        hashes integer input before sorting it
+    '''
+    keys.sort()
+    if len(keys) < 2:
+        return keys
+    keep = np.empty(len(keys), dtype=bool)
+    keep[0] = True
+    np.not_equal(keys[1:], keys[:-1], out=keep[1:])
+    return keys[keep]
+
+class EdgeSorter:
+    ''' Collects edges into sorted, deduplicated runs on disk, using at most
+        about memory_mb of memory for keys
+    params
+        memory_mb - the memory budget in MB
+        temp_dir - the directory to create the run directory in, the system
+            default if None
+    '''
+    def __init__(self, memory_mb=1024, temp_dir=None):
+        # Sorting and deduplicating a buffer needs about twice its size
+        self.memory_bytes = memory_mb * 2**20
+        self.buffer_keys = max(self.memory_bytes // 16, 1024)
+        self.run_dir = tempfile.mkdtemp(prefix="edge_sort_", dir=temp_dir)
+        self.runs = []
+        self.buffer = array("Q")
+        self.edge_count = 0
+
+    def add(self, citing, cited):
+        ''' Adds one edge, PMIDs may be ints or strings '''
+        citing = int(citing)
+        cited = int(cited)
+        if citing > 0xFFFFFFFF or cited > 0xFFFFFFFF:
+            raise ValueError("PMIDs larger than 2^32 - 1 are not supported")
+        self.buffer.append(citing << 32 | cited)
+        if len(self.buffer) >= self.buffer_keys:
+            self._spill()
+
+    def add_arrays(self, src, dst):
+        ''' Adds edges from arrays of citing and cited PMIDs '''
+        keys = pack_edges(src, dst)
+        start = 0
+        while start < len(keys):
+            # The packed bytes are copied straight into the buffer, filling
+            # it no further than buffer_keys before each spill
+            end = start + self.buffer_keys - len(self.buffer)
+            self.buffer.frombytes(keys[start:end].view(np.uint8))
+            start = end
+            if len(self.buffer) >= self.buffer_keys:
+                self._spill()
+
+    def _spill(self):
+        if not self.buffer:
+            return
+        # Sorted in place in the buffer's memory rather than a copy of it
+        keys = sort_unique(np.frombuffer(self.buffer, dtype=np.uint64))
+        self.edge_count += len(self.buffer)
+        self.buffer = array("Q")
+
+        run_path = os.path.join(self.run_dir, f"run_{len(self.runs)}.bin")
+        keys.tofile(run_path)
+        self.runs.append((run_path, len(keys)))
+
+    def sorted_blocks(self):
+        ''' Merges the runs
+        returns
+            yields sorted uint64 key arrays with no repeats within or across
+            blocks
+        '''
+        self._spill()
+        if not self.runs:
+            return
+
+        block_keys = max(self.memory_bytes // (16 * len(self.runs)), 4096)
+        # The read position and current block of each run
+        positions = [0] * len(self.runs)
+        blocks = [None] * len(self.runs)
+        last = None
+
+        def refill(i):
+            run_path, length = self.runs[i]
+            count = min(block_keys, length - positions[i])
+            if count <= 0:
+                blocks[i] = None
+                return
+            blocks[i] = np.fromfile(run_path, dtype=np.uint64, count=count,
+                                    offset=positions[i] * 8)
+            positions[i] += count
+
+        for i in range(len(self.runs)):
+            refill(i)
+
+        while True:
+            live = [i for i in range(len(blocks)) if blocks[i] is not None]
+            if not live:
+                break
+
+            # Every key up to the smallest block maximum is known to be in
+            # the current blocks, as the runs are sorted
+            threshold = min(blocks[i][-1] for i in live)
+            parts = []
+            for i in live:
+                cut = np.searchsorted(blocks[i], threshold, side="right")
+                parts.append(blocks[i][:cut])
+                blocks[i] = blocks[i][cut:]
+                if len(blocks[i]) == 0:
+                    refill(i)
+
+            merged = sort_unique(np.concatenate(parts))
+            if last is not None and len(merged) and merged[0] == last:
+                merged = merged[1:]
+            if len(merged):
+                last = merged[-1]
+                yield merged
+
+    def cleanup(self):
+        shutil.rmtree(self.run_dir, ignore_errors=True)
+
+def shard_ids(keys, num_shards):
+    ''' Assigns each edge a shard by a multiplicative hash of its citing PMID,
+        so all edges of an article land in the same shard
+    '''
+    # Computed in place, as each temporary would be the size of keys
+    hashed = keys >> shift
+    hashed *= np.uint64(2654435761)
+    hashed &= low_mask
+    hashed %= np.uint64(num_shards)
+    return hashed
+
+def shard_paths(out_path, num_shards):
+    if num_shards == 1:
+        return [out_path]
+    return [f"{out_path}.{num}" for num in range(num_shards)]
+
+def write_sorted_edges(sorter, out_path, num_shards=1, delim=","):
+    ''' Writes the merged edges of an EdgeSorter. With more than one shard,
+        edges are written to {out_path}.0 to {out_path}.{num_shards - 1},
+        each sorted by citing and then cited PMID
+    params
+        sorter - an EdgeSorter that all edges have been added to
+        out_path - the output path
+        num_shards - the number of shards
+        delim - delimiter to separate nodes for each edge
+    returns
+        the number of unique edges written
+    '''
+    logger = logging.getLogger(__name__)
+
+    # Shards are compressed as out_path's extension implies
+    compression = compression_from_path(out_path)
+    outs = [open_file(path, "w", compression) for path in shard_paths(out_path, num_shards)]
+    unique_count = 0
+    try:
+        for keys in sorter.sorted_blocks():
+            unique_count += len(keys)
+            if num_shards == 1:
+                groups = [(0, keys)]
+            else:
+                shards = shard_ids(keys, num_shards)
+                # Masking keeps each shard's keys in PMID order, and only one
+                # shard's copy is made at a time
+                groups = ((num, keys[shards == num]) for num in range(num_shards))
+
+            for num, group in groups:
+                for start in range(0, len(group), write_keys):
+                    part = group[start:start + write_keys]
+                    lines = zip((part >> shift).tolist(), (part & low_mask).tolist())
+                    outs[num].write("".join([f"{citing}{delim}{cited}\n" for citing, cited in lines]))
+    finally:
+        for out in outs:
+            out.close()
+
+    logger.info(f"Wrote {unique_count} unique edges of {sorter.edge_count} to {num_shards} " \
+                f"shard(s) from {len(sorter.runs)} sorted run(s)")
+
+    return unique_count
+
+def sort_edges(edges, out_path, num_shards=1, delim=",", memory_mb=1024, temp_dir=None):
+    ''' Deduplicates and sorts an iterable of edges, like the output of
+        citation_network.edge_generator, in bounded memory
+    params
+        edges - an iterable of (citing_PMID, cited_PMID) tuples
+        out_path - the output path, see write_sorted_edges
+        num_shards - the number of hash-partitioned shards to write
+        delim - delimiter to separate nodes for each edge
+        memory_mb - the memory budget for keys in MB
+        temp_dir - the directory for sorted runs, the system default if None
+    returns
+        the number of unique edges written
+    '''
+    sorter = EdgeSorter(memory_mb, temp_dir)
+    try:
+        for edge in edges:
+            sorter.add(edge[0], edge[1])
+        return write_sorted_edges(sorter, out_path, num_shards, delim)
+    finally:
+        sorter.cleanup()
+
+def sort_edge_arrays(src, dst, out_path, num_shards=1, delim=",", memory_mb=1024, temp_dir=None):
+    ''' Deduplicates and sorts edges given as arrays of citing and cited
+        PMIDs, like those read from an edge_store
+    returns
+        the number of unique edges written
+    '''
+    sorter = EdgeSorter(memory_mb, temp_dir)
+    try:
+        for start in range(0, len(src), sorter.buffer_keys):
+            sorter.add_arrays(src[start:start + sorter.buffer_keys],
+                                dst[start:start + sorter.buffer_keys])
+        return write_sorted_edges(sorter, out_path, num_shards, delim)
+    finally:
+        sorter.cleanup()
+
+def sort_edge_file(in_path, out_path, num_shards=1, delim=",", memory_mb=1024, temp_dir=None):
+    ''' Deduplicates and sorts an existing edge list, reading it in chunks
+    params
+        in_path - path to an edge list written by citation_network.py
+        see sort_edges for the rest
+    returns
+        the number of unique edges written
+    '''
+    sorter = EdgeSorter(memory_mb, temp_dir)
+    # Characters per chunk, as a rough fraction of the budget
+    chunk_chars = max(sorter.buffer_keys, 2**16)
+    try:
+        with open_file(in_path, "r") as handle:
+            while True:
+                lines = handle.readlines(chunk_chars)
+                if not lines:
+                    break
+                values = np.array("".join(lines).replace(delim, "\n").split(), dtype=np.uint64)
+                if len(values) % 2:
+                    raise ValueError(f"{in_path} has a line that is not a pair of PMIDs")
+                sorter.add_arrays(values[0::2], values[1::2])
+        return write_sorted_edges(sorter, out_path, num_shards, delim)
+    finally:
+        sorter.cleanup()
+
+def main():
+    # Get command line args
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-i", "--input", help="An edge list written by citation_network.py",
+                    required=True, type=str)
+    parser.add_argument("-o", "--output", help="Output path, shards are written to " \
+                    "{output}.0, {output}.1, ... when there is more than one", required=True, type=str)
+    parser.add_argument("-n", "--shards", help="The number of shards to partition edges into " \
+                    "by citing PMID", type=int, default=1)
+    parser.add_argument("-m", "--memory", help="Memory budget for sorting in MB",
+                    type=int, default=1024)
+    parser.add_argument("-t", "--temp-dir", help="Directory for temporary sorted runs")
+    parser.add_argument("-d", "--delim", help="Delimiter between the nodes of each edge",
+                    default=",")
+    parser.add_argument("-q", "--quiet", help="Suppress printing of log messages to STDOUT. " \
+                    "Warning: exceptions will not be printed to console", action="store_true")
+    args = parser.parse_args()
+
+    # Set up logging
+    logger = logging.getLogger(__name__)
+    logger.setLevel(logging.INFO)
+    handler = logging.FileHandler("edge_sort.log")
+    formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+    handler.setFormatter(formatter)
+    logger.addHandler(handler)
+
+    if not args.quiet:
+        handler = logging.StreamHandler(sys.stdout)
+        handler.setLevel(logging.INFO)
+        formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+        handler.setFormatter(formatter)
+        logger.addHandler(handler)
+
+    sort_edge_file(args.input, args.output, args.shards, args.delim, args.memory, args.temp_dir)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,328 @@
+#!/usr/bin/env python3
+import io
+import os
+import sys
+import hashlib
+import logging
+import argparse
+import traceback
+from array import array
+from pathlib import Path
+from functools import partial
+from multiprocessing import Pool
+
+import numpy as np
+
+from citation_network import get_handle_edges
+from compressed_io import decompress_block
+
+'''
+An incremental, on-disk store of citation network edges. The store is a
+directory containing:
+    edges.bin - append-only (citing_PMID, cited_PMID) uint32 pairs
+    manifest.tsv - one line per parsed file giving its path, size, mtime (ns),
+        BLAKE2b hash and the [start, end) range of its edges in edges.bin
+Edges of files that were changed or removed stay in edges.bin until the store
+is compacted, but are no longer covered by a manifest range
+'''
+
+manifest_fields = ["path", "size", "mtime", "hash", "start", "end"]
+
+def read_manifest(store_dir):
+    ''' Reads the manifest of an edge store
+    params
+        store_dir - the store directory
+    returns
+        a dict giving the manifest entry (a dict) for each path, empty if the
+        store does not exist yet
+    '''
+    manifest = {}
+    manifest_path = os.path.join(store_dir, "manifest.tsv")
+    if not os.path.isfile(manifest_path):
+        return manifest
+
+    with open(manifest_path, "r") as handle:
+        for line in handle:
+            values = line.rstrip("\n").split("\t")
+            entry = dict(zip(manifest_fields, values))
+            for field in ("size", "mtime", "start", "end"):
+                entry[field] = int(entry[field])
+            manifest[entry["path"]] = entry
+
+    return manifest
+
+def write_manifest(store_dir, manifest):
+    ''' Writes the manifest, replacing the old one only once the new one is
+        complete so that an interrupted run leaves the previous state intact
+    '''
+    manifest_path = os.path.join(store_dir, "manifest.tsv")
+    with open(f"{manifest_path}.tmp", "w") as out:
+        for entry in sorted(manifest.values(), key=lambda entry: entry["start"]):
+            out.write("\t".join([str(entry[field]) for field in manifest_fields]))
+            out.write("\n")
+    os.replace(f"{manifest_path}.tmp", manifest_path)
+
+def get_file_state(path):
+    stat = os.stat(path)
+    return (stat.st_size, stat.st_mtime_ns)
+
+def index_worker(path, resolver=None):
+    ''' Reads a file once to both hash it and extract its edges
+    params
+        path - path to a PMC XML
+        resolver - an id_index.IdResolver, or None
+    returns
+        a tuple (path, size, mtime, hash, edges, error) where edges is a list
+        of edge tuples or None, and error is None or a tuple (repr, traceback)
+    '''
+    try:
+        size, mtime = get_file_state(path)
+        with open(path, "rb") as handle:
+            data = handle.read()
+        digest = hashlib.blake2b(data, digest_size=16).hexdigest()
+        # The hash is of the file as stored, compressed or not. TextIOWrapper
+        # decodes the same way open(path, "r") does
+        edges = get_handle_edges(io.TextIOWrapper(io.BytesIO(decompress_block(data))), resolver)
+        return (path, size, mtime, digest, edges, None)
+    except Exception as e:
+        return (path, None, None, None, None, (repr(e), traceback.format_exc()))
+
+def hash_file(path):
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as handle:
+        for block in iter(lambda: handle.read(2**20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def update_edge_store(file_list, store_dir, workers=1, compact_ratio=0.5, resolver=None):
+    ''' Brings an edge store up to date with a list of files. Files whose size
+        and mtime match the manifest are skipped without being read, files
+        whose metadata changed but whose hash did not are only re-stamped, and
+        all other new or changed files are parsed and their edges appended.
+        Files no longer in file_list are dropped from the manifest
+    params
+        file_list - a list of paths to PMC XMLs, should be absolute
+        store_dir - the store directory, created if needed
+        workers - the number of worker processes to parse with
+        compact_ratio - compact the store once this fraction of edges.bin
+            is no longer covered by the manifest
+        resolver - an id_index.IdResolver, or None. Only files that are
+            parsed in this run use it, so a store should be kept with the
+            same resolver setting throughout
+    returns
+        a dict of counts: parsed, unchanged, restamped, removed, failed
+    '''
+    logger = logging.getLogger(__name__)
+    os.makedirs(store_dir, exist_ok=True)
+
+    manifest = read_manifest(store_dir)
+    counts = {"parsed": 0, "unchanged": 0, "restamped": 0, "removed": 0, "failed": 0}
+
+    current = set(file_list)
+    for path in [path for path in manifest if path not in current]:
+        del manifest[path]
+        counts["removed"] += 1
+
+    to_parse = []
+    for path in file_list:
+        entry = manifest.get(path)
+        if entry is None:
+            to_parse.append(path)
+            continue
+
+        try:
+            size, mtime = get_file_state(path)
+            if (size, mtime) == (entry["size"], entry["mtime"]):
+                counts["unchanged"] += 1
+            elif size == entry["size"] and hash_file(path) == entry["hash"]:
+                entry["mtime"] = mtime
+                counts["restamped"] += 1
+            else:
+                to_parse.append(path)
+        except Exception as e:
+            trace = traceback.format_exc()
+            logger.error(f"{path}: {repr(e)}")
+            logger.critical(trace)
+            # The file can't be checked, so its edges are dropped from the
+            # store and it is parsed again once it can be read
+            del manifest[path]
+            counts["failed"] += 1
+
+    logger.info(f"{len(to_parse)} files to parse, {counts['unchanged']} unchanged, "
+                f"{counts['removed']} removed")
+
+    edges_path = os.path.join(store_dir, "edges.bin")
+    with open(edges_path, "ab") as out:
+        # Edge positions are counted in (citing, cited) pairs of uint32s
+        position = out.tell() // 8
+        buffer = array("I")
+
+        worker = partial(index_worker, resolver=resolver)
+        pool = None
+        if workers == 1:
+            results = map(worker, to_parse)
+        else:
+            pool = Pool(workers)
+            results = pool.imap(worker, to_parse, 64)
+
+        try:
+            for path, size, mtime, digest, edges, error in results:
+                if error is not None:
+                    logger.error(f"{path}: {error[0]}")
+                    logger.critical(error[1])
+                    # Failed files are left out of the manifest so they are retried
+                    manifest.pop(path, None)
+                    counts["failed"] += 1
+                    continue
+
+                start = position
+                for edge in edges or []:
+                    buffer.append(int(edge[0]))
+                    buffer.append(int(edge[1]))
+                position += len(edges or [])
+
+                manifest[path] = {"path": path, "size": size, "mtime": mtime, "hash": digest,
+                                    "start": start, "end": position}
+                counts["parsed"] += 1
+
+                if len(buffer) >= 2**22:
+                    buffer.tofile(out)
+                    buffer = array("I")
+
+            buffer.tofile(out)
+        finally:
+            # As with Pool's context manager, the workers are stopped whether
+            # or not the merge finished
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+
+    write_manifest(store_dir, manifest)
+
+    live = sum(entry["end"] - entry["start"] for entry in manifest.values())
+    total = os.path.getsize(edges_path) // 8
+    logger.info(f"Edge store has {live} live edges out of {total} stored")
+    if total and (total - live) / total > compact_ratio:
+        compact_edge_store(store_dir)
+
+    return counts
+
+def live_ranges(manifest):
+    entries = sorted(manifest.values(), key=lambda entry: entry["start"])
+    starts = np.array([entry["start"] for entry in entries], dtype=np.int64)
+    ends = np.array([entry["end"] for entry in entries], dtype=np.int64)
+    return (starts, ends)
+
+def read_edge_store(store_dir):
+    ''' Reads the live edges of a store
+    params
+        store_dir - the store directory
+    returns
+        a tuple of uint32 numpy arrays (citing_pmids, cited_pmids), ready to
+        pass to citation_graph.build_citation_graph
+    '''
+    manifest = read_manifest(store_dir)
+    edges_path = os.path.join(store_dir, "edges.bin")
+    if not manifest or os.path.getsize(edges_path) == 0:
+        empty = np.zeros(0, dtype=np.uint32)
+        return (empty, empty)
+
+    pairs = np.memmap(edges_path, dtype=np.uint32, mode="r").reshape(-1, 2)
+    starts, ends = live_ranges(manifest)
+    lengths = ends - starts
+    index = np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+    live = np.asarray(pairs[index])
+
+    return (live[:, 0].copy(), live[:, 1].copy())
+
+def compact_edge_store(store_dir):
+    ''' Rewrites edges.bin with only the edges covered by the manifest and
+        updates the manifest's ranges to match
+    params
+        store_dir - the store directory
+    '''
+    logger = logging.getLogger(__name__)
+    manifest = read_manifest(store_dir)
+    edges_path = os.path.join(store_dir, "edges.bin")
+
+    src, dst = read_edge_store(store_dir)
+
+    position = 0
+    for entry in sorted(manifest.values(), key=lambda entry: entry["start"]):
+        length = entry["end"] - entry["start"]
+        entry["start"] = position
+        entry["end"] = position + length
+        position += length
+
+    np.stack([src, dst], axis=1).astype(np.uint32).tofile(f"{edges_path}.tmp")
+    os.replace(f"{edges_path}.tmp", edges_path)
+    write_manifest(store_dir, manifest)
+
+    logger.info(f"Compacted edge store to {position} edges")
+
+def write_store_edges(store_dir, out_path=None, delim=","):
+    ''' Writes the live edges of a store as an edge list, in the same format
+        as citation_network.py
+    params
+        store_dir - the store directory
+        out_path - the path to write to, stdout if None
+        delim - the delimiter between the nodes of each edge
+    '''
+    src, dst = read_edge_store(store_dir)
+    out = open(out_path, "w") if out_path else sys.stdout
+    try:
+        for citing, cited in zip(src.tolist(), dst.tolist()):
+            out.write(f"{citing}{delim}{cited}\n")
+    finally:
+        if out_path:
+            out.close()
+
+def initialize_logger(quiet=False):
+    logger = logging.getLogger(__name__)
+    logger.setLevel(logging.INFO)
+    handler = logging.FileHandler("edge_store.log")
+    formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+    handler.setFormatter(formatter)
+    logger.addHandler(handler)
+
+    if not quiet:
+        handler = logging.StreamHandler(sys.stdout)
+        handler.setLevel(logging.INFO)
+        formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+        handler.setFormatter(formatter)
+        logger.addHandler(handler)
+
+    return logger
+
+def main():
+    # Get command line args
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-i", "--input", help="A directory containing PMC XMLs to index, " \
+                    "only the top level is searched", required=True, type=str)
+    parser.add_argument("-s", "--store", help="Directory of the edge store to update",
+                    required=True, type=str)
+    parser.add_argument("-o", "--output", help="Also write the live edges to this path as " \
+                    "a comma-delimited edge list")
+    parser.add_argument("-w", "--workers", help="Number of worker processes to parse XMLs with",
+                    type=int, default=1)
+    parser.add_argument("-q", "--quiet", help="Suppress printing of log messages to STDOUT. " \
+                    "Warning: exceptions will not be printed to console", action="store_true")
+    args = parser.parse_args()
+
+    logger = initialize_logger(args.quiet)
+
+    # Make filepaths absolute so the manifest is independent of cwd
+    xml_containing_dir = Path(args.input).resolve()
+    xmls = [os.path.join(xml_containing_dir, xml) for xml in os.listdir(args.input)]
+    xmls = [path for path in xmls if os.path.isfile(path)]
+
+    counts = update_edge_store(xmls, args.store, args.workers)
+    logger.info(f"Parsed {counts['parsed']}, unchanged {counts['unchanged']}, " \
+                f"restamped {counts['restamped']}, removed {counts['removed']}, " \
+                f"failed {counts['failed']}")
+
+    if args.output:
+        write_store_edges(args.store, args.output)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+import os
+import csv
+import sys
+import json
+import hashlib
+import logging
+import argparse
+from array import array
+
+import numpy as np
+
+from compressed_io import open_file
+
+'''
+A lookup index from PMCIDs and DOIs to PMIDs, built once from NCBI's PMC-ids
+mapping file (https://ftp.ncbi.nlm.nih.gov/pub/pmc/PMC-ids.csv.gz). The index
+is a directory of sorted .npy arrays that are memory-mapped when loaded, so
+opening it is cheap and each lookup is a binary search:
+    pmcid_keys.npy, pmcid_pmids.npy - PMCID numbers and their PMIDs
+    doi_keys.npy, doi_pmids.npy - 64-bit hashes of normalized DOIs and their PMIDs
+    meta.json - entry counts
+'''
+
+doi_prefixes = ("https://doi.org/", "http://doi.org/", "https://dx.doi.org/",
+                "http://dx.doi.org/", "doi:")
+
+def normalize_doi(doi):
+    ''' DOIs are case-insensitive and are often written as URLs or with a
+        "doi:" prefix in references
+    '''
+    doi = doi.strip().lower()
+    for prefix in doi_prefixes:
+        if doi.startswith(prefix):
+            return doi[len(prefix):].strip()
+    return doi
+
+def doi_key(doi):
+    digest = hashlib.blake2b(normalize_doi(doi).encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "little")
+
+def pmcid_key(pmcid):
+    ''' Gets the number of a PMCID like "PMC1234567"
+    returns
+        an int, or None if pmcid is not a PMCID
+    '''
+    pmcid = pmcid.strip().upper()
+    if pmcid.startswith("PMC"):
+        pmcid = pmcid[3:]
+    return int(pmcid) if pmcid.isdigit() else None
+
+def sorted_unique(keys, values):
+    ''' Sorts keys and their values by key, keeping the first value given for
+        a repeated key
+    '''
+    order = np.argsort(keys, kind="stable")
+    keys = keys[order]
+    values = values[order]
+    _, first = np.unique(keys, return_index=True)
+
+    return (keys[first], values[first])
+
+def build_id_index(csv_path, out_dir):
+    ''' Builds the index from a PMC-ids.csv or PMC-ids.csv.gz file. Rows
+        without a PMID are skipped
+    params
+        csv_path - path to the mapping file
+        out_dir - directory to write the index to, created if needed
+    returns
+        a tuple (num_pmcids, num_dois)
+    '''
+    logger = logging.getLogger(__name__)
+    os.makedirs(out_dir, exist_ok=True)
+
+    pmcid_keys = array("I")
+    pmcid_pmids = array("I")
+    doi_keys = array("Q")
+    doi_pmids = array("I")
+
+    with open_file(csv_path, "r", newline="") as handle:
+        reader = csv.reader(handle)
+        header = next(reader)
+        doi_col = header.index("DOI")
+        pmcid_col = header.index("PMCID")
+        pmid_col = header.index("PMID")
+
+        for row in reader:
+            if len(row) <= pmid_col or not row[pmid_col].isdigit():
+                continue
+            pmid = int(row[pmid_col])
+
+            pmcid = pmcid_key(row[pmcid_col])
+            if pmcid is not None:
+                pmcid_keys.append(pmcid)
+                pmcid_pmids.append(pmid)
+
+            if row[doi_col].strip():
+                doi_keys.append(doi_key(row[doi_col]))
+                doi_pmids.append(pmid)
+
+    arrays = {"pmcid": sorted_unique(np.frombuffer(pmcid_keys, dtype=np.uint32),
+                                        np.frombuffer(pmcid_pmids, dtype=np.uint32)),
+              "doi": sorted_unique(np.frombuffer(doi_keys, dtype=np.uint64),
+                                        np.frombuffer(doi_pmids, dtype=np.uint32))}
+
+    for name, (keys, pmids) in arrays.items():
+        np.save(os.path.join(out_dir, f"{name}_keys.npy"), keys)
+        np.save(os.path.join(out_dir, f"{name}_pmids.npy"), pmids)
+
+    counts = (len(arrays["pmcid"][0]), len(arrays["doi"][0]))
+    with open(os.path.join(out_dir, "meta.json"), "w") as out:
+        json.dump({"num_pmcids": counts[0], "num_dois": counts[1]}, out)
+
+    logger.info(f"Indexed {counts[0]} PMCIDs and {counts[1]} DOIs")
+
+    return counts
+
+class IdResolver:
+    ''' Resolves PMCIDs and DOIs to PMIDs with an index written by
+        build_id_index. Pickling a resolver only pickles the index path, so
+        it can be handed to worker processes, which map the index themselves
+    params
+        index_dir - the directory of the index
+    '''
+    def __init__(self, index_dir):
+        self.index_dir = index_dir
+
+        def load(name):
+            return np.load(os.path.join(index_dir, f"{name}.npy"), mmap_mode="r")
+
+        self.pmcid_keys = load("pmcid_keys")
+        self.pmcid_pmids = load("pmcid_pmids")
+        self.doi_keys = load("doi_keys")
+        self.doi_pmids = load("doi_pmids")
+
+    def __getstate__(self):
+        return self.index_dir
+
+    def __setstate__(self, index_dir):
+        self.__init__(index_dir)
+
+    @staticmethod
+    def _lookup(keys, pmids, key):
+        i = int(np.searchsorted(keys, key))
+        if i < len(keys) and keys[i] == key:
+            return str(pmids[i])
+        return None
+
+    def resolve_pmcid(self, pmcid):
+        ''' returns the PMID for a PMCID as a string, or None '''
+        key = pmcid_key(pmcid)
+        if key is None or key > np.iinfo(np.uint32).max:
+            return None
+        return self._lookup(self.pmcid_keys, self.pmcid_pmids, np.uint32(key))
+
+    def resolve_doi(self, doi):
+        ''' returns the PMID for a DOI as a string, or None '''
+        if not doi.strip():
+            return None
+        return self._lookup(self.doi_keys, self.doi_pmids, np.uint64(doi_key(doi)))
+
+def main():
+    # Get command line args
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-i", "--input", help="Path to PMC-ids.csv or PMC-ids.csv.gz",
+                    required=True, type=str)
+    parser.add_argument("-o", "--output", help="Directory to write the index to",
+                    required=True, type=str)
+    parser.add_argument("-q", "--quiet", help="Suppress printing of log messages to STDOUT. " \
+                    "Warning: exceptions will not be printed to console", action="store_true")
+    args = parser.parse_args()
+
+    # Set up logging
+    logger = logging.getLogger(__name__)
+    logger.setLevel(logging.INFO)
+    handler = logging.FileHandler("id_index.log")
+    formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+    handler.setFormatter(formatter)
+    logger.addHandler(handler)
+
+    if not args.quiet:
+        handler = logging.StreamHandler(sys.stdout)
+        handler.setLevel(logging.INFO)
+        formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+        handler.setFormatter(formatter)
+        logger.addHandler(handler)
+
+    build_id_index(args.input, args.output)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,264 @@
+#!/usr/bin/env python3
+import os
+import re
+import sys
+import pickle
+import logging
+import argparse
+from collections import Counter, deque
+
+from parse_mesh import parse_mesh
+from compressed_io import open_file, read_text
+
+'''
+Finds mentions of MeSH descriptors in cleaned text. The names and entry terms
+of every descriptor are compiled into an Aho-Corasick automaton over tokens,
+so a document is tagged in one pass over its tokens however many terms there
+are. Text and terms are tokenized the same way, casefolded and split on
+anything that isn't a letter or digit, so "Non-Hodgkin's Lymphoma" matches
+"non hodgkin s lymphoma". Where matches overlap, the leftmost and then the
+longest is counted. The automaton is pickled to a cache file, and workers
+given a tagger load it from there once per process
+'''
+
+token_regex = re.compile(r"[^\W_]+")
+
+# Bumped when the automaton layout changes, so old caches are rebuilt
+cache_version = 1
+
+# Automata loaded in this process, by cache path
+loaded_automata = {}
+
+def tokenize(text):
+    return token_regex.findall(text.casefold())
+
+def build_automaton(desc_data):
+    ''' Compiles descriptor names and entry terms into an automaton
+    params
+        desc_data - the descriptor dict returned by parse_mesh.parse_mesh
+    returns
+        a dict holding the token vocabulary and the automaton's lists, each
+        indexed by node with the root as node 0:
+            goto - dicts of token ID to child node
+            fail - the node for the longest proper suffix in the trie
+            depth - the number of tokens from the root
+            outputs - a tuple of UIDs for nodes that end a term, else None
+            dict_link - the nearest node on the fail chain ending a term
+    '''
+    vocab = {}
+    goto = [{}]
+    depth = [0]
+    outputs = [None]
+
+    for uid, fields in desc_data.items():
+        terms = [fields["name"]]
+        if fields["entry_terms"]:
+            terms.extend(fields["entry_terms"].split("|"))
+
+        for term in terms:
+            tokens = tokenize(term)
+            if not tokens:
+                continue
+
+            node = 0
+            for token in tokens:
+                token_id = vocab.setdefault(token, len(vocab))
+                child = goto[node].get(token_id)
+                if child is None:
+                    child = len(goto)
+                    goto[node][token_id] = child
+                    goto.append({})
+                    depth.append(depth[node] + 1)
+                    outputs.append(None)
+                node = child
+
+            # Terms that tokenize the same may belong to more than one UID
+            if outputs[node] is None:
+                outputs[node] = (uid,)
+            elif uid not in outputs[node]:
+                outputs[node] = outputs[node] + (uid,)
+
+    fail = [0] * len(goto)
+    dict_link = [0] * len(goto)
+    queue = deque(goto[0].values())
+    while queue:
+        node = queue.popleft()
+        for token_id, child in goto[node].items():
+            state = fail[node]
+            while state and token_id not in goto[state]:
+                state = fail[state]
+            target = goto[state].get(token_id, 0)
+            fail[child] = target
+            dict_link[child] = fail[child] if outputs[fail[child]] else dict_link[fail[child]]
+            queue.append(child)
+
+    return {"vocab": vocab, "goto": goto, "fail": fail, "depth": depth,
+            "outputs": outputs, "dict_link": dict_link}
+
+def file_signature(path):
+    stat = os.stat(path)
+    return [os.path.abspath(path), stat.st_size, stat.st_mtime, cache_version]
+
+def load_tagger(descriptor_file, cache_path=None):
+    ''' Loads a tagger from its cache, building the cache first if it doesn't
+        exist or was built from a different descriptor file
+    params
+        descriptor_file - the MeSH descriptor XML
+        cache_path - where to keep the automaton, next to the descriptor
+            file by default
+    returns
+        a MeshTagger
+    '''
+    logger = logging.getLogger(__name__)
+    cache_path = cache_path or f"{descriptor_file}.tagger.pkl"
+    signature = file_signature(descriptor_file)
+
+    if os.path.exists(cache_path):
+        with open(cache_path, "rb") as handle:
+            cached_signature = pickle.load(handle)
+        if cached_signature == signature:
+            logger.info(f"Using the MeSH tagger cache {cache_path}")
+            return MeshTagger(cache_path)
+        logger.info(f"The MeSH tagger cache {cache_path} is out of date, rebuilding it")
+
+    desc_data, _ = parse_mesh(descriptor_file, fields=("entry_terms",))
+    automaton = build_automaton(desc_data)
+    logger.info(f"Compiled {len(desc_data)} descriptors into {len(automaton['goto'])} " \
+                f"automaton states over {len(automaton['vocab'])} tokens")
+
+    # The signature is pickled first so it can be checked without loading
+    # the automaton
+    temp_path = f"{cache_path}.tmp"
+    with open(temp_path, "wb") as out:
+        pickle.dump(signature, out, protocol=pickle.HIGHEST_PROTOCOL)
+        pickle.dump(automaton, out, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(temp_path, cache_path)
+
+    loaded_automata[cache_path] = automaton
+
+    return MeshTagger(cache_path)
+
+class MeshTagger:
+    ''' Tags text with an automaton cached by load_tagger. Pickling a tagger
+        only pickles the cache path, so it can be handed to worker processes
+    params
+        cache_path - the cache file written by load_tagger
+    '''
+    def __init__(self, cache_path):
+        self.cache_path = cache_path
+        if cache_path not in loaded_automata:
+            with open(cache_path, "rb") as handle:
+                pickle.load(handle)
+                loaded_automata[cache_path] = pickle.load(handle)
+        automaton = loaded_automata[cache_path]
+
+        self.vocab = automaton["vocab"]
+        self.goto = automaton["goto"]
+        self.fail = automaton["fail"]
+        self.depth = automaton["depth"]
+        self.outputs = automaton["outputs"]
+        self.dict_link = automaton["dict_link"]
+
+    def __getstate__(self):
+        return self.cache_path
+
+    def __setstate__(self, cache_path):
+        self.__init__(cache_path)
+
+    def find_matches(self, text):
+        ''' Finds every term in text
+        returns
+            a list of (start_token, length, node) tuples, ordered by end
+        '''
+        vocab = self.vocab
+        goto = self.goto
+        fail = self.fail
+        depth = self.depth
+        outputs = self.outputs
+        dict_link = self.dict_link
+
+        matches = []
+        state = 0
+        for position, token in enumerate(tokenize(text)):
+            token_id = vocab.get(token)
+            if token_id is None:
+                # No term contains the token
+                state = 0
+                continue
+
+            while state and token_id not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(token_id, 0)
+
+            node = state if outputs[state] else dict_link[state]
+            while node:
+                matches.append((position - depth[node] + 1, depth[node], node))
+                node = dict_link[node]
+
+        return matches
+
+    def tag(self, text):
+        ''' Counts descriptor mentions in text, keeping the leftmost and then
+            longest of overlapping matches
+        returns
+            a Counter of descriptor UID to mention count
+        '''
+        counts = Counter()
+        end = 0
+        for start, length, node in sorted(self.find_matches(text), key=lambda m: (m[0], -m[1])):
+            if start < end:
+                continue
+            end = start + length
+            counts.update(self.outputs[node])
+
+        return counts
+
+def format_counts(doc_id, counts):
+    ''' returns the TSV lines, doc_id, UID and count, for one document '''
+    return "".join([f"{doc_id}\t{uid}\t{count}\n" for uid, count in sorted(counts.items())])
+
+def main():
+    # Get command line args
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-m", "--mesh", help="Pubmed's MeSH descriptor data in XML format",
+                    required=True, type=str)
+    parser.add_argument("-c", "--cache", help="Path of the tagger cache, {mesh}.tagger.pkl " \
+                    "by default", type=str)
+    parser.add_argument("-i", "--input", help="Text or pmc_parser JSON files to tag, " \
+                    "the cache is only built if not given", nargs="*", default=[])
+    parser.add_argument("-o", "--output", help="Path to write a TSV of file name, UID and " \
+                    "count to, STDOUT by default", type=str)
+    parser.add_argument("-q", "--quiet", help="Suppress printing of log messages to STDOUT. " \
+                    "Warning: exceptions will not be printed to console", action="store_true")
+    args = parser.parse_args()
+
+    # Set up logging
+    logger = logging.getLogger(__name__)
+    logger.setLevel(logging.INFO)
+    handler = logging.FileHandler("mesh_tagger.log")
+    formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+    handler.setFormatter(formatter)
+    logger.addHandler(handler)
+
+    if not args.quiet:
+        handler = logging.StreamHandler(sys.stderr if args.input and not args.output else sys.stdout)
+        handler.setLevel(logging.INFO)
+        formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+        handler.setFormatter(formatter)
+        logger.addHandler(handler)
+
+    tagger = load_tagger(args.mesh, args.cache)
+    if not args.input:
+        return
+
+    out = open_file(args.output, "w") if args.output else sys.stdout
+    try:
+        for path in args.input:
+            doc_id = os.path.basename(path).split(".")[0]
+            out.write(format_counts(doc_id, tagger.tag(read_text(path))))
+    finally:
+        if args.output:
+            out.close()
+
+if __name__ == "__main__":
+    main()
@@ -113,7 +113,7 @@ if __name__ == "__main__":
     args = get_args()
     logger = initialize_logger()
     
-    (desc_data, desc_uis) = parse_mesh(args.mesh)
+    (desc_data, desc_uis) = parse_mesh(args.mesh, fields=("graph_positions",))
     adj_list = get_mesh_graph(desc_data)
 
 
@@ -0,0 +1,231 @@
+#!/usr/bin/env python3
+import os
+import sys
+import json
+import logging
+import argparse
+from array import array
+
+import numpy as np
+from scipy import sparse
+
+from citation_graph import CitationGraph
+from citation_features import adjacency_matrices, product_blocks
+from compressed_io import open_file
+
+'''
+Joins the citation network with the MeSH terms of each article. With A the
+citation adjacency matrix of a graph store written by citation_graph.py and D
+a binary doc-term matrix aligned to the same nodes:
+    cited_terms = A @ D - for each article, the number of the articles it
+        cites that are indexed with each term
+    citing_terms = A^T @ D - the same for the articles that cite it
+Both are written as CSR arrays with a row for each graph node, in node order,
+and are computed a block of rows at a time so neither product has to be held
+in memory at once
+'''
+
+class NpyAppender:
+    ''' Writes a 1-d .npy file whose length isn't known in advance. A header
+        for an empty array is written first and rewritten with the final
+        length on close, the header is padded to the same size either way
+    params
+        path - the .npy path
+        dtype - the numpy dtype of the array
+    '''
+    def __init__(self, path, dtype):
+        self.dtype = np.dtype(dtype)
+        self.length = 0
+        self.handle = open(path, "wb")
+        self.header_size = self._write_header()
+
+    def _write_header(self):
+        self.handle.seek(0)
+        header = {"descr": np.lib.format.dtype_to_descr(self.dtype),
+                    "fortran_order": False, "shape": (self.length,)}
+        np.lib.format.write_array_header_1_0(self.handle, header)
+        return self.handle.tell()
+
+    def append(self, values):
+        values = np.ascontiguousarray(values, dtype=self.dtype)
+        values.tofile(self.handle)
+        self.length += len(values)
+
+    def close(self):
+        end = self.handle.tell()
+        if self._write_header() != self.header_size:
+            raise ValueError("npy header changed size")
+        self.handle.seek(end)
+        self.handle.close()
+
+def doc_term_matrix(doc_term_path, nodes, lines_per_chunk=1000000):
+    ''' Builds a binary doc-term matrix aligned to graph nodes from the
+        doc/term file written by term_co-occurrence.count_doc_terms. Articles
+        that aren't in the graph are skipped
+    params
+        doc_term_path - path to the doc/term file (pmid,year,term,term,...)
+        nodes - the sorted PMID array of a graph store
+        lines_per_chunk - the number of lines mapped to nodes at a time
+    returns
+        a tuple (doc_terms, terms) where doc_terms is a CSR matrix with a row
+        for each node and terms is the list of UIDs giving its column order
+    '''
+    logger = logging.getLogger(__name__)
+
+    term_index = {}
+    row_chunks = []
+    col_chunks = []
+
+    pmids = array("q")
+    lengths = array("q")
+    chunk_cols = array("I")
+
+    def map_chunk():
+        ids = np.searchsorted(nodes, np.frombuffer(pmids, dtype=np.int64))
+        found = ids < len(nodes)
+        found[found] = nodes[ids[found]] == np.frombuffer(pmids, dtype=np.int64)[found]
+        counts = np.frombuffer(lengths, dtype=np.int64)
+        keep = np.repeat(found, counts)
+        row_chunks.append(np.repeat(ids, counts)[keep])
+        col_chunks.append(np.frombuffer(chunk_cols, dtype=np.uint32)[keep])
+
+    doc_count = 0
+    with open_file(doc_term_path, "r") as handle:
+        for line in handle:
+            fields = line.rstrip("\n").split(",")
+            if not fields[0].isdigit():
+                continue
+            terms = [term for term in fields[2:] if term]
+            pmids.append(int(fields[0]))
+            lengths.append(len(terms))
+            for term in terms:
+                chunk_cols.append(term_index.setdefault(term, len(term_index)))
+            doc_count += 1
+
+            if len(pmids) >= lines_per_chunk:
+                map_chunk()
+                pmids, lengths, chunk_cols = array("q"), array("q"), array("I")
+
+    if pmids:
+        map_chunk()
+
+    rows = np.concatenate(row_chunks) if row_chunks else np.zeros(0, dtype=np.int64)
+    cols = np.concatenate(col_chunks) if col_chunks else np.zeros(0, dtype=np.uint32)
+    matrix = sparse.csr_matrix((np.ones(len(rows), dtype=np.int32), (rows, cols)),
+                                shape=(len(nodes), len(term_index)))
+    # Repeated terms or repeated articles would otherwise count twice
+    matrix.data[:] = 1
+
+    logger.info(f"Read {doc_count} articles, {matrix.getnnz(axis=1).astype(bool).sum()} " \
+                f"of them in the graph, with {len(term_index)} terms")
+
+    return (matrix, list(term_index))
+
+def write_product(left, right, out_dir, name, max_entries=50000000):
+    ''' Writes left @ right as {name}_indptr.npy, {name}_indices.npy and
+        {name}_data.npy, one block of rows at a time
+    returns
+        the number of nonzero entries written
+    '''
+    indptr = np.zeros(left.shape[0] + 1, dtype=np.int64)
+    indices = NpyAppender(os.path.join(out_dir, f"{name}_indices.npy"), np.int32)
+    data = NpyAppender(os.path.join(out_dir, f"{name}_data.npy"), np.int32)
+
+    for start, end in product_blocks(left, right, max_entries):
+        block = (left[start:end] @ right).tocsr()
+        block.sort_indices()
+        indptr[start + 1:end + 1] = block.indptr[1:] + indptr[start]
+        indices.append(block.indices)
+        data.append(block.data)
+
+    indices.close()
+    data.close()
+    np.save(os.path.join(out_dir, f"{name}_indptr.npy"), indptr)
+
+    return int(indptr[-1])
+
+def build_neighbour_terms(graph, doc_term_path, out_dir, max_entries=50000000):
+    ''' Writes the cited_terms and citing_terms matrices for a graph store
+        along with terms.txt, giving the column order, and pmids.npy, giving
+        the PMID of each row
+    params
+        graph - a CitationGraph
+        doc_term_path - path to the doc/term file written by count_doc_terms
+        out_dir - directory to write to, created if needed
+        max_entries - the product size budget for each block of rows
+    '''
+    logger = logging.getLogger(__name__)
+    os.makedirs(out_dir, exist_ok=True)
+
+    doc_terms, terms = doc_term_matrix(doc_term_path, np.asarray(graph.nodes))
+    a, a_t = adjacency_matrices(graph)
+
+    cited = write_product(a, doc_terms, out_dir, "cited_terms", max_entries)
+    logger.info(f"Wrote {cited} cited article term counts")
+    citing = write_product(a_t, doc_terms, out_dir, "citing_terms", max_entries)
+    logger.info(f"Wrote {citing} citing article term counts")
+
+    np.save(os.path.join(out_dir, "pmids.npy"), np.asarray(graph.nodes))
+    with open(os.path.join(out_dir, "terms.txt"), "w") as out:
+        for term in terms:
+            out.write(f"{term}\n")
+    with open(os.path.join(out_dir, "meta.json"), "w") as out:
+        json.dump({"num_nodes": len(graph.nodes), "num_terms": len(terms),
+                    "cited_terms_nnz": cited, "citing_terms_nnz": citing}, out)
+
+def load_neighbour_terms(out_dir, name="cited_terms"):
+    ''' Loads a matrix written by build_neighbour_terms, memory-mapped
+    params
+        out_dir - the directory written by build_neighbour_terms
+        name - 'cited_terms' or 'citing_terms'
+    returns
+        a tuple (matrix, pmids, terms) where matrix is a CSR matrix with a
+        row for each PMID in pmids and a column for each UID in terms
+    '''
+    def load(array_name):
+        return np.load(os.path.join(out_dir, f"{array_name}.npy"), mmap_mode="r")
+
+    pmids = load("pmids")
+    with open(os.path.join(out_dir, "terms.txt"), "r") as handle:
+        terms = [line.strip("\n") for line in handle]
+
+    matrix = sparse.csr_matrix((load(f"{name}_data"), load(f"{name}_indices"),
+                                load(f"{name}_indptr")), shape=(len(pmids), len(terms)))
+
+    return (matrix, pmids, terms)
+
+def main():
+    # Get command line args
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-g", "--graph", help="A graph store directory written by " \
+                    "citation_graph.py", required=True, type=str)
+    parser.add_argument("-d", "--doc-terms", help="The doc/term file written by " \
+                    "term_co-occurrence.py (pm_bulk_doc_term_counts.csv)", required=True, type=str)
+    parser.add_argument("-o", "--output", help="Directory to write the term count matrices to",
+                    required=True, type=str)
+    parser.add_argument("-b", "--block-entries", help="The number of intermediate products " \
+                    "computed at a time, bounds memory use", type=int, default=50000000)
+    parser.add_argument("-q", "--quiet", help="Suppress printing of log messages to STDOUT. " \
+                    "Warning: exceptions will not be printed to console", action="store_true")
+    args = parser.parse_args()
+
+    # Set up logging
+    logger = logging.getLogger(__name__)
+    logger.setLevel(logging.INFO)
+    handler = logging.FileHandler("neighbour_terms.log")
+    formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+    handler.setFormatter(formatter)
+    logger.addHandler(handler)
+
+    if not args.quiet:
+        handler = logging.StreamHandler(sys.stdout)
+        handler.setLevel(logging.INFO)
+        formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+        handler.setFormatter(formatter)
+        logger.addHandler(handler)
+
+    graph = CitationGraph(args.graph)
+    build_neighbour_terms(graph, args.doc_terms, args.output, args.block_entries)
+
+if __name__ == "__main__":
+    main()
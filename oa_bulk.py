@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+import io
+import os
+import queue
+import logging
+import tarfile
+import traceback
+from pathlib import Path
+from multiprocessing import Process, Queue
+
+archive_extensions = (".tar.gz", ".tgz", ".tar")
+member_extensions = (".xml", ".nxml")
+
+# Seconds to wait for a batch before checking whether the workers are alive
+result_timeout = 5
+
+def is_archive(path):
+    ''' Checks if a path looks like a tar archive, like the PMC oa_bulk
+        .tar.gz files
+    '''
+    return str(path).endswith(archive_extensions)
+
+def get_archive_list(path):
+    ''' Gets the archives to read from an input path
+    params
+        path - a tar archive or a directory that may contain archives at its
+            top level
+    returns
+        a list of absolute paths to archives, empty if there are none
+    '''
+    if os.path.isfile(path):
+        return [str(Path(path).resolve())] if is_archive(path) else []
+
+    absolute_path = Path(path).resolve()
+    archives = [os.path.join(absolute_path, f) for f in sorted(os.listdir(path))]
+
+    return [fp for fp in archives if is_archive(fp) and os.path.isfile(fp)]
+
+def iter_archive(archive_path):
+    ''' Streams the XML members of a tar archive without extracting them to
+        disk. The archive is read front to back in a single pass
+    params
+        archive_path - path to a .tar.gz, .tgz or .tar file
+    returns
+        yields tuples (member_name, data) where data is the member's
+        contents as bytes
+    '''
+    with tarfile.open(archive_path, "r|*") as tar:
+        for member in tar:
+            if member.isfile() and member.name.endswith(member_extensions):
+                # Stream mode archives can't be seeked, so each member is read
+                # whole rather than wrapped in a file handle
+                yield (member.name, tar.extractfile(member).read())
+
+def read_archive(archive_path, member_function):
+    ''' Applies member_function to every XML member of an archive, errors
+        for a member are caught so that the rest of the archive is still read
+    params
+        archive_path - path to the archive
+        member_function - a function taking (member_name, handle) where
+            handle is a text mode handle for the member
+    returns
+        yields tuples (member_name, result, error) where error is None or a
+        tuple (repr, traceback)
+    '''
+    try:
+        for member_name, data in iter_archive(archive_path):
+            try:
+                handle = io.StringIO(data.decode("utf-8"))
+                result = (member_name, member_function(member_name, handle), None)
+            except Exception as e:
+                result = (member_name, None, (repr(e), traceback.format_exc()))
+            yield result
+    except Exception as e:
+        # A truncated or corrupt archive ends the archive, not the run
+        yield (archive_path, None, (repr(e), traceback.format_exc()))
+
+def archive_worker(work_queue, result_queue, member_function, batch_size):
+    ''' A multiprocessing worker. Pulls archive paths from the work queue and
+        puts the results for their members on the result queue in batches.
+        Puts None on the result queue once it pulls None from the work queue
+    params
+        work_queue - a queue of archive paths
+        result_queue - a queue to put lists of (member_name, result, error)
+            tuples in
+        member_function - a function taking (member_name, handle)
+        batch_size - the number of members per batch
+    '''
+    batch = []
+
+    while True:
+        archive_path = work_queue.get()
+        if archive_path is None:
+            break
+        for result in read_archive(archive_path, member_function):
+            batch.append(result)
+            if len(batch) >= batch_size:
+                result_queue.put(batch)
+                batch = []
+
+    if batch:
+        result_queue.put(batch)
+    result_queue.put(None)
+
+def archive_generator(archives, member_function, workers=1, batch_size=256):
+    ''' Applies member_function to every XML member of every archive. With
+        more than one worker, archives are read in parallel, one archive per
+        worker process at a time, and results arrive in no particular order
+        across archives
+    params
+        archives - a list of archive paths
+        member_function - a function taking (member_name, handle), must be
+            picklable (defined at the top level of a module)
+        workers - the number of archives to read at once
+        batch_size - the number of member results sent back at a time
+    returns
+        yields tuples (member_name, result, error) where error is None or
+        a tuple (repr, traceback)
+    '''
+    logger = logging.getLogger(__name__)
+    workers = max(min(workers, len(archives)), 1)
+
+    if workers == 1:
+        for archive_path in archives:
+            for result in read_archive(archive_path, member_function):
+                yield result
+        return
+
+    work_queue = Queue()
+    result_queue = Queue(maxsize=workers * 4)
+
+    for archive_path in archives:
+        work_queue.put(archive_path)
+    for _ in range(workers):
+        work_queue.put(None)
+
+    processes = [Process(target=archive_worker, args=(work_queue, result_queue,
+                member_function, batch_size)) for _ in range(workers)]
+    for process in processes:
+        process.daemon = True
+        process.start()
+
+    try:
+        finished = 0
+        dead = set()
+        while finished < workers:
+            try:
+                batch = result_queue.get(timeout=result_timeout)
+            except queue.Empty:
+                # A worker that was killed never puts its None, so it is
+                # counted as finished once it is seen to have exited
+                for num, process in enumerate(processes):
+                    if num not in dead and not process.is_alive() and process.exitcode != 0:
+                        dead.add(num)
+                        finished += 1
+                        logger.error(f"Archive worker {process.pid} exited with code " \
+                                        f"{process.exitcode}, the rest of the archive it was " \
+                                        "reading is skipped")
+                continue
+            if batch is None:
+                finished += 1
+                continue
+            for result in batch:
+                yield result
+    finally:
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+            process.join()
@@ -1,94 +1,376 @@
 #!/usr/bin/env python3
 
+import io
+import os
 import re
 import argparse
 import logging
+from functools import partial
+from multiprocessing import Pool
 
-def parse_mesh(descriptor_file):
-    allow_permuted_terms = False
+from compressed_io import open_file, detect_compression
+
+'''
+Parses the MeSH descriptor (desc20XX.xml) and supplementary concept record
+(supp20XX.xml) files. Callers name the fields they need, and the subtrees
+holding other fields are skipped over without being matched. Records are
+dicts of "|" delimited strings keyed by UID, with the name always included.
+Descriptor fields are:
+    graph_positions - the tree numbers
+    entry_terms - the non-permuted terms of every concept, other than the name
+    qualifiers - the allowable qualifier UIDs
+    pharm_actions - the descriptor UIDs of the pharmacological actions
+and supplementary record fields are:
+    mapped_to - the UIDs of the descriptors the record's headings map to,
+        without the "*" marking major headings
+    pharm_actions and entry_terms, as for descriptors
+'''
+
+desc_fields = ("graph_positions", "entry_terms", "qualifiers", "pharm_actions")
+default_desc_fields = ("graph_positions", "entry_terms")
+supp_fields = ("mapped_to", "pharm_actions", "entry_terms")
+
+# Records start at the beginning of a line, which is what the parsers match
+desc_record_start = b"\n<DescriptorRecord "
+supp_record_start = b"\n<SupplementalRecord "
+
+desc_name_tag = re.compile(r"\s+</DescriptorName>")
+desc_ui = re.compile(r"<DescriptorUI>(D\d+)</DescriptorUI")
+supp_ui = re.compile(r"<SupplementalRecordUI>(C\d+)</SupplementalRecordUI")
+record_name = re.compile(r"<String>(.+)</String>")
+tree_num = re.compile(r"<TreeNumber>(.+)</TreeNumber")
+qualifier_ui = re.compile(r"<QualifierUI>(Q\d+)</QualifierUI")
+# Mapped headings mark major topics with a * before the UID
+referred_desc_ui = re.compile(r"<DescriptorUI>\*?(D\d+)</DescriptorUI")
+
+term_entry_start = re.compile(r"\s*<Term\s+")
+term_entry_end = re.compile(r"\s*</Term>")
+term_string = re.compile(r"\s*<String>(.*)</String")
+term_permute_status = re.compile(r'\s*<Term.*IsPermutedTermYN="([YN])".*')
+
+def check_fields(fields, valid_fields):
+    unknown = set(fields).difference(valid_fields)
+    if unknown:
+        raise ValueError(f"Unknown MeSH fields: {sorted(unknown)}")
+
+def read_list(handle, line, end_tag, value_regex):
+    ''' Reads the values matched by value_regex up to the line holding end_tag
+    returns
+        a tuple (values, line) where line is the one holding end_tag
+    '''
+    values = []
+    while line and end_tag not in line:
+        if "UI>" in line:
+            match = value_regex.search(line)
+            if match:
+                values.append(match.group(1))
+        line = handle.readline()
+
+    return (values, line)
+
+def skip_to(handle, line, end_tag):
+    ''' returns the line holding end_tag, without matching the ones before '''
+    while line and end_tag not in line:
+        line = handle.readline()
+
+    return line
+
+def read_entry_terms(handle, line, allow_permuted_terms=False):
+    ''' Reads the terms of a ConceptList, starting from its opening line
+    returns
+        a tuple (entry_terms, line) where line is the list's closing line
+    '''
+    entry_terms = []
+    while line and "</ConceptList" not in line:
+        if term_entry_start.search(line):
+            permute_agreement = False
+
+            permute_status_search = term_permute_status.search(line)
+            if permute_status_search:
+                permute_status = permute_status_search.group(1)
+                if allow_permuted_terms or permute_status == "N":
+                    permute_agreement = True
+
+            while line and not term_entry_end.search(line):
+                if permute_agreement:
+                    term_string_match = term_string.search(line)
+                    if term_string_match:
+                        entry_terms.append(term_string_match.group(1))
+                line = handle.readline()
+        line = handle.readline()
+
+    return (entry_terms, line)
+
+def read_header(handle, line, name_end):
+    ''' Reads a record's lines up to the end of its name
+    returns
+        a tuple (header, line) where header is the lines joined
+    '''
+    header = []
+    while line and not name_end(line):
+        header.append(line.strip("\n"))
+        line = handle.readline()
+
+    return ("".join(header), line)
+
+def parse_descriptors(handle, fields=default_desc_fields):
+    ''' Parses the DescriptorRecords read from a text mode handle, which may
+        hold the whole descriptor file or a range of whole records from it
+    returns
+        a tuple (desc_data, desc_uis), see parse_mesh
+    '''
+    want_trees = "graph_positions" in fields
+    want_terms = "entry_terms" in fields
+    want_qualifiers = "qualifiers" in fields
+    want_pharm = "pharm_actions" in fields
+
+    def name_end(line):
+        return desc_name_tag.search(line) or line.startswith("</DescriptorRecord")
 
     desc_data = {}
     desc_uis = []
 
-    desc_name_tag = re.compile(r"\s+</DescriptorName>")
-    desc_rec_end_tag = re.compile(r"\s*</DescriptorRecord>")
-
-    desc_ui = re.compile(r"<DescriptorUI>(D\d+)</DescriptorUI")
-    desc_name = re.compile(r"<String>(.+)</String>")
-    tree_num = re.compile(r"<TreeNumber>(.+)</TreeNumber")
-    
-    concept_list_start = re.compile(r"\s*<ConceptList")
-    concept_list_end = re.compile(r"\s*</ConceptList")
-    
-    term_entry_start = re.compile(r"\s*<Term\s+")
-    term_entry_end = re.compile(r"\s*</Term>")
-    term_string = re.compile(r"\s*<String>(.*)</String")
-    term_permute_status = re.compile(r'\s*<Term.*IsPermutedTermYN="([YN])".*')
-
-    with open(descriptor_file, "r") as handle:
-        line = handle.readline()
-        while line:
-            if line.startswith("<DescriptorRecord "):
-                tree_nums = []
-                entry_terms = []
-                relevant_lines = []
-
-                while not desc_name_tag.search(line) and not line.startswith("</DescriptorRecord"):
-                    relevant_lines.append(line.strip("\n"))
-                    line = handle.readline()
-
-                relevant_lines = "".join(relevant_lines)
-
-                ui_match = desc_ui.search(relevant_lines)
-                name_match = desc_name.search(relevant_lines)
-                
-                while not desc_rec_end_tag.search(line):
-                    tree_match = tree_num.search(line)
-                    if tree_match:
-                        tree_nums.append(tree_match.group(1))
-                    
-                    if concept_list_start.search(line):
-                        while not concept_list_end.search(line):
-                            if term_entry_start.search(line):
-                                permute_status = None
-                                permute_agreement = False
-
-                                if not permute_status:
-                                    permute_status_search = term_permute_status.search(line)
-                                    if permute_status_search:
-                                        permute_status = permute_status_search.group(1)
-                                        
-                                        if allow_permuted_terms == False:
-                                            if permute_status == "N":
-                                                permute_agreement = True
-                                        else:
-                                            permute_agreement = True
-
-                                while not term_entry_end.search(line):
-                                    term_string_match = term_string.search(line)
-                                    if term_string_match and permute_agreement:
-                                        entry_terms.append(term_string_match.group(1))
-                                    line = handle.readline()
-                            line = handle.readline()
-                    line = handle.readline()
-                    
-                if ui_match and name_match:
+    line = handle.readline()
+    while line:
+        if line.startswith("<DescriptorRecord "):
+            tree_nums = []
+            entry_terms = []
+            qualifiers = []
+            pharm_actions = []
+
+            header, line = read_header(handle, line, name_end)
+            ui_match = desc_ui.search(header)
+            name_match = record_name.search(header)
+
+            while line and "</DescriptorRecord>" not in line:
+                if "<TreeNumber>" in line:
+                    if want_trees:
+                        tree_match = tree_num.search(line)
+                        if tree_match:
+                            tree_nums.append(tree_match.group(1))
+                elif "<ConceptList" in line:
+                    if want_terms:
+                        entry_terms, line = read_entry_terms(handle, line)
+                    else:
+                        line = skip_to(handle, line, "</ConceptList")
+                elif "<AllowableQualifiersList" in line:
+                    if want_qualifiers:
+                        qualifiers, line = read_list(handle, line,
+                                            "</AllowableQualifiersList", qualifier_ui)
+                    else:
+                        line = skip_to(handle, line, "</AllowableQualifiersList")
+                elif "<PharmacologicalActionList" in line:
+                    if want_pharm:
+                        pharm_actions, line = read_list(handle, line,
+                                            "</PharmacologicalActionList", desc_ui)
+                    else:
+                        line = skip_to(handle, line, "</PharmacologicalActionList")
+                line = handle.readline()
+
+            if ui_match and name_match:
+                record = {"name": name_match.group(1)}
+                if want_trees:
+                    record["graph_positions"] = "|".join(tree_nums)
+                if want_terms:
                     entry_terms = [t for t in entry_terms if t != name_match.group(1)]
-                    desc_data[ui_match.group(1)] = {"name": name_match.group(1),
-                                                    "graph_positions": "|".join(tree_nums),
-                                                    "entry_terms": "|".join(entry_terms)}
-                    desc_uis.append(ui_match.group(1))
+                    record["entry_terms"] = "|".join(entry_terms)
+                if want_qualifiers:
+                    record["qualifiers"] = "|".join(qualifiers)
+                if want_pharm:
+                    record["pharm_actions"] = "|".join(pharm_actions)
+                desc_data[ui_match.group(1)] = record
+                desc_uis.append(ui_match.group(1))
 
-            line = handle.readline()
+        line = handle.readline()
 
     return (desc_data, desc_uis)
 
+def parse_supplementals(handle, fields=supp_fields):
+    ''' Parses the SupplementalRecords read from a text mode handle, which may
+        hold the whole supplementary record file or a range of whole records
+    returns
+        a tuple (supp_data, supp_uis), see parse_supp
+    '''
+    want_mapped = "mapped_to" in fields
+    want_pharm = "pharm_actions" in fields
+    want_terms = "entry_terms" in fields
+
+    def name_end(line):
+        return "</SupplementalRecordName>" in line or line.startswith("</SupplementalRecord>")
+
+    supp_data = {}
+    supp_uis = []
+
+    line = handle.readline()
+    while line:
+        if line.startswith("<SupplementalRecord "):
+            mapped_to = []
+            pharm_actions = []
+            entry_terms = []
+
+            header, line = read_header(handle, line, name_end)
+            ui_match = supp_ui.search(header)
+            name_match = record_name.search(header)
+
+            while line and "</SupplementalRecord>" not in line:
+                if "<HeadingMappedToList" in line:
+                    if want_mapped:
+                        mapped_to, line = read_list(handle, line, "</HeadingMappedToList",
+                                                    referred_desc_ui)
+                    else:
+                        line = skip_to(handle, line, "</HeadingMappedToList")
+                elif "<PharmacologicalActionList" in line:
+                    if want_pharm:
+                        pharm_actions, line = read_list(handle, line,
+                                            "</PharmacologicalActionList", desc_ui)
+                    else:
+                        line = skip_to(handle, line, "</PharmacologicalActionList")
+                elif "<ConceptList" in line:
+                    if want_terms:
+                        entry_terms, line = read_entry_terms(handle, line)
+                    else:
+                        line = skip_to(handle, line, "</ConceptList")
+                line = handle.readline()
+
+            if ui_match and name_match:
+                record = {"name": name_match.group(1)}
+                if want_mapped:
+                    record["mapped_to"] = "|".join(mapped_to)
+                if want_pharm:
+                    record["pharm_actions"] = "|".join(pharm_actions)
+                if want_terms:
+                    entry_terms = [t for t in entry_terms if t != name_match.group(1)]
+                    record["entry_terms"] = "|".join(entry_terms)
+                supp_data[ui_match.group(1)] = record
+                supp_uis.append(ui_match.group(1))
+
+        line = handle.readline()
+
+    return (supp_data, supp_uis)
+
+def find_record_start(handle, offset, record_start=desc_record_start):
+    ''' returns the offset of the first record starting after offset, or None
+        if there isn't one
+    '''
+    block_size = 2**20
+    # The newline before a record at offset itself is at offset - 1
+    position = max(offset - 1, 0)
+    handle.seek(position)
+    tail = b""
+    while True:
+        block = handle.read(block_size)
+        if not block:
+            return None
+        data = tail + block
+        found = data.find(record_start)
+        if found != -1:
+            return position - len(tail) + found + 1
+        # Keep enough of the block to match a record_start split across blocks
+        tail = data[-(len(record_start) - 1):]
+        position += len(block)
+
+def get_record_ranges(mesh_file, num_ranges, record_start=desc_record_start):
+    ''' Splits an uncompressed MeSH file into byte ranges of about equal size
+        that each start at a record, apart from the first, which starts at
+        the beginning of the file
+    returns
+        a list of (start, end) byte offsets in file order
+    '''
+    size = os.path.getsize(mesh_file)
+    starts = [0]
+    with open(mesh_file, "rb") as handle:
+        for i in range(1, num_ranges):
+            start = find_record_start(handle, max(size * i // num_ranges, starts[-1]),
+                                        record_start)
+            if start is None:
+                break
+            if start > starts[-1]:
+                starts.append(start)
+
+    return list(zip(starts, starts[1:] + [size]))
+
+def parse_range(mesh_file, parse_function, byte_range):
+    ''' A multiprocessing worker that parses the records in a byte range '''
+    start, end = byte_range
+    with open(mesh_file, "rb") as handle:
+        handle.seek(start)
+        data = handle.read(end - start)
+
+    # TextIOWrapper decodes the same way open(path, "r") does
+    return parse_function(io.TextIOWrapper(io.BytesIO(data)))
+
+def parse_records(mesh_file, parse_function, record_start, workers=1):
+    ''' Parses a MeSH file with parse_function, in parallel byte ranges of
+        whole records if workers > 1, see parse_mesh
+    '''
+    logger = logging.getLogger(__name__)
+
+    if workers > 1 and detect_compression(mesh_file) == "none":
+        # More ranges than workers evens out ranges that parse slowly
+        ranges = get_record_ranges(mesh_file, workers * 4, record_start)
+        if len(ranges) > 1:
+            logger.info(f"Parsing {mesh_file} in {len(ranges)} byte ranges with " \
+                        f"{workers} workers")
+            data = {}
+            uis = []
+            with Pool(workers) as pool:
+                for range_data, range_uis in pool.imap(partial(parse_range, mesh_file,
+                                                                parse_function), ranges):
+                    data.update(range_data)
+                    uis.extend(range_uis)
+
+            return (data, uis)
+
+    with open_file(mesh_file, "r") as handle:
+        return parse_function(handle)
+
+def parse_mesh(descriptor_file, workers=1, fields=default_desc_fields):
+    ''' Parses a MeSH descriptor XML file, such as desc2019.xml
+    params
+        descriptor_file - path to the file, which may be gzip or zstd
+            compressed
+        workers - the number of worker processes. The file is split into
+            byte ranges of whole records which are parsed in parallel and
+            merged in file order, so the result is the same as with one.
+            Compressed files can't be split and are always parsed serially
+        fields - the descriptor fields to extract, see the module docstring
+    returns
+        a tuple (desc_data, desc_uis) where desc_data is a dict of descriptor
+        UID to a dict of its "name" and the requested fields, and desc_uis
+        is the list of UIDs in file order
+    '''
+    check_fields(fields, desc_fields)
+    return parse_records(descriptor_file, partial(parse_descriptors, fields=tuple(fields)),
+                            desc_record_start, workers)
+
+def parse_supp(supp_file, workers=1, fields=supp_fields):
+    ''' Parses a MeSH supplementary concept record XML file, such as
+        supp2019.xml, see parse_mesh
+    returns
+        a tuple (supp_data, supp_uis) where supp_data is a dict of
+        supplementary record UID to a dict of its "name" and the requested
+        fields, and supp_uis is the list of UIDs in file order
+    '''
+    check_fields(fields, supp_fields)
+    return parse_records(supp_file, partial(parse_supplementals, fields=tuple(fields)),
+                            supp_record_start, workers)
+
 def main():
     # Get command line args
     parser = argparse.ArgumentParser()
-    parser.add_argument("-i", "--input", help="Pubmed's MeSH descriptor data in XML format", 
+    parser.add_argument("-i", "--input", help="Pubmed's MeSH descriptor data in XML format",
                     required=True, type=str)
     parser.add_argument("-o", "--output", help="Output file to write data in a tab-delimited format")
+    parser.add_argument("-s", "--supp", help="The input is a supplementary concept record " \
+                    "file (supp20XX.xml) rather than a descriptor file", action="store_true")
+    parser.add_argument("-f", "--fields", help="The fields to write after the UID and name, " \
+                    f"in order. Descriptor fields are {list(desc_fields)} and supplementary " \
+                    f"record fields are {list(supp_fields)}. By default entry terms and " \
+                    "graph positions for descriptors, and all fields for supplementary " \
+                    "records", nargs="+")
+    parser.add_argument("-w", "--workers", help="Number of worker processes to parse the " \
+                    "descriptor file with, compressed files are parsed by one", type=int,
+                    default=1)
     parser.add_argument("-q", "--quiet", help="Suppress printing of log messages to STDOUT. " \
                     "Warning: exceptions will not be printed to console", action="store_true")
     args = parser.parse_args()
@@ -100,20 +382,33 @@ def main():
     formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
     handler.setFormatter(formatter)
     logger.addHandler(handler)
-    
-    fields = ["name", "entry_terms", "graph_positions"]
-    
+
+    if args.supp:
+        fields = args.fields or list(supp_fields)
+        check = partial(check_fields, valid_fields=supp_fields)
+    else:
+        fields = args.fields or ["entry_terms", "graph_positions"]
+        check = partial(check_fields, valid_fields=desc_fields)
+    try:
+        check(fields)
+    except ValueError as e:
+        parser.error(str(e))
+
     # desc_uis keeps terms in the same order as the original file but
     # maybe this is not really necessary
-    (desc_data, desc_uis) = parse_mesh(args.input)
+    if args.supp:
+        (desc_data, desc_uis) = parse_supp(args.input, args.workers, fields)
+    else:
+        (desc_data, desc_uis) = parse_mesh(args.input, args.workers, fields)
+    fields = ["name"] + fields
 
     if args.output:
-        with open(args.output, "w") as out:
+        with open_file(args.output, "w") as out:
             for ui in desc_uis:
                 line = [ui]
                 for field in fields:
                     line.append(desc_data[ui][field])
-                
+
                 out.write("\t".join(line))
                 out.write("\n")
 
@@ -0,0 +1,318 @@
+#!/usr/bin/env python3
+import os
+import re
+import sys
+import logging
+import argparse
+import traceback
+from pathlib import Path
+from functools import partial
+from multiprocessing import Pool
+
+import pmc_parser
+from citation_network import ReferenceScanner
+from oa_bulk import get_archive_list, archive_generator
+from text_bundle import BundleWriter
+from compressed_io import open_file, codec_extensions, check_codec
+
+'''
+Extracts cleaned text, citation edges and article metadata from PMC XMLs in a
+single read of each file. pmc_parser's line loop drives the read, and every
+line it reads is also passed to the scanners that find the edges and the
+metadata, so the file is read and decoded once whichever sinks are used
+'''
+
+metadata_fields = ["pmid", "pmcid", "doi", "journal", "year", "article_type"]
+
+class MetadataScanner:
+    ''' Finds article IDs and basic metadata. Everything needed is in <front>,
+        so text is only kept until </front> is seen. Fed with feed() and the
+        result taken from close(), like ReferenceScanner
+    '''
+    patterns = {"pmid": re.compile(r'<article-id pub-id-type="pmid">\s*(\d+)\s*</article-id>'),
+                "pmcid": re.compile(r'<article-id pub-id-type="pmc(?:id)?">\s*(?:PMC)?(\d+)\s*</article-id>'),
+                "doi": re.compile(r'<article-id pub-id-type="doi">\s*([^<]*?)\s*</article-id>'),
+                "journal": re.compile(r'<journal-title>\s*([^<]*?)\s*</journal-title>'),
+                "journal_id": re.compile(r'<journal-id journal-id-type="nlm-ta">\s*([^<]*?)\s*</journal-id>'),
+                "year": re.compile(r'<pub-date[^>]*>.*?<year>\s*(\d{4})\s*</year>', re.S),
+                "article_type": re.compile(r'<article\s[^>]*?article-type="([^"]*)"')}
+
+    def __init__(self):
+        self.text = []
+        self.tail = ""
+        self.done = False
+
+    def feed(self, text):
+        if self.done:
+            return
+        self.text.append(text)
+        # The tag may be split across blocks
+        if "</front>" in self.tail + text[:8] or "</front>" in text:
+            self.done = True
+        self.tail = text[-8:]
+
+    def close(self):
+        ''' returns a dict with a value, or "", for each of metadata_fields '''
+        front = "".join(self.text)
+        end = front.find("</front>")
+        if end >= 0:
+            front = front[:end]
+        self.text = []
+
+        metadata = {}
+        for field, pattern in self.patterns.items():
+            match = pattern.search(front)
+            metadata[field] = pmc_parser.remove_codes(match.group(1)) if match else ""
+
+        if not metadata["journal"]:
+            metadata["journal"] = metadata["journal_id"]
+        del metadata["journal_id"]
+        if metadata["pmcid"]:
+            metadata["pmcid"] = f"PMC{metadata['pmcid']}"
+
+        return metadata
+
+class TeeReader:
+    ''' Wraps a text mode handle so that everything read through readline()
+        is also fed to a list of scanners. Lines are batched into blocks
+        before being fed, as the scanners work best on large blocks
+    params
+        handle - a text mode handle
+        scanners - objects with a feed(text) method
+        block_size - the number of characters fed at a time
+    '''
+    def __init__(self, handle, scanners, block_size=2**20):
+        self.handle = handle
+        self.scanners = scanners
+        self.block_size = block_size
+        self.pending = []
+        self.pending_size = 0
+
+    def readline(self):
+        line = self.handle.readline()
+        if line:
+            self.pending.append(line)
+            self.pending_size += len(line)
+            if self.pending_size >= self.block_size:
+                self._flush()
+        return line
+
+    def _flush(self):
+        if self.pending:
+            block = "".join(self.pending)
+            for scanner in self.scanners:
+                scanner.feed(block)
+            self.pending = []
+            self.pending_size = 0
+
+    def drain(self):
+        ''' Feeds everything not yet read through readline to the scanners '''
+        self._flush()
+        block = self.handle.read(self.block_size)
+        while block:
+            for scanner in self.scanners:
+                scanner.feed(block)
+            block = self.handle.read(self.block_size)
+
+def extract_handle(handle, text=True, edges=True, metadata=True, resolver=None, sections=None):
+    ''' Runs the requested extractors over one XML in one pass
+    params
+        handle - a text mode handle for a PMC XML
+        text - Boolean, clean the text sections with pmc_parser
+        edges - Boolean, find the citation edges
+        metadata - Boolean, find the article IDs and metadata
+        resolver - an id_index.IdResolver for the edges, or None
+        sections - the text sections to clean, pmc_parser's default if None
+    returns
+        a dict with the keys text, edges and metadata. text is a dict as from
+        pmc_parser.parse_xml, edges is a list of edge tuples as from
+        citation_network.get_edges, metadata is a dict of metadata_fields.
+        Each is None if it wasn't requested, edges is also None if the article
+        has no PMID or no reference list
+    '''
+    scanners = {}
+    if edges:
+        scanners["edges"] = ReferenceScanner(resolver)
+    if metadata:
+        scanners["metadata"] = MetadataScanner()
+
+    tee = TeeReader(handle, list(scanners.values()))
+    result = {"text": None, "edges": None, "metadata": None}
+
+    if text:
+        result["text"] = pmc_parser.parse_xml_handle(tee, sections)
+    # The scanners also need anything the parser didn't read
+    tee.drain()
+
+    if edges:
+        article_id, refs = scanners["edges"].close()
+        if article_id and refs is not None:
+            result["edges"] = [(article_id, ref) for ref in refs]
+    if metadata:
+        result["metadata"] = scanners["metadata"].close()
+
+    return result
+
+def extract_worker(xml_file, text=True, edges=True, metadata=True, resolver=None,
+        sections=None):
+    ''' A multiprocessing worker, see extract_handle
+    returns
+        a tuple (xml_file, result, error) where error is None or a tuple
+        (repr, traceback)
+    '''
+    try:
+        with open_file(xml_file, "r") as handle:
+            return (xml_file, extract_handle(handle, text, edges, metadata, resolver, sections),
+                    None)
+    except Exception as e:
+        return (xml_file, None, (repr(e), traceback.format_exc()))
+
+def extract_member(member_name, handle, text=True, edges=True, metadata=True, resolver=None,
+        sections=None):
+    ''' For use with oa_bulk.archive_generator '''
+    return extract_handle(handle, text, edges, metadata, resolver, sections)
+
+def extract_xmls(input_dir, text_dir=None, output_format="xml",
+        sections=["title", "abstract", "body"], edge_path=None, metadata_path=None,
+        workers=1, resolver=None, quiet=False, debug=False, shard_size=256, compression=None):
+    ''' Extracts from every XML in a directory, or in oa_bulk archives, to the
+        requested sinks. At least one sink should be given
+    params
+        input_dir - a directory of XMLs and/or archives, or a single archive
+        text_dir - directory to write cleaned text to, as pmc_parser does
+        output_format - the pmc_parser output format, 'xml', 'json', 'text' or
+            'bundle'
+        sections - the text sections to write
+        edge_path - path to write the comma-delimited edge list to
+        metadata_path - path to write a TSV of metadata_fields to, with the
+            file's PMC ID first
+        workers - the number of worker processes
+        resolver - an id_index.IdResolver for the edges, or None
+        quiet - Boolean, suppress logging to STDOUT
+        debug - Boolean, log at the DEBUG level
+        shard_size - the size in MB at which bundle shards are split
+        compression - 'none', 'gzip' or 'zstd' for the text files or bundle
+            shards. Bundles are gzipped and other formats left uncompressed
+            if None
+    '''
+    logger = pmc_parser.initialize_logger(debug, quiet)
+
+    sinks = {"text": text_dir is not None, "edges": edge_path is not None,
+                "metadata": metadata_path is not None}
+    if not any(sinks.values()):
+        raise ValueError("No output sinks were given")
+
+    bundle_writer = None
+    if sinks["text"]:
+        sections = pmc_parser.validate_sections(sections)
+        if output_format == "bundle":
+            bundle_writer = BundleWriter(text_dir, shard_size * 2**20, compression or "gzip")
+            output_function = pmc_parser.get_bundle_function(bundle_writer)
+        else:
+            check_codec(compression or "none")
+            output_function = pmc_parser.get_output_function(output_format,
+                                                                compression or "none")
+
+    logger.info(f"Starting extractor, input: {input_dir}, sinks: " \
+                f"{[sink for sink, used in sinks.items() if used]}")
+
+    edge_out = open_file(edge_path, "w") if sinks["edges"] else None
+    metadata_out = open_file(metadata_path, "w") if sinks["metadata"] else None
+    if metadata_out:
+        metadata_out.write("\t".join(["file"] + metadata_fields) + "\n")
+
+    edge_count = 0
+    doc_count = 0
+
+    def results():
+        input_files = pmc_parser.get_file_list(input_dir)
+        worker = partial(extract_worker, resolver=resolver, sections=sections, **sinks)
+        if workers == 1:
+            for result in map(worker, input_files):
+                yield result
+        else:
+            with Pool(workers) as pool:
+                for result in pool.imap(worker, input_files, 16):
+                    yield result
+
+        # Members of oa_bulk archives are streamed rather than extracted
+        archives = get_archive_list(input_dir)
+        member_function = partial(extract_member, resolver=resolver, sections=sections, **sinks)
+        for result in archive_generator(archives, member_function, workers):
+            yield result
+
+    try:
+        for name, result, error in results():
+            if error is not None:
+                logger.error(f"{name}: {error[0]}")
+                logger.critical(error[1])
+                continue
+
+            pmc_id = name.split("/")[-1].split(".")[0]
+            doc_count += 1
+
+            if sinks["text"]:
+                output_function(f"{text_dir}/{pmc_id}", result["text"])
+
+            if sinks["edges"] and result["edges"]:
+                edge_count += len(result["edges"])
+                edge_out.write("".join([f"{citing},{cited}\n" for citing, cited in result["edges"]]))
+
+            if sinks["metadata"]:
+                values = [result["metadata"][field] for field in metadata_fields]
+                # Tabs and newlines in titles would break the TSV
+                values = [" ".join(value.split()) for value in values]
+                metadata_out.write("\t".join([pmc_id] + values) + "\n")
+    finally:
+        if edge_out:
+            edge_out.close()
+        if metadata_out:
+            metadata_out.close()
+        if bundle_writer is not None:
+            bundle_writer.close()
+
+    logger.info(f"Extracted {doc_count} documents, {edge_count} edges")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-i", "--input", help="Directory containing PMC XML files, " \
+                        "oa_bulk .tar.gz archives, or both. May also be a single archive",
+                        required=True)
+    parser.add_argument("-t", "--text-dir", help="Directory to write cleaned text files to, " \
+                        "text is not extracted if not given")
+    parser.add_argument("-f", "--output-format", help="Output format of the text files, " \
+                        "'xml', 'json', or 'text'. 'bundle' writes JSON lines to size-bounded " \
+                        "shards with an index for lookup by PMC ID, see text_bundle.py",
+                        choices=["xml", "json", "text", "bundle"], default="xml")
+    parser.add_argument("-s", "--sections", help="Text sections to write, space delimited",
+                        nargs="*", default=["title", "abstract", "body"])
+    parser.add_argument("-e", "--edges", help="Path to write the citation edge list to, " \
+                        "edges are not extracted if not given")
+    parser.add_argument("-m", "--metadata", help="Path to write a TSV of article IDs and " \
+                        "metadata to, metadata is not extracted if not given")
+    parser.add_argument("-r", "--resolve", help="An ID index directory written by id_index.py, " \
+                        "used to resolve DOI and PMCID references for the edge list")
+    parser.add_argument("-w", "--workers", help="Number of worker processes",
+                        type=int, default=1)
+    parser.add_argument("-q", "--quiet", help="Suppress printing of log messages to STDOUT. " \
+                        "Warning: exceptions will not be printed to console",
+                        action="store_true", default=False)
+    parser.add_argument("-d", "--debug", help="Set log level to DEBUG", action="store_true",
+                        default=False)
+    parser.add_argument("--shard-size", help="The size in MB at which bundle shards are " \
+                        "split", type=int, default=256)
+    parser.add_argument("-c", "--compression", help="Compression of the text files or " \
+                        "bundle shards, 'none', 'gzip', or 'zstd' (requires the zstandard " \
+                        "package). Bundle shards are gzipped and other outputs left " \
+                        "uncompressed by default", choices=list(codec_extensions))
+
+    args = parser.parse_args()
+
+    resolver = None
+    if args.resolve:
+        from id_index import IdResolver
+        resolver = IdResolver(args.resolve)
+
+    extract_xmls(args.input, args.text_dir, args.output_format, args.sections, args.edges,
+                    args.metadata, args.workers, resolver, args.quiet, args.debug,
+                    args.shard_size, args.compression)
@@ -9,13 +9,23 @@ import logging
 import unicodedata
 import traceback
 from pathlib import Path
+from functools import lru_cache, partial
+from collections import deque
+from multiprocessing import Pool
+
+from oa_bulk import is_archive, get_archive_list, archive_generator
+from text_bundle import BundleWriter
+from mesh_tagger import load_tagger, format_counts
+from text_stats import NgramCounter, count_ngrams
+from compressed_io import open_file, codec_extensions, check_codec
 
 '''
 text_elements is a dict containing text elements like
-title, abstract, and body. Writes output in an XML-like format
+title, abstract, and body. Writes output in an XML-like format,
+compressed if compression is 'gzip' or 'zstd'
 '''
-def write_xml(fp, text_elements):
-    with open(f"{fp}.xml", "w") as out:
+def write_xml(fp, text_elements, compression="none"):
+    with open_file(f"{fp}.xml{codec_extensions[compression]}", "w", compression) as out:
         for element in text_elements.keys():
             out.write(f"<{element}>\n")
             out.write(text_elements[element])
@@ -23,60 +33,94 @@ def write_xml(fp, text_elements):
 
 '''
 text_elements is a dict containing text elements like 
-title, abstract, and body. Writes output in JSON
+title, abstract, and body. Writes output in JSON, compressed
+if compression is 'gzip' or 'zstd'
 '''
-def write_json(fp, text_elements):
-    with open(f"{fp}.json", "w") as out:
+def write_json(fp, text_elements, compression="none"):
+    with open_file(f"{fp}.json{codec_extensions[compression]}", "w", compression) as out:
         json.dump(text_elements, out)
 
 '''
 text_elements is a dict containing text elements like
 title, abstract, and body. Writes output in a plain text
-format
+format, compressed if compression is 'gzip' or 'zstd'
 '''
-def write_plain_text(fp, text_elements):
-    with open(f"{fp}.txt", "w") as out:
+def write_plain_text(fp, text_elements, compression="none"):
+    with open_file(f"{fp}.txt{codec_extensions[compression]}", "w", compression) as out:
         for element in text_elements.keys():
             out.write(f"{element.upper()}: {text_elements[element]}\n")
 
-'''
-Takes an HTML entity and attempts to parse it into a UTF-8 
-character
-'''
-def parse_entity(match_obj):
+entity_regex = re.compile(r"&[^;\s]*;")
+tag_regex = re.compile(r"<[^>]+>")
+sup_regex = re.compile(r"<sup[^<]*</sup>")
+
+# Titles and labels are matched without the whitespace before them, which is
+# stripped separately. A leading \s* stops the regex engine from searching for
+# the literal "<" and makes it try a match at every character instead.
+# Titles inside a label are removed before the label in the multi-pass
+# version, so a label may contain them
+body_title_regex = re.compile(r"<(?:title>[^<]*</title>|"
+                              r"label>[^<]*(?:<title>[^<]*</title>[^<]*)*</label>)")
+abstract_title_regex = re.compile(r"<title>[^<]*</title>")
+
+# Top level body sections are named by matching these against their sec-type
+# and title, a section titled "Results and Discussion" is in both
+body_sections = {"introduction": re.compile(r"\b(?:intro|introduction|background)\b"),
+                 "methods": re.compile(r"\b(?:methods?|methodology|materials)\b"),
+                 "results": re.compile(r"\bresults?\b"),
+                 "discussion": re.compile(r"\bdiscussion\b"),
+                 "conclusions": re.compile(r"\bconclusions?\b")}
+
+default_sections = ["title", "abstract", "body"]
+valid_sections = default_sections + ["figures"] + list(body_sections)
+
+sec_tag_regex = re.compile(r"<(/?)sec(\s[^>]*)?>")
+sec_type_regex = re.compile(r'sec-type="([^"]*)"')
+sec_title_regex = re.compile(r"<title>(.*?)</title>", re.S)
+fig_regex = re.compile(r"<fig[\s>].*?</fig>", re.S)
+caption_regex = re.compile(r"<caption>(.*?)</caption>", re.S)
+
+'''
+Takes an HTML entity and attempts to parse it into a UTF-8
+character. Articles repeat the same few entities many times, so
+conversions are cached
+'''
+@lru_cache(maxsize=4096)
+def decode_entity(entity):
     logger = logging.getLogger(__name__)
     symbol = ""
-    
-    if match_obj.group(0):
+
+    if entity:
         # try to convert
         try:
-            symbol = html.unescape(match_obj.group(0)).encode("utf-8").decode()
+            symbol = html.unescape(entity).encode("utf-8").decode()
             symbol = unicodedata.normalize("NFKC", symbol)
-        
+
         except Exception as e:
             trace = traceback.format_exc()
             logger.error(repr(e))
             logger.critical(trace)
             symbol = ""
-    
+
     return symbol
 
+'''
+Takes an HTML entity match and attempts to parse it into a UTF-8
+character
+'''
+def parse_entity(match_obj):
+    return decode_entity(match_obj.group(0))
+
 '''
 Deal with HTML entity codes
 '''
 def remove_codes(string):
-    entity_regex = re.compile("&[^;\s]*;")
-
-    string = entity_regex.sub(parse_entity, string)
-
-    return string
+    return entity_regex.sub(parse_entity, string)
 
 '''
 Removes tags from a string
 '''
 def remove_tags(string):
-    tag_regex = re.compile("<[^>]+>")
-
     return tag_regex.sub("", string)
 
 '''
@@ -87,19 +131,52 @@ whitespace-separated-elements)
 Note: this is all quite arbitrary
 '''
 def remove_empty_lines(string):
-    string = string.split("\n")
-    string = [line for line in string if re.search("\S", line)]
-    
-    for index, line in enumerate(string):
-        line = line.split()
-        if len(line) > 7:
-            string[index] = " ".join(line)
+    lines = (line.split() for line in string.split("\n"))
+
+    return "\n".join([" ".join(words) for words in lines if len(words) > 7])
+
+'''
+Cuts everything from the first start up to and including the last end
+after it, as re.sub(start + ".*" + end, "", string) would for a string with
+no newlines, but without the regex engine's backtracking
+'''
+def cut_region(string, start, end):
+    start_index = string.find(start)
+    if start_index < 0:
+        return string
+
+    end_index = string.rfind(end)
+    if end_index < start_index + len(start):
+        return string
+
+    return string[:start_index] + string[end_index + len(end):]
+
+'''
+Removes the matches of title_regex from a string along with the whitespace
+before each match. With keep_newlines the whitespace removed stops at the
+nearest newline, as in parse_body, where lines were once joined with a
+sentinel before titles were removed
+'''
+def remove_titles(string, title_regex, keep_newlines=False):
+    pieces = []
+    position = 0
+
+    for match in title_regex.finditer(string):
+        before = string[position:match.start()]
+        if keep_newlines:
+            head, newline, tail = before.rpartition("\n")
+            before = head + newline + tail.rstrip()
         else:
-            string[index] = ""
+            before = before.rstrip()
+        pieces.append(before)
+        position = match.end()
 
-    string = [line for line in string if line]
+    if not pieces:
+        return string
 
-    return "\n".join(string)
+    pieces.append(string[position:])
+
+    return "".join(pieces)
 
 
 '''
@@ -109,7 +186,7 @@ returns a string without tags and HTML entities
 '''
 def parse_abstract(abstract):
     # remove title
-    abstract = re.sub("\s*<title>[^<]*</title>", "", abstract)
+    abstract = remove_titles(abstract, abstract_title_regex)
     
     # remove tags
     abstract = remove_tags(abstract)
@@ -128,23 +205,18 @@ body should be a string, can contain tags and HTML entities
 returns a string
 '''
 def parse_body(body):
-    # make one big block of text to make everything easier
-    body = "|$|$|".join(body.split("\n"))
-    
-    # remove text that is in tables
-    body = re.sub("<sup[^<]*</sup>", "", body)
-    body = re.sub("<td.*</td>", "", body)
-    body = re.sub("<th.*</th>", "", body)
+    body = sup_regex.sub("", body)
+
+    # remove text that is in tables, everything from the first cell to the
+    # last one is dropped
+    body = cut_region(body, "<td", "</td>")
+    body = cut_region(body, "<th", "</th>")
 
     # remove LaTeX
-    body = re.sub("\\\documentclass\[.*\\\end\{document\}", "", body)
-    # remove titles
-    body = re.sub("\s*<title>[^<]*</title>", "", body)
+    body = cut_region(body, "\\documentclass[", "\\end{document}")
 
-    # remove figure labels
-    body = re.sub("\s*<label>[^<]*</label>", "", body)
-    
-    body = "\n".join(body.split("|$|$|"))
+    # remove titles and figure labels
+    body = remove_titles(body, body_title_regex, keep_newlines=True)
 
     # remove tags
     body = remove_tags(body)
@@ -157,14 +229,93 @@ def parse_body(body):
     return body
 
 '''
-Parses a single PMC full text XML
+Splits the body into its top level sections and names them with
+body_sections
+body should be the raw XML of the body
+returns a dict of section name to the raw XML of every section with that
+name, joined by newlines
+'''
+def split_body_sections(body):
+    named = {}
+    depth = 0
+    start = 0
+
+    for match in sec_tag_regex.finditer(body):
+        if not match.group(1):
+            if depth == 0:
+                start = match.start()
+                sec_type = sec_type_regex.search(match.group(2) or "")
+            depth += 1
+            continue
+
+        depth -= 1
+        if depth != 0:
+            continue
+
+        section = body[start:match.end()]
+        # Only the section's own title, not that of its first subsection
+        nested = section.find("<sec", 4)
+        title = sec_title_regex.search(section[:nested] if nested >= 0 else section)
+
+        key = " ".join([sec_type.group(1) if sec_type else "",
+                        remove_tags(title.group(1)) if title else ""]).lower()
+        for name, name_regex in body_sections.items():
+            if name_regex.search(key):
+                named.setdefault(name, []).append(section)
+
+    return {name: "\n".join(sections) for name, sections in named.items()}
+
+'''
+Gets the caption of every figure, one caption per line
+string should contain the raw XML of figures
+'''
+def parse_captions(string):
+    captions = []
+    for fig in fig_regex.finditer(string):
+        caption = caption_regex.search(fig.group(0))
+        if caption:
+            # The caption's title and paragraphs are separate elements
+            text = remove_codes(tag_regex.sub(" ", caption.group(1)))
+            text = " ".join(text.split())
+            if text:
+                captions.append(text)
+
+    return "\n".join(captions)
+
+'''
+Parses a single PMC full text XML, which may be gzip or zstd compressed, see
+parse_xml_handle
+'''
+def parse_xml(fp, sections=None):
+    logger = logging.getLogger(__name__)
+
+    try:
+        handle = open_file(fp, "r")
+    except Exception as e:
+        trace = traceback.format_exc()
+        logger.error(repr(e))
+        logger.critical(trace)
+        return {section: "" for section in sections or default_sections}
+
+    with handle:
+        return parse_xml_handle(handle, sections)
+
+'''
+Parses a single PMC full text XML from an open text mode handle. Only the
+requested sections are collected and cleaned, and reading stops once all of
+them have been seen. Sub-articles, like the peer review documents some
+articles carry, are not read, so an article's title is the last in its own
+front matter rather than that of its last sub-article
+sections is a list of names from valid_sections, title, abstract and body
+by default
+returns a dict with a string for each section, empty if it wasn't found
 '''
-def parse_xml(fp):
+def parse_xml_handle(handle, sections=None):
     logger = logging.getLogger(__name__)
 
+    sections = sections or default_sections
+    clean_text = {section: "" for section in sections}
     title = ""
-    clean_abstract = ""
-    clean_body = ""
 
     title_group_start = re.compile("^\s*<title-group")
     title_group_stop = re.compile("^\s*</title-group")
@@ -172,62 +323,123 @@ def parse_xml(fp):
 
     abstract_start = re.compile("\s*<abstract")
     abstract_stop = re.compile("\s*</abstract>")
+    front_stop = re.compile("</front>")
 
     body_start = re.compile("\s*<body")
     body_stop = re.compile("\s*</body>")
 
+    floats_start = re.compile("<floats-group")
+    floats_stop = re.compile("</floats-group>")
+    sub_article_start = re.compile("<sub-article")
+
+    # The parts of the file still to be read. Figures may be in the body or
+    # in the floats group after the back matter
+    pending = set()
+    if "title" in sections:
+        pending.add("title")
+    if "abstract" in sections:
+        pending.add("abstract")
+    if any(section in body_sections or section in ["body", "figures"] for section in sections):
+        pending.add("body")
+    if "figures" in sections:
+        pending.add("floats")
+
     abstract = []
     body = []
+    floats = []
 
     try:
-        with open(fp, "r") as handle:
+        line = handle.readline()
+        logger.debug("starting line loop")
+        while line and pending:
+            if sub_article_start.search(line):
+                logger.debug("found sub-article start tag")
+                break
+
+            if "title" in pending and title_group_start.search(line):
+                logger.debug("found title group start tag")
+                while line and not title_group_stop.search(line):
+                    if title_regex.search(line):
+                        title = title_regex.search(line).group(1)
+                    line = handle.readline()
+
+            if "abstract" in pending and abstract_start.search(line):
+                logger.debug("found abstract start tag")
+                while line and not abstract_stop.search(line):
+                    abstract.append(line)
+                    line = handle.readline()
+
+            # There may be more than one abstract, but they're all in front. The
+            # last title group in front gives the title, as it always has
+            if front_stop.search(line):
+                pending.discard("title")
+                pending.discard("abstract")
+
+            if "body" in pending and body_start.search(line):
+                logger.debug("found body start tag")
+                while line and not body_stop.search(line):
+                    body.append(line)
+                    line = handle.readline()
+                pending.discard("body")
+
+            if "floats" in pending and floats_start.search(line):
+                logger.debug("found floats group start tag")
+                while line and not floats_stop.search(line):
+                    floats.append(line)
+                    line = handle.readline()
+                pending.discard("floats")
+
             line = handle.readline()
-            logger.debug("starting line loop")
-            while line:
-                
-                if title_group_start.search(line):
-                    logger.debug("found title group start tag")
-                    while not title_group_stop.search(line):
-                        if title_regex.search(line):
-                            title = title_regex.search(line).group(1)
-                        line = handle.readline()
-                
-                if abstract_start.search(line):
-                    logger.debug("found abstract start tag")
-                    while not abstract_stop.search(line):
-                        abstract.append(line)
-                        line = handle.readline()
-
-                if body_start.search(line):
-                    logger.debug("found body start tag")
-                    while not body_stop.search(line):
-                        body.append(line)
-                        line = handle.readline()
-
-                line = handle.readline()
-            logger.debug("end line loop")
-        clean_abstract = parse_abstract("".join(abstract))
-        clean_body = parse_body("".join(body))
+        logger.debug("end line loop")
+
+        if "abstract" in sections:
+            clean_text["abstract"] = parse_abstract("".join(abstract))
+
+        body = "".join(body)
+        if "body" in sections:
+            clean_text["body"] = parse_body(body)
+
+        if any(section in body_sections for section in sections):
+            named = split_body_sections(body)
+            for section in sections:
+                if section in named:
+                    clean_text[section] = parse_body(named[section])
+
+        if "figures" in sections:
+            clean_text["figures"] = parse_captions(body + "".join(floats))
 
     except Exception as e:
         trace = traceback.format_exc()
         logger.error(repr(e))
         logger.critical(trace)
 
-    title = remove_codes(title)
-    title = remove_tags(title)
+    if "title" in sections:
+        title = remove_codes(title)
+        title = remove_tags(title)
+        clean_text["title"] = title
+
+    return clean_text
 
-    return {"title": title, "abstract": clean_abstract, "body": clean_body}
+'''
+Parses an XML streamed from an oa_bulk archive, for use with
+oa_bulk.archive_generator
+'''
+def parse_xml_member(member_name, handle, sections=None):
+    return parse_xml_handle(handle, sections)
 
 '''
-returns a list of absolute filepaths for every file in a directory
+returns a list of absolute filepaths for every file in a directory,
+archives are left out as their members are read by parse_xmls
 '''
 def get_file_list(directory):
+    if os.path.isfile(directory):
+        return []
+
     absolute_path = Path(directory).resolve()
     files = os.listdir(directory)
     absolute_fps = [os.path.join(absolute_path, f) for f in files]
 
-    return [fp for fp in absolute_fps if os.path.isfile(fp)]
+    return [fp for fp in absolute_fps if os.path.isfile(fp) and not is_archive(fp)]
 
 '''
 returns a logger
@@ -260,7 +472,6 @@ Validates the section names requested in the input
 def validate_sections(sections_in):
     logger = logging.getLogger(__name__)
 
-    valid_sections = ["title", "abstract", "body"]
     sections = [sec for sec in sections_in if sec in valid_sections]
     
     if len(sections) == 0:
@@ -273,9 +484,11 @@ def validate_sections(sections_in):
     return sections
 
 '''
-Maps the output format string to a function
+Maps the output format string to a function. The bundle format writes to
+shared files rather than a file per article, see get_bundle_function. Files
+are compressed with compression, 'none', 'gzip' or 'zstd'
 '''
-def get_output_function(output_format):
+def get_output_function(output_format, compression="none"):
     logger = logging.getLogger(__name__)
 
     function_map = {"xml": write_xml,
@@ -286,13 +499,98 @@ def get_output_function(output_format):
         logger.warning("Requested output format not supported, defaulting to XML")
         output_format = "xml"
 
-    return function_map[output_format]
+    if compression == "none":
+        return function_map[output_format]
+    return partial(function_map[output_format], compression=compression)
+
+'''
+Wraps a text_bundle.BundleWriter as an output function. The file name part
+of fp is used as the record's PMC ID
+'''
+def get_bundle_function(bundle_writer):
+    def write_bundle(fp, text_elements):
+        bundle_writer.write(fp.split("/")[-1], text_elements)
+
+    return write_bundle
+
+'''
+Runs the optional analyses of a parsed article in the worker that parsed it.
+With a mesh_tagger.MeshTagger the MeSH descriptor mentions in every section
+are counted, and with ngrams the sections are split into sentences and
+tokens and their unigrams and bigrams are counted
+returns a tuple (mentions, ngram_counts), each None if not requested,
+ngram_counts as from text_stats.count_ngrams
+'''
+def analyze_text(clean_text, tagger=None, ngrams=False):
+    mentions = None
+    ngram_counts = None
+
+    if tagger is not None or ngrams:
+        text = "\n".join(clean_text.values())
+        if tagger is not None:
+            mentions = tagger.tag(text)
+        if ngrams:
+            ngram_counts = count_ngrams(text)
+
+    return (mentions, ngram_counts)
+
+'''
+Parses and analyzes an XML streamed from an oa_bulk archive, see parse_chunk
+'''
+def parse_member_chunk(member_name, handle, sections=None, tagger=None, ngrams=False):
+    clean_text = parse_xml_handle(handle, sections)
+    return (clean_text, *analyze_text(clean_text, tagger, ngrams))
+
+'''
+Parses a list of files in a worker process. Each file's errors are caught
+separately so one bad file doesn't lose the rest of the chunk
+returns a list of tuples (input_file, (clean_text, mentions, ngram_counts),
+error) where mentions and ngram_counts are from analyze_text and error is
+None or a tuple (repr, traceback)
+'''
+def parse_chunk(input_files, sections, tagger=None, ngrams=False):
+    results = []
+    for input_file in input_files:
+        try:
+            clean_text = parse_xml(input_file, sections)
+            results.append((input_file, (clean_text, *analyze_text(clean_text, tagger, ngrams)),
+                            None))
+        except Exception as e:
+            results.append((input_file, None, (repr(e), traceback.format_exc())))
+
+    return results
+
+'''
+Parses files in a pool of worker processes, yielding results in input order.
+Chunks of files are dispatched with apply_async, and no more than
+max_in_flight chunks are outstanding at once, so a slow writer holds back
+the workers rather than letting parsed text pile up in memory
+'''
+def parallel_parse(input_files, sections, workers, chunksize=16, max_in_flight=None,
+        tagger=None, ngrams=False):
+    max_in_flight = max_in_flight or workers * 4
+    in_flight = deque()
+
+    with Pool(workers) as pool:
+        for start in range(0, len(input_files), chunksize):
+            chunk = input_files[start:start + chunksize]
+            in_flight.append(pool.apply_async(parse_chunk, (chunk, sections, tagger, ngrams)))
+
+            if len(in_flight) >= max_in_flight:
+                for result in in_flight.popleft().get():
+                    yield result
+
+        while in_flight:
+            for result in in_flight.popleft().get():
+                yield result
 
 '''
 Main driver function
 '''
 def parse_xmls(input_dir, output_dir, output_format="xml", 
-        sections=["title", "abstract", "body"], quiet=False, debug=False):
+        sections=["title", "abstract", "body"], quiet=False, debug=False, workers=1,
+        shard_size=256, compression=None, tagger=None, mesh_counts=None,
+        ngram_counter=None, ngram_dir=None):
     logger = initialize_logger(debug, quiet)
 
     sections = validate_sections(sections)
@@ -303,44 +601,149 @@ def parse_xmls(input_dir, output_dir, output_format="xml",
     
     input_files = get_file_list(input_dir)
 
-    output_function = get_output_function(output_format)
-    
-    logger.debug("Starting parse loop")
-    for input_file in input_files:
-        clean_text_temp = parse_xml(input_file)
-        
-        clean_text = {}
-        for section in sections:
-            clean_text[section] = clean_text_temp[section]
+    bundle_writer = None
+    if output_format == "bundle":
+        bundle_writer = BundleWriter(output_dir, shard_size * 2**20, compression or "gzip")
+        output_function = get_bundle_function(bundle_writer)
+    else:
+        check_codec(compression or "none")
+        output_function = get_output_function(output_format, compression or "none")
+
+    # MeSH mentions are counted in the workers and written here
+    mentions_out = None
+    if tagger is not None:
+        mentions_out = open_file(mesh_counts, "w")
 
-        pmc_id = input_file.split("/")[-1].split(".")[0]    
+    try:
+        parse_files(input_dir, input_files, output_dir, output_function, sections, workers,
+                    tagger, mentions_out, ngram_counter)
+    finally:
+        if mentions_out is not None:
+            mentions_out.close()
+        if bundle_writer is not None:
+            bundle_writer.close()
+            logger.info(f"Wrote {bundle_writer.record_count} records to " \
+                        f"{bundle_writer.shard_num + 1} bundle shards")
+
+    if ngram_counter is not None:
+        ngram_counter.save(ngram_dir)
+        logger.info(f"Saved frequency tables of {ngram_counter.num_tokens} tokens in " \
+                    f"{ngram_counter.num_sentences} sentences to {ngram_dir}")
+
+'''
+Parses the files and archive members under input_dir and writes each with
+output_function. With a tagger, each article's MeSH mention counts are
+written to mentions_out as lines of PMC ID, UID and count. With a
+text_stats.NgramCounter, each article's unigram and bigram counts are added
+to it
+'''
+def parse_files(input_dir, input_files, output_dir, output_function, sections, workers,
+        tagger=None, mentions_out=None, ngram_counter=None):
+    logger = logging.getLogger(__name__)
+    ngrams = ngram_counter is not None
+
+    def write_result(name, result):
+        clean_text, mentions, ngram_counts = result
+        pmc_id = name.split("/")[-1].split(".")[0]
         output_function(f"{output_dir}/{pmc_id}", clean_text)
+        if mentions is not None:
+            mentions_out.write(format_counts(pmc_id, mentions))
+        if ngram_counts is not None:
+            ngram_counter.add_counts(*ngram_counts)
+
+    logger.debug("Starting parse loop")
+    if workers == 1:
+        results = (result for input_file in input_files
+                    for result in parse_chunk([input_file], sections, tagger, ngrams))
+    else:
+        logger.info(f"Parsing {len(input_files)} files with {workers} workers")
+        results = parallel_parse(input_files, sections, workers, tagger=tagger, ngrams=ngrams)
+
+    for input_file, result, error in results:
+        if error is not None:
+            logger.error(f"{input_file}: {error[0]}")
+            logger.critical(error[1])
+            continue
+
+        write_result(input_file, result)
+
+    # Members of oa_bulk archives are streamed rather than extracted
+    archives = get_archive_list(input_dir)
+    if archives:
+        logger.info(f"Reading {len(archives)} archives with {workers} workers")
+
+    member_function = partial(parse_member_chunk, sections=sections, tagger=tagger,
+                                ngrams=ngrams)
+    for member_name, result, error in archive_generator(archives, member_function, workers):
+        if error is not None:
+            logger.error(f"{member_name}: {error[0]}")
+            logger.critical(error[1])
+            continue
+
+        write_result(member_name, result)
         
 '''
 For command line usage
 '''
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
-    parser.add_argument("-i", "--input", help="Directory containing PMC XML files",
+    parser.add_argument("-i", "--input", help="Directory containing PMC XML files, " \
+                        "oa_bulk .tar.gz archives, or both. May also be a single archive",
                         required=True)
     parser.add_argument("-o", "--output", help="Directory to write output files to",
                         required=True)
     parser.add_argument("-f", "--output-format", help="Output format, currently " \
                         "XML, JSON, and plain text are supported and can be specified " \
-                        "using the strings 'xml', 'json', or 'text'", default="xml")
+                        "using the strings 'xml', 'json', or 'text'. 'bundle' writes " \
+                        "JSON lines to size-bounded shards with an index for lookup by " \
+                        "PMC ID, see text_bundle.py", default="xml")
     parser.add_argument("-s", "--sections", help="Specify the desired sections for " \
                         "output. Sections should be follow the '-s' or '--sections' " \
                         "argument name and be space delimited, for example: " \
                         "'-s title abstract'. Sensitive to order. By default " \
-                        "parses titles, abstracts, and body text", nargs="*", 
+                        "parses titles, abstracts, and body text. Figure captions " \
+                        "('figures') and top level body sections named by their " \
+                        "sec-type or title ('introduction', 'methods', 'results', " \
+                        "'discussion', 'conclusions') may also be requested. Only the " \
+                        "requested sections are cleaned", nargs="*", 
                         default=["title", "abstract", "body"])
     parser.add_argument("-q", "--quiet", help="Suppress printing of log messages to STDOUT. " \
                         "Warning: exceptions will not be printed to console", 
                         action="store_true", default=False)
     parser.add_argument("-d", "--debug", help="Set log level to DEBUG", action="store_true", 
                         default=False)
+    parser.add_argument("-w", "--workers", help="Number of worker processes to parse XMLs " \
+                        "with, archives are each read by one worker", type=int, default=1)
+    parser.add_argument("--shard-size", help="The size in MB at which bundle shards are " \
+                        "split", type=int, default=256)
+    parser.add_argument("-c", "--compression", help="Compression of the output files or " \
+                        "bundle shards, 'none', 'gzip', or 'zstd' (requires the zstandard " \
+                        "package). Bundle shards are gzipped and other outputs left " \
+                        "uncompressed by default. Compressed input XMLs are always detected " \
+                        "and read", choices=list(codec_extensions))
+    parser.add_argument("-m", "--mesh", help="MeSH descriptor XML, used with --mesh-counts " \
+                        "to count the descriptors mentioned in each article's text")
+    parser.add_argument("--mesh-counts", help="Path to write a TSV of PMC ID, descriptor " \
+                        "UID and mention count to")
+    parser.add_argument("--mesh-cache", help="Path of the MeSH tagger cache, built if " \
+                        "needed, {mesh}.tagger.pkl by default")
+    parser.add_argument("-n", "--ngrams", help="Directory to save corpus unigram and bigram " \
+                        "frequency tables to, see text_stats.py")
+    parser.add_argument("--max-bigrams", help="The number of bigrams kept in memory before " \
+                        "the lowest counts are pruned", type=int, default=20000000)
 
     args = parser.parse_args()
+
+    tagger = None
+    if args.mesh_counts:
+        if not args.mesh:
+            parser.error("--mesh-counts requires -m/--mesh")
+        tagger = load_tagger(args.mesh, args.mesh_cache)
+
+    ngram_counter = None
+    if args.ngrams:
+        ngram_counter = NgramCounter(max_bigrams=args.max_bigrams)
     
     parse_xmls(args.input, args.output, args.output_format, args.sections, 
-                args.quiet, args.debug)   
+                args.quiet, args.debug, args.workers, args.shard_size, args.compression,
+                tagger, args.mesh_counts, ngram_counter, args.ngrams)   
@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+import re
+import xml.etree.ElementTree as ET
+
+from compressed_io import open_file
+
+'''
+Reads PubMed citation XML (the baseline and update files from
+https://ftp.ncbi.nlm.nih.gov/pubmed/, or EFetch output) with an incremental
+parser, one PubmedArticle at a time. Files may be gzip or zstd compressed. Each article is
+cleared once it has been read, so memory use doesn't grow with the file.
+Records are dicts holding the requested fields:
+    pmid - the citation's PMID
+    year - the year of the journal issue, from its Year or MedlineDate, or ""
+    headings - a list of (descriptor UID, major topic, qualifiers) tuples,
+        where major topic is a Boolean and qualifiers is a list of
+        (qualifier UID, major topic) tuples if "qualifiers" was requested and
+        empty otherwise
+and "deleted", False for articles. Update files also list deleted PMIDs,
+which are yielded as {"pmid": pmid, "deleted": True}
+'''
+
+all_fields = ("pmid", "year", "headings", "qualifiers")
+
+year_regex = re.compile(r"\d{4}")
+
+def open_pubmed(path):
+    return open_file(path, "rb")
+
+def get_year(citation):
+    pub_date = citation.find("Article/Journal/JournalIssue/PubDate")
+    if pub_date is None:
+        return ""
+
+    year = pub_date.findtext("Year")
+    if year is None:
+        year = pub_date.findtext("MedlineDate") or ""
+    match = year_regex.match(year.strip())
+
+    return match.group(0) if match else ""
+
+def get_headings(citation, qualifiers=False):
+    headings = []
+    for heading in citation.iterfind("MeshHeadingList/MeshHeading"):
+        descriptor = heading.find("DescriptorName")
+        if descriptor is None:
+            continue
+
+        heading_qualifiers = []
+        if qualifiers:
+            heading_qualifiers = [(qualifier.get("UI"), qualifier.get("MajorTopicYN") == "Y")
+                                    for qualifier in heading.iterfind("QualifierName")]
+
+        headings.append((descriptor.get("UI"), descriptor.get("MajorTopicYN") == "Y",
+                            heading_qualifiers))
+
+    return headings
+
+def iter_pubmed(path, fields=all_fields):
+    ''' Reads the citations and deletions of a PubMed XML file
+    params
+        path - path to an XML file, compressed or not
+        fields - the fields to read, a subset of all_fields. Fields that
+            aren't requested aren't extracted
+    returns
+        yields record dicts, see the module docstring
+    '''
+    fields = set(fields)
+    unknown = fields.difference(all_fields)
+    if unknown:
+        raise ValueError(f"Unknown PubMed fields: {sorted(unknown)}")
+    want_headings = "headings" in fields or "qualifiers" in fields
+
+    with open_pubmed(path) as handle:
+        events = ET.iterparse(handle, events=("start", "end"))
+        # Clearing an article leaves it as an empty child of the root, so the
+        # root is cleared instead, dropping every article read so far
+        _, root = next(events)
+        for event, elem in events:
+            if event != "end":
+                continue
+
+            if elem.tag == "PubmedArticle":
+                citation = elem.find("MedlineCitation")
+                if citation is None:
+                    root.clear()
+                    continue
+
+                record = {"deleted": False}
+                if "pmid" in fields:
+                    record["pmid"] = (citation.findtext("PMID") or "").strip()
+                if "year" in fields:
+                    record["year"] = get_year(citation)
+                if want_headings:
+                    record["headings"] = get_headings(citation, "qualifiers" in fields)
+
+                root.clear()
+                yield record
+
+            elif elem.tag == "DeleteCitation":
+                pmids = [(pmid.text or "").strip() for pmid in elem.iterfind("PMID")]
+                root.clear()
+                for pmid in pmids:
+                    yield {"pmid": pmid, "deleted": True}
+
+            elif elem.tag == "PubmedBookArticle":
+                # Book records have no MeSH headings and aren't read
+                root.clear()
+
+def iter_pubmed_files(paths, fields=all_fields):
+    ''' Reads several PubMed XML files in order, see iter_pubmed '''
+    for path in paths:
+        for record in iter_pubmed(path, fields):
+            yield record
@@ -16,6 +16,8 @@ from subprocess import Popen, PIPE
 
 import numpy as np
 from parse_mesh import parse_mesh
+from pubmed_reader import iter_pubmed
+from compressed_io import open_file
 
 def get_children(uid, term_trees):
     ''' Gets a list of children for a term. Because there isn't actually a graph
@@ -127,11 +129,156 @@ def semantic_similarity(uid1, uid2, sws, svs, term_trees, term_trees_rev):
     return 0 if num is np.NaN or denom == 0 else num / denom
 
 
+class LcaIndex:
+    ''' Answers lowest common ancestor queries between positions on the MeSH
+        trees in constant time. The trees are walked in an Euler tour, and a
+        sparse table over the depths along the tour gives the shallowest
+        node between the first visits of two positions, which is their LCA.
+        Positions on different trees (such as C01 and C04) have no common
+        ancestor
+    params
+        term_trees - a dict giving the position(s) on the graph for each UID.
+            Positions whose parents aren't listed get their parents added
+    '''
+    def __init__(self, term_trees):
+        self.term_trees = {uid: [tree for tree in trees if tree]
+                            for uid, trees in term_trees.items()}
+
+        positions = set()
+        for trees in self.term_trees.values():
+            for tree in trees:
+                parts = tree.split(".")
+                positions.update(".".join(parts[:depth]) for depth in range(1, len(parts) + 1))
+        # Sorting by parts puts every position right after its ancestors, in
+        # the preorder of a depth-first walk
+        self.positions = sorted(positions, key=lambda tree: tree.split("."))
+        self.position_ids = {tree: idx for idx, tree in enumerate(self.positions)}
+        self.depths = np.array([tree.count(".") + 1 for tree in self.positions], dtype=np.int32)
+
+        tour = []
+        first = np.zeros(len(self.positions), dtype=np.int64)
+        roots = np.zeros(len(self.positions), dtype=np.int32)
+        stack = []
+        for idx, tree in enumerate(self.positions):
+            # Climb back up to the parent, visiting each node on the way
+            while stack and not tree.startswith(self.positions[stack[-1]] + "."):
+                stack.pop()
+                if stack:
+                    tour.append(stack[-1])
+            roots[idx] = stack[0] if stack else idx
+            first[idx] = len(tour)
+            tour.append(idx)
+            stack.append(idx)
+        while stack:
+            stack.pop()
+            if stack:
+                tour.append(stack[-1])
+
+        self.tour = np.array(tour, dtype=np.int32)
+        self.first = first
+        self.roots = roots
+
+        # table[k][i] is the tour index of the shallowest node in
+        # tour[i:i + 2**k]
+        tour_depths = self.depths[self.tour]
+        levels = [np.arange(len(tour), dtype=np.int32)]
+        span = 1
+        while span * 2 <= len(tour):
+            prev = levels[-1]
+            left = prev[:len(tour) - span]
+            right = prev[span:]
+            level = prev.copy()
+            level[:len(tour) - span] = np.where(tour_depths[right] < tour_depths[left],
+                                                right, left)
+            levels.append(level)
+            span *= 2
+        self.table = np.array(levels)
+        self.tour_depths = tour_depths
+        self.log2 = np.zeros(len(tour) + 1, dtype=np.int32)
+        self.log2[2:] = np.floor(np.log2(np.arange(2, len(tour) + 1))).astype(np.int32)
+
+    def ids(self, trees):
+        ''' returns an array of the position IDs of a list of positions '''
+        return np.array([self.position_ids[tree] for tree in trees], dtype=np.int64)
+
+    def lca_ids(self, ids1, ids2):
+        ''' Finds the LCAs of pairs of positions, vectorized
+        params
+            ids1, ids2 - arrays of position IDs, from ids()
+        returns
+            an array of the position ID of each pair's LCA, -1 for pairs on
+            different trees
+        '''
+        ids1 = np.asarray(ids1)
+        ids2 = np.asarray(ids2)
+        start = np.minimum(self.first[ids1], self.first[ids2])
+        end = np.maximum(self.first[ids1], self.first[ids2])
+        k = self.log2[end - start + 1]
+        left = self.table[k, start]
+        right = self.table[k, end - (1 << k) + 1]
+        shallowest = np.where(self.tour_depths[right] < self.tour_depths[left], right, left)
+
+        return np.where(self.roots[ids1] == self.roots[ids2], self.tour[shallowest], -1)
+
+    def lca_depths(self, ids1, ids2):
+        ''' returns an array of the depth of each pair's LCA, where roots are
+            at depth 1, -1 for pairs on different trees
+        '''
+        lcas = self.lca_ids(ids1, ids2)
+        return np.where(lcas >= 0, self.depths[lcas], -1)
+
+    def path_lengths(self, ids1, ids2):
+        ''' returns an array of the number of edges between each pair through
+            their LCA, -1 for pairs on different trees
+        '''
+        lca_depths = self.lca_depths(ids1, ids2)
+        lengths = self.depths[ids1] + self.depths[ids2] - 2 * lca_depths
+        return np.where(lca_depths >= 0, lengths, -1)
+
+    def wu_palmer(self, ids1, ids2):
+        ''' returns an array of the Wu-Palmer similarity of each pair, twice
+            the LCA's depth over the sum of their depths, 0 for pairs on
+            different trees
+        '''
+        lca_depths = self.lca_depths(ids1, ids2)
+        return np.where(lca_depths >= 0,
+                        2 * lca_depths / (self.depths[ids1] + self.depths[ids2]), 0.0)
+
+    def lca(self, tree1, tree2):
+        ''' returns the LCA of two positions, or None if on different trees '''
+        lca = int(self.lca_ids(self.ids([tree1]), self.ids([tree2]))[0])
+        return self.positions[lca] if lca >= 0 else None
+
+    def position_pairs(self, uid1, uid2):
+        ''' returns a tuple of arrays (ids1, ids2) pairing every position of
+            uid1 with every position of uid2
+        '''
+        ids1 = self.ids(self.term_trees[uid1])
+        ids2 = self.ids(self.term_trees[uid2])
+        return (np.repeat(ids1, len(ids2)), np.tile(ids2, len(ids1)))
+
+    def term_path_length(self, uid1, uid2):
+        ''' returns the shortest path between any positions of two terms, -1
+            if they share no tree
+        '''
+        lengths = self.path_lengths(*self.position_pairs(uid1, uid2))
+        lengths = lengths[lengths >= 0]
+        return int(lengths.min()) if len(lengths) else -1
+
+    def term_wu_palmer(self, uid1, uid2):
+        ''' returns the highest Wu-Palmer similarity between any positions of
+            two terms, 0 if they share no tree
+        '''
+        similarities = self.wu_palmer(*self.position_pairs(uid1, uid2))
+        return float(similarities.max()) if len(similarities) else 0.0
+
+
 def count_mesh_terms(doc_list, uids):
     ''' Counts the number of times each term is indexed to a Pubmed citation
         for a set of Pubmed documents
     params
-        doc_list - A list of file paths to Pubmed citation documents in XML format
+        doc_list - A list of file paths to Pubmed citation documents in XML
+            format, which may be gzipped
         uids - a list of all MeSH UIDs
     returns
         a dict containing the count of each term
@@ -139,33 +286,26 @@ def count_mesh_terms(doc_list, uids):
     logger = logging.getLogger(__name__)
     
     logger.info("Starting MeSH term counting...")
-    # Compile regexes for counting MeSH terms
-    mesh_list_start = re.compile(r"\s*<MeshHeadingList>")
-    mesh_list_stop = re.compile(r"\s*</MeshHeadingList>")
-    mesh_term_id = re.compile(r'\s*<DescriptorName UI="(D\d+)".*>')
 
     term_counts = {uid:0 for uid in uids}
     # Count MeSH terms
     for doc in doc_list:
         try:
-            with open(f"{doc}", "r") as handle:
-                start_time = time.perf_counter()
-
-                line = handle.readline()
-                while line:
-                    if mesh_list_start.search(line):
-                        while not mesh_list_stop.search(line):
-                            if mesh_term_id.search(line):
-                                term_id = mesh_term_id.search(line).group(1)
-                                term_counts[term_id] += 1
-                            line = handle.readline()
-                    line = handle.readline()
-
-                # Get elapsed time and truncate for log
-                # The only reason this is currently here is because it helped me
-                # find a serious issue with a package I was previously using
-                elapsed_time = int((time.perf_counter() - start_time) * 10) / 10.0
-                logger.debug(f"{doc} MeSH term counts completed in {elapsed_time} seconds")
+            start_time = time.perf_counter()
+
+            for record in iter_pubmed(doc, fields=("headings",)):
+                # Deletions only appear in update files and are not subtracted
+                if record["deleted"]:
+                    continue
+                for term_id, _, __ in record["headings"]:
+                    if term_id in term_counts:
+                        term_counts[term_id] += 1
+
+            # Get elapsed time and truncate for log
+            # The only reason this is currently here is because it helped me
+            # find a serious issue with a package I was previously using
+            elapsed_time = int((time.perf_counter() - start_time) * 10) / 10.0
+            logger.debug(f"{doc} MeSH term counts completed in {elapsed_time} seconds")
         except Exception as e:
             trace = traceback.format_exc()
             logger.error(repr(e))
@@ -229,7 +369,7 @@ def output_writer(write_queue, out_path):
         write_queue - the queue to pull data from to write
         out_path - the output file path to write to
     '''
-    with open(out_path, "w") as out:
+    with open_file(out_path, "w") as out:
         while True:
             result = write_queue.get()
             if result is None:
@@ -12,57 +12,52 @@ from multiprocessing import Process, Queue
 from subprocess import Popen, PIPE
 
 import numpy as np
+from scipy import sparse
+from parse_mesh import parse_mesh
+from pubmed_reader import iter_pubmed
+from compressed_io import open_file
 
 # TODO: add docstrings
 
-def count_doc_terms(doc_list, term_subset):
+def count_doc_terms(doc_list, term_subset, slices=None):
+    ''' Extracts the PMID, publication year and MeSH descriptor UIDs of every
+        citation in a list of PubMed XML files and writes them to
+        pm_bulk_doc_term_counts.csv. Files are read in order, so a citation
+        repeated in a later update file replaces the earlier one, and a
+        deletion removes it
+    params
+        doc_list - paths to PubMed XML files, which may be gzipped
+        term_subset - the UIDs to keep, or None for the full vocabulary
+        slices - a TimeSlicedCounts to add each document's terms to, or None
+    '''
     logger = logging.getLogger(__name__)
     doc_terms = {}
-    doc_pmid = ""
-    term_ids = []
+    doc_years = {}
 
-    term_set = set(term_subset)
-
-    # Compile regexes
-    pm_article_start = re.compile(r"\s*<PubmedArticle>")
-    pm_article_stop = re.compile(r"\s*</PubmedArticle>")
-    pmid = re.compile(r"\s*<PMID.*>(\d*)</PMID>")
-    mesh_list_start = re.compile(r"\s*<MeshHeadingList>")
-    mesh_list_stop = re.compile(r"\s*</MeshHeadingList>")
-    mesh_term_id = re.compile(r'\s*<DescriptorName UI="(D\d+)".*>')
+    # A term_subset of None keeps the full vocabulary
+    term_set = set(term_subset) if term_subset is not None else None
 
     logger.info("Starting doc/term counting")
     for doc in doc_list:
         try:
-            with open(f"./pubmed_bulk/{doc}", "r") as handle:
-                start_doc_count = len(doc_terms.keys())
-                start_time = time.perf_counter()
-
-                line = handle.readline()
-                while line:
-                    if pm_article_start.search(line):
-                        if doc_pmid:
-                            doc_terms[doc_pmid] = term_ids
-                            doc_pmid = ""
-                            term_ids = []
-                        while not pm_article_stop.search(line):
-                            if not doc_pmid and pmid.search(line):
-                                doc_pmid = pmid.search(line).group(1)
-                            if mesh_list_start.search(line):
-                                while not mesh_list_stop.search(line):
-                                    mesh_match = mesh_term_id.search(line)
-                                    if mesh_match and mesh_match.group(1) in term_set:
-                                        term_ids.append(mesh_match.group(1))
-                                    line = handle.readline()
-                            line = handle.readline()
-                    line = handle.readline()
-                doc_terms[doc_pmid] = term_ids
-
-                # Get count for log
-                docs_counted = len(doc_terms.keys()) - start_doc_count
-                # Get elapsed time and truncate for log
-                elapsed_time = int((time.perf_counter() - start_time) * 10) / 10.0
-                logger.info(f"{doc} parsing completed - terms extracted for {docs_counted} documents in {elapsed_time} seconds")
+            start_doc_count = len(doc_terms.keys())
+            start_time = time.perf_counter()
+
+            for record in iter_pubmed(doc, fields=("pmid", "year", "headings")):
+                if record["deleted"]:
+                    doc_terms.pop(record["pmid"], None)
+                    doc_years.pop(record["pmid"], None)
+                    continue
+
+                doc_terms[record["pmid"]] = [uid for uid, _, __ in record["headings"]
+                                                if term_set is None or uid in term_set]
+                doc_years[record["pmid"]] = record["year"]
+
+            # Get count for log
+            docs_counted = len(doc_terms.keys()) - start_doc_count
+            # Get elapsed time and truncate for log
+            elapsed_time = int((time.perf_counter() - start_time) * 10) / 10.0
+            logger.info(f"{doc} parsing completed - terms extracted for {docs_counted} documents in {elapsed_time} seconds")
                 
         except Exception as e:
             trace = traceback.format_exc()
@@ -71,28 +66,513 @@ def count_doc_terms(doc_list, term_subset):
 
     logger.info("Stopping doc/term counting")
 
+    # Each line is pmid,year,term,term,... where year may be empty
     with open("pm_bulk_doc_term_counts.csv", "w") as out:
         for doc in doc_terms:
-            out.write("".join([doc, ","]))
+            out.write("".join([doc, ",", doc_years[doc], ","]))
             out.write(",".join(doc_terms[doc]))
             out.write("\n")
 
-def td_matrix_gen(file_path, term_subset, docs_per_matrix):
-    with open("pm_bulk_doc_term_counts.csv", "r") as handle:
-        td_matrix = []
+            if slices is not None and doc_years[doc]:
+                slices.add(int(doc_years[doc]), doc_terms[doc])
+
+    if slices is not None:
+        slices.flush()
+
+def read_doc_terms(file_path):
+    ''' Reads the doc/term file written by count_doc_terms
+    params
+        file_path - path to the doc/term file
+    returns
+        yields tuples (pmid, year, terms) where year is an int or None
+        if the article had no publication year
+    '''
+    with open_file(file_path, "r") as handle:
         for line in handle:
-            if len(td_matrix) > docs_per_matrix:
-                yield td_matrix
-                td_matrix = []
             line = line.strip("\n").split(",")
-            terms = line[1:]
-            row = []
-            for uid in term_subset:
-                if uid in terms:
-                    row.append(1)
-                else:
-                    row.append(0)
-            td_matrix.append(row)
+            year = int(line[1]) if line[1] else None
+            yield (line[0], year, [term for term in line[2:] if term])
+
+def td_matrix_gen(file_path, term_subset, docs_per_matrix):
+    td_matrix = []
+    for _, __, terms in read_doc_terms(file_path):
+        if len(td_matrix) > docs_per_matrix:
+            yield td_matrix
+            td_matrix = []
+        row = []
+        for uid in term_subset:
+            if uid in terms:
+                row.append(1)
+            else:
+                row.append(0)
+        td_matrix.append(row)
+
+class CountMinSketch:
+    ''' A count-min sketch over unsigned 64-bit integer keys, used to count
+        term pairs when an exact co-occurrence matrix would not fit in memory.
+        Each of the depth rows uses a multiply-shift hash, so width is rounded
+        up to a power of two. Estimates never undercount, and with probability
+        1 - delta they overcount by at most epsilon * total, where
+        epsilon = e / width and delta = e^-depth
+    params
+        width - the number of counters in each row
+        depth - the number of rows (independent hash functions)
+        seed - seed for drawing the hash functions
+    '''
+    def __init__(self, width, depth, seed=0):
+        if width < 2 or depth < 1:
+            raise ValueError("Sketch width must be at least 2 and depth at least 1")
+
+        self.bits = (int(width) - 1).bit_length()
+        self.width = 1 << self.bits
+        self.depth = int(depth)
+        self.total = 0
+
+        rng = np.random.default_rng(seed)
+        # Multipliers must be odd for multiply-shift hashing
+        self.mults = rng.integers(1, 2**63, size=self.depth, dtype=np.uint64) | np.uint64(1)
+        self.adds = rng.integers(0, 2**63, size=self.depth, dtype=np.uint64)
+        self.shift = np.uint64(64 - self.bits)
+
+        self.table = np.zeros((self.depth, self.width), dtype=np.int64)
+
+    def _hash(self, row, keys):
+        # uint64 arithmetic wraps, which is the mod 2^64 multiply-shift needs
+        return ((keys * self.mults[row] + self.adds[row]) >> self.shift).astype(np.intp)
+
+    def add(self, keys):
+        ''' Increments the count of each key by one, duplicates are counted
+            once per occurrence
+        params
+            keys - a numpy array of uint64 keys
+        '''
+        for row in range(self.depth):
+            np.add.at(self.table[row], self._hash(row, keys), 1)
+        self.total += len(keys)
+
+    def estimate(self, keys):
+        ''' Estimates the counts of keys
+        params
+            keys - a numpy array of uint64 keys
+        returns
+            a numpy array of estimated counts, never less than the true counts
+        '''
+        estimates = self.table[0, self._hash(0, keys)]
+        for row in range(1, self.depth):
+            estimates = np.minimum(estimates, self.table[row, self._hash(row, keys)])
+        return estimates
+
+    def error_bounds(self):
+        ''' Gets the error guarantee for the counts added so far
+        returns
+            a tuple (epsilon, delta, max_error) where, with probability
+            1 - delta, every estimate is at most max_error = epsilon * total
+            above the true count
+        '''
+        epsilon = math.e / self.width
+        delta = math.exp(-self.depth)
+        return (epsilon, delta, epsilon * self.total)
+
+    def memory_bytes(self):
+        return self.table.nbytes
+
+
+class HeavyHitters:
+    ''' Tracks candidate top pairs using the estimates from a CountMinSketch.
+        Candidates are pruned back to capacity whenever twice that many are
+        held, after which only keys estimated above the pruned floor can enter
+    params
+        sketch - the CountMinSketch the keys are counted in
+        num_top - the number of top keys wanted
+        capacity_factor - how many candidates to hold per wanted key
+    '''
+    def __init__(self, sketch, num_top, capacity_factor=4):
+        self.sketch = sketch
+        self.num_top = num_top
+        self.capacity = max(num_top * capacity_factor, 1)
+        self.candidates = {}
+        self.floor = 0
+
+    def update(self, keys):
+        ''' Updates the candidates with a batch of keys that has already been
+            added to the sketch
+        params
+            keys - a numpy array of uint64 keys
+        '''
+        keys = np.unique(keys)
+        estimates = self.sketch.estimate(keys)
+        mask = estimates > self.floor
+        self.candidates.update(zip(keys[mask].tolist(), estimates[mask].tolist()))
+
+        if len(self.candidates) > 2 * self.capacity:
+            kept = sorted(self.candidates.items(), key=lambda item: item[1],
+                            reverse=True)[:self.capacity]
+            self.candidates = dict(kept)
+            self.floor = kept[-1][1]
+
+    def top(self):
+        ''' Gets the top keys, re-estimated against the final sketch
+        returns
+            a list of (key, estimated_count) tuples, largest first
+        '''
+        if not self.candidates:
+            return []
+        keys = np.fromiter(self.candidates.keys(), dtype=np.uint64, count=len(self.candidates))
+        estimates = self.sketch.estimate(keys)
+        order = np.argsort(-estimates, kind="stable")[:self.num_top]
+        return list(zip(keys[order].tolist(), estimates[order].tolist()))
+
+
+def sketch_co_occurrence(file_path, width, depth, num_top, docs_per_batch=10000):
+    ''' Approximates term co-occurrence counts over the full vocabulary in
+        a fixed memory budget using a CountMinSketch, while tracking the most
+        frequent pairs
+    params
+        file_path - path to the doc/term file written by count_doc_terms
+        width - the width of the sketch
+        depth - the depth of the sketch
+        num_top - the number of top pairs to report
+        docs_per_batch - the number of documents to hash at once
+    returns
+        a tuple (top_pairs, term_counts, sketch), where top_pairs is a list of
+        (uid1, uid2, estimated_count) tuples, largest first, and term_counts
+        is a dict giving the number of documents each term appears in
+    '''
+    logger = logging.getLogger(__name__)
+
+    sketch = CountMinSketch(width, depth)
+    heavy_hitters = HeavyHitters(sketch, num_top)
+    logger.info(f"Sketching co-occurrences with width {sketch.width} and depth "
+                f"{sketch.depth} ({sketch.memory_bytes() / 2**20:.1f} MiB)")
+
+    # Terms are interned to dense indices so that a pair packs into a uint64
+    term_index = {}
+    vocab = []
+    term_counts = {}
+
+    batch = []
+    doc_count = 0
+
+    def add_batch():
+        if batch:
+            keys = np.concatenate(batch)
+            sketch.add(keys)
+            heavy_hitters.update(keys)
+            batch.clear()
+
+    for _, __, terms in read_doc_terms(file_path):
+        terms = list(dict.fromkeys(terms))
+
+        indices = []
+        for term in terms:
+            if term not in term_index:
+                term_index[term] = len(vocab)
+                vocab.append(term)
+                term_counts[term] = 0
+            term_counts[term] += 1
+            indices.append(term_index[term])
+
+        doc_count += 1
+        if len(indices) > 1:
+            indices = np.sort(np.array(indices, dtype=np.uint64))
+            rows, cols = np.triu_indices(len(indices), k=1)
+            batch.append((indices[rows] << np.uint64(32)) | indices[cols])
+
+        if doc_count % docs_per_batch == 0:
+            add_batch()
+    add_batch()
+
+    epsilon, delta, max_error = sketch.error_bounds()
+    logger.info(f"Sketched {sketch.total} pair occurrences from {doc_count} documents")
+    logger.info(f"Error bounds: with probability {1 - delta:.4f} each estimate exceeds "
+                f"its true count by at most {max_error:.1f} (epsilon = {epsilon:.2e})")
+
+    top_pairs = []
+    for key, count in heavy_hitters.top():
+        top_pairs.append((vocab[key >> 32], vocab[key & 0xFFFFFFFF], count))
+
+    return (top_pairs, term_counts, sketch)
+
+def write_sketch_pairs(top_pairs, term_counts, total_pairs, out_path):
+    ''' Writes the top sketched pairs along with their log-likelihood ratios,
+        computed as in the exact path
+    params
+        top_pairs - a list of (uid1, uid2, estimated_count) tuples
+        term_counts - a dict giving the count for each term
+        total_pairs - the total number of pair occurrences sketched
+        out_path - the output file path
+    '''
+    total_terms = sum(term_counts.values())
+
+    with open_file(out_path, "w") as out:
+        for uid1, uid2, count in top_pairs:
+            expected = (term_counts[uid1] / total_terms) * (term_counts[uid2] / total_terms)
+            log_ratio = math.log((count / total_pairs) / expected)
+            out.write(",".join([uid1, uid2, str(count), str(log_ratio)]))
+            out.write("\n")
+
+class TimeSlicedCounts:
+    ''' Accumulates a sparse co-occurrence matrix for each publication year,
+        or each window of years, as documents are counted. Only the upper
+        triangle (including the diagonal, which holds document counts for
+        each term) is stored
+    params
+        term_subset - a list of UIDs to count, or None to count every term
+        window - the number of years in each slice
+        pairs_per_flush - the number of buffered pairs at which buffers are
+            folded into the sparse matrices
+    '''
+    def __init__(self, term_subset=None, window=1, pairs_per_flush=5000000):
+        self.fixed_vocab = term_subset is not None
+        self.vocab = list(term_subset) if self.fixed_vocab else []
+        self.term_index = {term: idx for idx, term in enumerate(self.vocab)}
+        self.window = window
+        self.pairs_per_flush = pairs_per_flush
+
+        self.matrices = {}
+        self.doc_counts = {}
+        self.buffers = {}
+        self.buffered = 0
+
+    def get_slice(self, year):
+        return year - (year % self.window)
+
+    def add(self, year, terms):
+        ''' Adds one document's terms to the slice for its year
+        params
+            year - the publication year as an int
+            terms - a list of the document's UIDs
+        '''
+        indices = []
+        for term in dict.fromkeys(terms):
+            if term not in self.term_index:
+                if self.fixed_vocab:
+                    continue
+                self.term_index[term] = len(self.vocab)
+                self.vocab.append(term)
+            indices.append(self.term_index[term])
+
+        time_slice = self.get_slice(year)
+        self.doc_counts[time_slice] = self.doc_counts.get(time_slice, 0) + 1
+
+        if indices:
+            indices = np.sort(np.array(indices, dtype=np.int64))
+            rows, cols = np.triu_indices(len(indices))
+            self.buffers.setdefault(time_slice, []).append((indices[rows], indices[cols]))
+            self.buffered += len(rows)
+
+        if self.buffered >= self.pairs_per_flush:
+            self.flush()
+
+    def flush(self):
+        ''' Folds the buffered pairs into the per-slice sparse matrices '''
+        dim = len(self.vocab)
+
+        for time_slice, pairs in self.buffers.items():
+            rows = np.concatenate([pair[0] for pair in pairs])
+            cols = np.concatenate([pair[1] for pair in pairs])
+            # Duplicate entries are summed when converting to CSR
+            counts = sparse.coo_matrix((np.ones(len(rows), dtype=np.int64), (rows, cols)),
+                                        shape=(dim, dim)).tocsr()
+
+            if time_slice in self.matrices:
+                self.matrices[time_slice].resize((dim, dim))
+                self.matrices[time_slice] = self.matrices[time_slice] + counts
+            else:
+                self.matrices[time_slice] = counts
+
+        self.buffers = {}
+        self.buffered = 0
+
+    def save(self, out_dir):
+        ''' Writes each slice's matrix to {out_dir}/{slice}.npz, along with the
+            term order (terms.txt) and the documents counted per slice
+            (doc_counts.tsv)
+        params
+            out_dir - the directory to write to, created if needed
+        '''
+        self.flush()
+        os.makedirs(out_dir, exist_ok=True)
+        dim = len(self.vocab)
+
+        with open(os.path.join(out_dir, "terms.txt"), "w") as out:
+            for term in self.vocab:
+                out.write(f"{term}\n")
+
+        with open(os.path.join(out_dir, "doc_counts.tsv"), "w") as out:
+            out.write(f"window\t{self.window}\n")
+            for time_slice in sorted(self.doc_counts):
+                out.write(f"{time_slice}\t{self.doc_counts[time_slice]}\n")
+
+        for time_slice, matrix in self.matrices.items():
+            matrix.resize((dim, dim))
+            sparse.save_npz(os.path.join(out_dir, f"{time_slice}.npz"), matrix)
+
+def load_time_slices(slice_dir):
+    ''' Loads the per-year co-occurrence statistics written by
+        TimeSlicedCounts.save
+    params
+        slice_dir - the directory the slices were saved to
+    returns
+        a tuple (terms, doc_counts, matrices) where terms is the list of UIDs
+        in matrix order, doc_counts is a dict giving the number of documents in
+        each slice and matrices is a dict giving the upper-triangular CSR
+        co-occurrence matrix for each slice, keyed by the slice's first year
+    '''
+    with open(os.path.join(slice_dir, "terms.txt"), "r") as handle:
+        terms = [line.strip("\n") for line in handle]
+
+    doc_counts = {}
+    with open(os.path.join(slice_dir, "doc_counts.tsv"), "r") as handle:
+        handle.readline()
+        for line in handle:
+            time_slice, count = line.strip("\n").split("\t")
+            doc_counts[int(time_slice)] = int(count)
+
+    matrices = {}
+    for time_slice in doc_counts:
+        path = os.path.join(slice_dir, f"{time_slice}.npz")
+        if os.path.isfile(path):
+            matrices[time_slice] = sparse.load_npz(path).tocsr()
+
+    return (terms, doc_counts, matrices)
+
+def co_occurrence_by_year(slice_dir, uid1, uid2):
+    ''' Gets the number of documents in which two terms co-occur for each
+        time slice. Passing the same UID twice gives its document counts
+    params
+        slice_dir - the directory the slices were saved to
+        uid1 - a MeSH UID
+        uid2 - a MeSH UID
+    returns
+        a dict giving the co-occurrence count for each slice
+    '''
+    terms, doc_counts, matrices = load_time_slices(slice_dir)
+    term_index = {term: idx for idx, term in enumerate(terms)}
+
+    if uid1 not in term_index or uid2 not in term_index:
+        return {time_slice: 0 for time_slice in doc_counts}
+
+    row, col = sorted((term_index[uid1], term_index[uid2]))
+    return {time_slice: int(matrix[row, col]) for time_slice, matrix in sorted(matrices.items())}
+
+def get_ancestor_index(desc_data, terms):
+    ''' Builds a sparse ancestor index from the MeSH tree numbers, where
+        entry (i, j) is 1 if terms[j] is terms[i] or one of its ancestors.
+        As in semantic_similarity.get_ancestors, ancestry is taken over terms
+        rather than positions, so the ancestors of a term's parent at any of
+        the parent's positions are included
+    params
+        desc_data - the descriptor dict from parse_mesh
+        terms - a list of UIDs giving the row and column order
+    returns
+        a square CSR matrix
+    '''
+    term_index = {term: idx for idx, term in enumerate(terms)}
+    position_lookup = {}
+    for uid in terms:
+        for position in desc_data[uid]["graph_positions"].split("|"):
+            if position:
+                position_lookup[position] = term_index[uid]
+
+    rows = []
+    cols = []
+    for uid in terms:
+        for position in desc_data[uid]["graph_positions"].split("|"):
+            parent = position_lookup.get(".".join(position.split(".")[:-1]))
+            if parent is not None:
+                rows.append(term_index[uid])
+                cols.append(parent)
+
+    dim = len(terms)
+    parents = sparse.csr_matrix((np.ones(len(rows), dtype=np.int64), (rows, cols)),
+                                shape=(dim, dim))
+
+    # Walk up one level per product until no new ancestors are found, the
+    # number of iterations is bounded by the depth of the deepest tree
+    ancestor_index = sparse.identity(dim, dtype=np.int64, format="csr")
+    while True:
+        expanded = (ancestor_index + ancestor_index @ parents).tocsr()
+        # Terms reachable by more than one path are only counted once
+        expanded.data[:] = 1
+        if expanded.nnz == ancestor_index.nnz:
+            break
+        ancestor_index = expanded
+
+    return ancestor_index
+
+def rolled_co_occurrence(file_path, desc_data, terms, docs_per_batch=50000):
+    ''' Counts co-occurrences after propagating each document's terms up the
+        MeSH trees, so that a pair of ancestors co-occurs in a document if any
+        of their descendants (or they themselves) do. Each document's
+        propagated term set is deduplicated, so a document is counted at most
+        once per pair
+    params
+        file_path - path to the doc/term file written by count_doc_terms
+        desc_data - the descriptor dict from parse_mesh
+        terms - a list of UIDs giving the matrix order, should include every
+            ancestor of interest
+        docs_per_batch - the number of documents multiplied at once
+    returns
+        a symmetric CSR matrix of document counts for each pair, the diagonal
+        gives the number of documents containing each term or a descendant
+    '''
+    logger = logging.getLogger(__name__)
+
+    term_index = {term: idx for idx, term in enumerate(terms)}
+    ancestor_index = get_ancestor_index(desc_data, terms)
+    dim = len(terms)
+
+    co_matrix = sparse.csr_matrix((dim, dim), dtype=np.int64)
+    doc_count = 0
+
+    def add_batch(rows, cols, num_docs):
+        doc_matrix = sparse.csr_matrix((np.ones(len(rows), dtype=np.int64), (rows, cols)),
+                                        shape=(num_docs, dim))
+        # Propagate to ancestors with one product, then binarize so that each
+        # document counts once per term (X.A can exceed 1 for shared ancestors)
+        rolled = doc_matrix @ ancestor_index
+        rolled.data[:] = 1
+        return co_matrix + (rolled.T @ rolled).tocsr()
+
+    logger.info(f"Counting hierarchy rolled-up co-occurrences for {dim} terms")
+    rows = []
+    cols = []
+    batch_docs = 0
+    for _, __, doc_terms in read_doc_terms(file_path):
+        for term in dict.fromkeys(doc_terms):
+            if term in term_index:
+                rows.append(batch_docs)
+                cols.append(term_index[term])
+        batch_docs += 1
+
+        if batch_docs == docs_per_batch:
+            co_matrix = add_batch(rows, cols, batch_docs)
+            doc_count += batch_docs
+            rows = []
+            cols = []
+            batch_docs = 0
+
+    if batch_docs:
+        co_matrix = add_batch(rows, cols, batch_docs)
+        doc_count += batch_docs
+
+    logger.info(f"Rolled-up co-occurrences counted for {doc_count} documents")
+
+    return co_matrix
+
+def save_co_matrix(co_matrix, terms, out_path):
+    ''' Saves a sparse co-occurrence matrix to {out_path}.npz and its term
+        order to {out_path}.terms
+    params
+        co_matrix - a sparse matrix
+        terms - a list of UIDs in matrix order
+        out_path - output path prefix
+    '''
+    sparse.save_npz(f"{out_path}.npz", co_matrix.tocsr())
+    with open_file(f"{out_path}.terms", "w") as out:
+        for term in terms:
+            out.write(f"{term}\n")
 
 def matrix_builder(work_queue, add_queue):
     logger = logging.getLogger(__name__)
@@ -138,11 +618,30 @@ def main():
     # TODO: add args here for input, quiet mode
     # Get command line args
     parser = argparse.ArgumentParser()
-    parser.add_argument("-i", "--input", help="A directory containing PMC full-text XMLs",
+    parser.add_argument("-i", "--input", help="A directory containing PubMed citation XMLs, " \
+            "which may be gzipped. Read in file name order so update files follow the baseline",
             required=True, type=str)
     parser.add_argument("-n", "--num_docs", help="number of docs to build co-occurrence matrix with", type=int)
     parser.add_argument("-q", "--quiet", help="Suppress printing of log messages to STDOUT" \
             "Warning: exceptions will not be printed to console", action="store_true")
+    parser.add_argument("-a", "--approximate", help="Approximate co-occurrence counts over the " \
+            "full vocabulary with a count-min sketch instead of building an exact matrix " \
+            "for the term subset", action="store_true")
+    parser.add_argument("--width", help="Width of the count-min sketch, rounded up to a power " \
+            "of two", type=int, default=2**22)
+    parser.add_argument("--depth", help="Depth of the count-min sketch", type=int, default=5)
+    parser.add_argument("--top", help="Number of top pairs to report in approximate mode",
+            type=int, default=100000)
+    parser.add_argument("-r", "--rollup", help="Propagate each document's terms to their " \
+            "ancestors on the MeSH trees before counting co-occurrences, requires --mesh",
+            action="store_true")
+    parser.add_argument("-m", "--mesh", help="Pubmed's MeSH descriptor data in XML format")
+    parser.add_argument("-y", "--by-year", help="Also accumulate co-occurrence counts for " \
+            "each publication year while counting, saved to --slices-dir", action="store_true")
+    parser.add_argument("--window", help="Number of years in each slice when using --by-year",
+            type=int, default=1)
+    parser.add_argument("--slices-dir", help="Directory to save per-year co-occurrence matrices to",
+            default="./data/co-occ_by_year")
     args = parser.parse_args()
 
     # Set up logging
@@ -160,6 +659,38 @@ def main():
         handler.setFormatter(formatter)
         logger.addHandler(handler)
  
+    if args.approximate:
+        docs_dir = Path(args.input).resolve()
+        docs = [os.path.join(docs_dir, doc) for doc in sorted(os.listdir(docs_dir))][:args.num_docs]
+        slices = TimeSlicedCounts(None, args.window) if args.by_year else None
+        count_doc_terms(docs, None, slices)
+        if slices is not None:
+            slices.save(args.slices_dir)
+
+        top_pairs, term_counts, sketch = sketch_co_occurrence("pm_bulk_doc_term_counts.csv",
+                                            args.width, args.depth, args.top)
+        write_sketch_pairs(top_pairs, term_counts, sketch.total,
+                            "./data/term_co-occ_sketch_top_pairs.csv")
+        os.remove("pm_bulk_doc_term_counts.csv")
+        return
+
+    if args.rollup:
+        if not args.mesh:
+            parser.error("--rollup requires --mesh")
+        desc_data, desc_uis = parse_mesh(args.mesh, fields=("graph_positions",))
+
+        docs_dir = Path(args.input).resolve()
+        docs = [os.path.join(docs_dir, doc) for doc in sorted(os.listdir(docs_dir))][:args.num_docs]
+        slices = TimeSlicedCounts(None, args.window) if args.by_year else None
+        count_doc_terms(docs, None, slices)
+        if slices is not None:
+            slices.save(args.slices_dir)
+
+        co_matrix = rolled_co_occurrence("pm_bulk_doc_term_counts.csv", desc_data, desc_uis)
+        save_co_matrix(co_matrix, desc_uis, "./data/term_co-occ_rolled")
+        os.remove("pm_bulk_doc_term_counts.csv")
+        return
+
     # TODO: figure subset out, maybe have a function and get it as an arg
     # Load term subset to count for
     term_subset = []
@@ -168,8 +699,11 @@ def main():
             term_subset.append(line.strip("\n"))
     
     docs_dir = Path(args.input).resolve()
-    docs = os.listdir(docs_dir)[:args.num_docs]
-    count_doc_terms(docs, term_subset)
+    docs = [os.path.join(docs_dir, doc) for doc in sorted(os.listdir(docs_dir))][:args.num_docs]
+    slices = TimeSlicedCounts(term_subset, args.window) if args.by_year else None
+    count_doc_terms(docs, term_subset, slices)
+    if slices is not None:
+        slices.save(args.slices_dir)
 
     # This value was determined in testing but is kind of arbitrary
     # Maybe need to figure out a better way to get this
@@ -243,14 +777,11 @@ def main():
             line = line.strip("\n").split("\t")
             term_counts[line[0]] = 0
 
-    with open("pm_bulk_doc_term_counts.csv", "r") as handle:
-        for _ in range(doc_count):
-            line = handle.readline()
-            line = line.strip("\n").split(",")
-            terms = line[1:]
-            terms = [term for term in terms if term]
-            for term in terms:
-                term_counts[term] += 1
+    doc_terms = read_doc_terms("pm_bulk_doc_term_counts.csv")
+    for _ in range(doc_count):
+        _, __, terms = next(doc_terms)
+        for term in terms:
+            term_counts[term] += 1
     
     # Get probability of each term for the document set
     total_terms = sum(term_counts.values())
@@ -0,0 +1,284 @@
+#!/usr/bin/env python3
+import os
+import sys
+import html
+import json
+import bisect
+import logging
+import argparse
+import unicodedata
+
+import numpy as np
+
+from parse_mesh import parse_mesh, parse_supp
+
+'''
+An inverted index from MeSH names and entry terms to descriptor (and
+optionally supplementary record) UIDs, for resolving free text to UIDs
+without scanning parse_mesh output. Terms are normalized by decoding XML
+entities, NFKC normalization, casefolding and collapsing whitespace. The
+index is a directory of arrays that are memory-mapped when loaded, so
+opening it is cheap and each lookup is a binary search over the sorted keys:
+    keys.npy, key_offsets.npy - the sorted, unique normalized terms as one
+        UTF-8 blob, key i spanning key_offsets[i] to key_offsets[i + 1]
+    posting_offsets.npy - the postings of key i span posting_offsets[i] to
+        posting_offsets[i + 1], names before entry terms
+    posting_uids.npy, posting_terms.npy - each posting's UID index and the
+        index of the term as written in MeSH
+    terms.npy, term_offsets.npy - the terms as written, as one UTF-8 blob
+    uids.txt - the UIDs, one per line
+    meta.json - counts and the files indexed
+'''
+
+whitespace = str.maketrans({character: " " for character in "\t\n\r\f\v"})
+
+def normalize_term(term):
+    return " ".join(unicodedata.normalize("NFKC", term).translate(whitespace).casefold().split())
+
+def collect_terms(records, uids, uid_ids):
+    ''' Lists the (key, is_entry_term, uid_id, term) postings of parse_mesh
+        style records, with terms unescaped
+    '''
+    postings = []
+    for uid in uids:
+        fields = records[uid]
+        terms = [fields["name"]]
+        if fields.get("entry_terms"):
+            terms.extend(fields["entry_terms"].split("|"))
+
+        for i, term in enumerate(terms):
+            term = html.unescape(term)
+            key = normalize_term(term)
+            if key:
+                postings.append((key.encode("utf-8"), i > 0, uid_ids[uid], term))
+
+    return postings
+
+def blob_arrays(strings):
+    ''' returns a tuple (blob, offsets) of uint8 and int64 arrays for a list
+        of bytes
+    '''
+    offsets = np.zeros(len(strings) + 1, dtype=np.int64)
+    np.cumsum([len(string) for string in strings], out=offsets[1:])
+    return (np.frombuffer(b"".join(strings), dtype=np.uint8), offsets)
+
+def build_term_index(descriptor_file, out_dir, supp_file=None, workers=1):
+    ''' Builds the index from the MeSH descriptor file, and the
+        supplementary record file if given
+    params
+        descriptor_file - the MeSH descriptor XML
+        out_dir - directory to write the index to, created if needed
+        supp_file - the MeSH supplementary concept record XML, or None
+        workers - the number of processes to parse the MeSH files with
+    returns
+        a tuple (num_keys, num_postings)
+    '''
+    logger = logging.getLogger(__name__)
+    os.makedirs(out_dir, exist_ok=True)
+
+    sources = [parse_mesh(descriptor_file, workers, fields=("entry_terms",))]
+    if supp_file:
+        sources.append(parse_supp(supp_file, workers, fields=("entry_terms",)))
+
+    uids = []
+    uid_ids = {}
+    postings = []
+    for records, record_uids in sources:
+        for uid in record_uids:
+            uid_ids.setdefault(uid, len(uids))
+            if len(uid_ids) > len(uids):
+                uids.append(uid)
+        postings.extend(collect_terms(records, record_uids, uid_ids))
+
+    # Names sort before entry terms, then by UID in file order. A term listed
+    # twice under one UID is kept once
+    postings = sorted(set(postings))
+
+    keys = []
+    posting_offsets = [0]
+    term_ids = {}
+    posting_uids = np.empty(len(postings), dtype=np.uint32)
+    posting_terms = np.empty(len(postings), dtype=np.uint32)
+    for i, (key, _, uid_id, term) in enumerate(postings):
+        if not keys or keys[-1] != key:
+            if keys:
+                posting_offsets.append(i)
+            keys.append(key)
+        posting_uids[i] = uid_id
+        posting_terms[i] = term_ids.setdefault(term, len(term_ids))
+    posting_offsets.append(len(postings))
+
+    key_blob, key_offsets = blob_arrays(keys)
+    term_blob, term_offsets = blob_arrays([term.encode("utf-8") for term in term_ids])
+
+    arrays = {"keys": key_blob, "key_offsets": key_offsets,
+              "posting_offsets": np.array(posting_offsets if keys else [0], dtype=np.int64),
+              "posting_uids": posting_uids, "posting_terms": posting_terms,
+              "terms": term_blob, "term_offsets": term_offsets}
+    for name, values in arrays.items():
+        np.save(os.path.join(out_dir, f"{name}.npy"), values)
+
+    with open(os.path.join(out_dir, "uids.txt"), "w") as out:
+        out.write("\n".join(uids))
+
+    with open(os.path.join(out_dir, "meta.json"), "w") as out:
+        json.dump({"num_uids": len(uids), "num_keys": len(keys), "num_postings": len(postings),
+                    "descriptor_file": os.path.abspath(descriptor_file),
+                    "supp_file": os.path.abspath(supp_file) if supp_file else None}, out)
+
+    logger.info(f"Indexed {len(postings)} names and entry terms of {len(uids)} UIDs " \
+                f"under {len(keys)} keys")
+
+    return (len(keys), len(postings))
+
+class BlobStrings:
+    ''' A read-only sequence of the byte strings in a blob, for bisect '''
+    def __init__(self, blob, offsets):
+        self.blob = blob
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return self.blob[self.offsets[i]:self.offsets[i + 1]].tobytes()
+
+class TermIndex:
+    ''' Looks up UIDs by name or entry term with an index written by
+        build_term_index. Pickling an index only pickles its path
+    params
+        index_dir - the directory of the index
+    '''
+    def __init__(self, index_dir):
+        self.index_dir = index_dir
+
+        def load(name):
+            return np.load(os.path.join(index_dir, f"{name}.npy"), mmap_mode="r")
+
+        self.keys = BlobStrings(load("keys"), load("key_offsets"))
+        self.terms = BlobStrings(load("terms"), load("term_offsets"))
+        self.posting_offsets = load("posting_offsets")
+        self.posting_uids = load("posting_uids")
+        self.posting_terms = load("posting_terms")
+
+        with open(os.path.join(index_dir, "uids.txt"), "r") as handle:
+            self.uids = handle.read().split("\n")
+
+    def __getstate__(self):
+        return self.index_dir
+
+    def __setstate__(self, index_dir):
+        self.__init__(index_dir)
+
+    def _postings(self, key_id):
+        ''' returns a list of (term, uid) tuples for a key '''
+        start = self.posting_offsets[key_id]
+        end = self.posting_offsets[key_id + 1]
+        return [(self.terms[term_id].decode("utf-8"), self.uids[uid_id])
+                for term_id, uid_id in zip(self.posting_terms[start:end],
+                                            self.posting_uids[start:end])]
+
+    def _find(self, key):
+        i = bisect.bisect_left(self.keys, key)
+        if i < len(self.keys) and self.keys[i] == key:
+            return i
+        return None
+
+    def lookup(self, term, case_sensitive=False):
+        ''' Finds the UIDs a name or entry term belongs to
+        params
+            term - the term
+            case_sensitive - Boolean, only match terms written exactly as
+                term, otherwise terms are matched once normalized
+        returns
+            a list of UIDs, those the term names before those it is an
+            entry term of
+        '''
+        key_id = self._find(normalize_term(term).encode("utf-8"))
+        if key_id is None:
+            return []
+
+        uids = []
+        for written, uid in self._postings(key_id):
+            if (not case_sensitive or written == term) and uid not in uids:
+                uids.append(uid)
+
+        return uids
+
+    def complete(self, prefix, limit=20):
+        ''' Finds the terms starting with a prefix, for autocompletion
+        params
+            prefix - the start of a term, matched once normalized
+            limit - the most terms returned
+        returns
+            a list of (term, uid) tuples in order of the normalized terms
+        '''
+        key = normalize_term(prefix).encode("utf-8")
+        if not key:
+            return []
+        start = bisect.bisect_left(self.keys, key)
+        # No UTF-8 byte is 0xff, so this sorts after every key with the prefix
+        end = bisect.bisect_left(self.keys, key + b"\xff", lo=start)
+
+        matches = []
+        for key_id in range(start, end):
+            for match in self._postings(key_id):
+                matches.append(match)
+                if len(matches) >= limit:
+                    return matches
+
+        return matches
+
+def main():
+    # Get command line args
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-m", "--mesh", help="Pubmed's MeSH descriptor data in XML format, " \
+                    "builds the index if given", type=str)
+    parser.add_argument("-s", "--supp", help="MeSH supplementary concept record XML, to also " \
+                    "index supplementary record names and entry terms", type=str)
+    parser.add_argument("-o", "--output", help="Directory of the index, written to if -m is " \
+                    "given and read otherwise", required=True, type=str)
+    parser.add_argument("-t", "--terms", help="Terms to look up, prints a line of the term " \
+                    "and its UIDs for each", nargs="*", default=[])
+    parser.add_argument("-p", "--prefix", help="Prints the terms starting with a prefix and " \
+                    "their UIDs", type=str)
+    parser.add_argument("--case-sensitive", help="Only match terms with the same case",
+                    action="store_true")
+    parser.add_argument("-w", "--workers", help="Number of worker processes to parse the " \
+                    "MeSH files with", type=int, default=1)
+    parser.add_argument("-q", "--quiet", help="Suppress printing of log messages to STDOUT. " \
+                    "Warning: exceptions will not be printed to console", action="store_true")
+    args = parser.parse_args()
+
+    # Set up logging
+    logger = logging.getLogger(__name__)
+    logger.setLevel(logging.INFO)
+    handler = logging.FileHandler("term_index.log")
+    formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+    handler.setFormatter(formatter)
+    logger.addHandler(handler)
+
+    if not args.quiet:
+        handler = logging.StreamHandler(sys.stderr)
+        handler.setLevel(logging.INFO)
+        formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+        handler.setFormatter(formatter)
+        logger.addHandler(handler)
+
+    if args.mesh:
+        build_term_index(args.mesh, args.output, args.supp, args.workers)
+    elif args.supp:
+        parser.error("-s/--supp requires -m/--mesh")
+
+    if not args.terms and not args.prefix:
+        return
+
+    index = TermIndex(args.output)
+    for term in args.terms:
+        sys.stdout.write("\t".join([term] + index.lookup(term, args.case_sensitive)) + "\n")
+    if args.prefix:
+        for term, uid in index.complete(args.prefix):
+            sys.stdout.write(f"{term}\t{uid}\n")
+
+if __name__ == "__main__":
+    main()
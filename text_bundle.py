@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+import os
+import sys
+import json
+import argparse
+
+from compressed_io import codec_extensions, check_codec, compress_block, decompress_block
+
+'''
+Bundled output for pmc_parser. Rather than one file per article, records are
+written as JSON lines to size-bounded shards:
+    bundle_00000.jsonl[.gz|.zst] - the records
+    bundle_00000.idx - a TSV of pmcid, block offset, block length, record
+        offset and record length for every record in the shard
+Records are buffered and written a block at a time. When compressed, each
+block is a separate gzip member or zstd frame, so a shard is still a valid
+.gz or .zst file that can be streamed with zcat or zstdcat, and a record can
+be read by decompressing just the block it's in
+'''
+
+def shard_name(num, compression):
+    return f"bundle_{num:05d}.jsonl{codec_extensions[compression]}"
+
+class BundleWriter:
+    ''' Writes records to bundle shards, see the module docstring
+    params
+        out_dir - directory to write shards to, created if needed
+        shard_bytes - the most bytes written to a shard, a shard only goes
+            over if a single block is larger
+        compression - 'none', 'gzip' or 'zstd'
+        block_bytes - the uncompressed size records are buffered to before
+            being compressed and written
+        level - the compression level, the codec default if None
+    '''
+    def __init__(self, out_dir, shard_bytes=256 * 2**20, compression="gzip",
+            block_bytes=2**20, level=None):
+        check_codec(compression)
+        os.makedirs(out_dir, exist_ok=True)
+
+        self.out_dir = out_dir
+        self.shard_bytes = shard_bytes
+        self.compression = compression
+        self.block_bytes = block_bytes
+        self.level = level
+
+        self.shard_num = -1
+        self.shard = None
+        self.shard_size = 0
+        self.index = []
+        self.record_count = 0
+
+        self.block = []
+        self.block_size = 0
+        # (pmcid, record offset, record length) for each buffered record
+        self.block_records = []
+
+    def write(self, pmcid, text_elements):
+        ''' Buffers one record, text_elements is a dict like the one returned
+            by pmc_parser.parse_xml
+        '''
+        record = dict(pmcid=pmcid, **text_elements)
+        line = (json.dumps(record) + "\n").encode("utf-8")
+
+        self.block_records.append((pmcid, self.block_size, len(line)))
+        self.block.append(line)
+        self.block_size += len(line)
+        self.record_count += 1
+
+        if self.block_size >= self.block_bytes:
+            self._flush_block()
+
+    def _flush_block(self):
+        if not self.block:
+            return
+
+        data = compress_block(b"".join(self.block), self.compression, self.level)
+        if self.shard is None or \
+                (self.shard_size and self.shard_size + len(data) > self.shard_bytes):
+            self._next_shard()
+
+        offset = self.shard_size
+        self.shard.write(data)
+        self.shard_size += len(data)
+        for pmcid, record_offset, record_length in self.block_records:
+            self.index.append(f"{pmcid}\t{offset}\t{len(data)}\t{record_offset}\t{record_length}\n")
+
+        self.block = []
+        self.block_size = 0
+        self.block_records = []
+
+    def _close_shard(self):
+        if self.shard is None:
+            return
+
+        self.shard.close()
+        index_path = os.path.join(self.out_dir, f"bundle_{self.shard_num:05d}.idx")
+        with open(index_path, "w") as out:
+            out.write("".join(self.index))
+
+        self.shard = None
+        self.index = []
+
+    def _next_shard(self):
+        self._close_shard()
+        self.shard_num += 1
+        self.shard_size = 0
+        self.shard = open(os.path.join(self.out_dir, shard_name(self.shard_num,
+                                        self.compression)), "wb")
+
+    def close(self):
+        self._flush_block()
+        self._close_shard()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+def shard_compression(shard_path):
+    for compression, extension in codec_extensions.items():
+        if extension and shard_path.endswith(extension):
+            return compression
+    return "none"
+
+def list_shards(bundle_dir):
+    ''' returns a sorted list of (shard_path, index_path) tuples '''
+    shards = []
+    for name in sorted(os.listdir(bundle_dir)):
+        if name.startswith("bundle_") and ".jsonl" in name:
+            index_name = name.split(".")[0] + ".idx"
+            shards.append((os.path.join(bundle_dir, name), os.path.join(bundle_dir, index_name)))
+    return shards
+
+class BundleReader:
+    ''' Random access to the records of a bundle by PMC ID. The shard indexes
+        are read on creation, and the last decompressed block is kept, as
+        records are often read in the order they were written
+    params
+        bundle_dir - a directory written by BundleWriter
+    '''
+    def __init__(self, bundle_dir):
+        self.shards = list_shards(bundle_dir)
+        self.index = {}
+        for shard_id, (_, index_path) in enumerate(self.shards):
+            with open(index_path, "r") as handle:
+                for line in handle:
+                    pmcid, *offsets = line.rstrip("\n").split("\t")
+                    self.index[pmcid] = (shard_id, *map(int, offsets))
+
+        self.cached_block = (None, None)
+        self.cached_data = None
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, pmcid):
+        return pmcid in self.index
+
+    def pmcids(self):
+        return list(self.index)
+
+    def get(self, pmcid):
+        ''' returns the record for a PMC ID as a dict, or None if it isn't
+            in the bundle
+        '''
+        if pmcid not in self.index:
+            return None
+        shard_id, block_offset, block_length, record_offset, record_length = self.index[pmcid]
+
+        if self.cached_block != (shard_id, block_offset):
+            shard_path = self.shards[shard_id][0]
+            with open(shard_path, "rb") as handle:
+                handle.seek(block_offset)
+                data = handle.read(block_length)
+            self.cached_data = decompress_block(data, shard_compression(shard_path))
+            self.cached_block = (shard_id, block_offset)
+
+        return json.loads(self.cached_data[record_offset:record_offset + record_length])
+
+def iter_bundle(bundle_dir):
+    ''' Reads every record of a bundle in the order written, a block at a
+        time
+    returns
+        yields record dicts
+    '''
+    for shard_path, index_path in list_shards(bundle_dir):
+        compression = shard_compression(shard_path)
+        check_codec(compression)
+
+        blocks = []
+        with open(index_path, "r") as handle:
+            for line in handle:
+                block = tuple(map(int, line.split("\t")[1:3]))
+                if not blocks or blocks[-1] != block:
+                    blocks.append(block)
+
+        with open(shard_path, "rb") as handle:
+            for block_offset, block_length in blocks:
+                handle.seek(block_offset)
+                data = decompress_block(handle.read(block_length), compression)
+                for line in data.splitlines():
+                    yield json.loads(line)
+
+def main():
+    # Get command line args
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-i", "--input", help="A bundle directory written by pmc_parser.py",
+                    required=True, type=str)
+    parser.add_argument("-p", "--pmcids", help="PMC IDs of the records to print as JSON " \
+                    "lines, all records are printed if not given", nargs="*")
+    args = parser.parse_args()
+
+    if args.pmcids:
+        reader = BundleReader(args.input)
+        records = (reader.get(pmcid) for pmcid in args.pmcids)
+    else:
+        records = iter_bundle(args.input)
+
+    for record in records:
+        if record is not None:
+            sys.stdout.write(json.dumps(record) + "\n")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,242 @@
+#!/usr/bin/env python3
+import os
+import re
+import sys
+import json
+import logging
+import argparse
+from collections import Counter
+
+import numpy as np
+
+from compressed_io import read_text
+
+'''
+Corpus-wide unigram and bigram frequency tables for cleaned text. Text is
+split into sentences at sentence-ending punctuation followed by a capital
+letter or digit, and sentences into casefolded word tokens. Bigrams don't
+cross sentences. Counts are accumulated in memory and pruned whenever a table
+grows past its limit, with the highest count pruned recorded as an error
+bound, in the manner of lossy counting. Tables are saved as:
+    vocab.bin - the tokens as newline-separated UTF-8, by descending count
+    unigram_counts.npy - the count of each token in vocab order
+    bigram_keys.npy - sorted uint64 keys, left token index << 32 | right
+    bigram_counts.npy - the count of each bigram in key order
+    meta.json - document, sentence and token totals and the error bounds
+'''
+
+sentence_regex = re.compile(r"(?<=[.!?])\s+(?=[\"'(\[]?[A-Z0-9])")
+word_regex = re.compile(r"[^\W_]+(?:[-'.][^\W_]+)*")
+
+shift = np.uint64(32)
+
+def split_sentences(text):
+    ''' returns yields the sentences of each line of text '''
+    for line in text.split("\n"):
+        for sentence in sentence_regex.split(line):
+            if sentence and not sentence.isspace():
+                yield sentence
+
+def tokenize(sentence):
+    return word_regex.findall(sentence.casefold())
+
+def count_ngrams(text):
+    ''' Counts the unigrams and bigrams of a text
+    returns
+        a tuple (unigrams, bigrams, num_sentences) where unigrams and bigrams
+        are Counters, bigram keys are two tokens separated by a space
+    '''
+    unigrams = Counter()
+    bigrams = Counter()
+    num_sentences = 0
+
+    for sentence in split_sentences(text):
+        tokens = tokenize(sentence)
+        if not tokens:
+            continue
+        num_sentences += 1
+        unigrams.update(tokens)
+        bigrams.update(map(" ".join, zip(tokens, tokens[1:])))
+
+    return (unigrams, bigrams, num_sentences)
+
+def prune(table, max_entries):
+    ''' Drops the lowest counts of a table until at most half of max_entries
+        are left
+    returns
+        a tuple (table, threshold) where threshold is the highest count
+        dropped
+    '''
+    counts = np.fromiter(table.values(), dtype=np.int64, count=len(table))
+    keep = max_entries // 2
+    threshold = int(np.partition(counts, len(counts) - keep - 1)[len(counts) - keep - 1])
+
+    return ({key: count for key, count in table.items() if count > threshold}, threshold)
+
+class NgramCounter:
+    ''' Accumulates unigram and bigram counts in bounded memory
+    params
+        max_unigrams - the number of unigrams kept before pruning
+        max_bigrams - the number of bigrams kept before pruning
+    '''
+    def __init__(self, max_unigrams=5000000, max_bigrams=20000000):
+        self.max_unigrams = max_unigrams
+        self.max_bigrams = max_bigrams
+
+        self.unigrams = {}
+        self.bigrams = {}
+        # Any count may be short by at most the sum of the thresholds pruned at
+        self.unigram_error = 0
+        self.bigram_error = 0
+
+        self.num_docs = 0
+        self.num_sentences = 0
+        self.num_tokens = 0
+
+    def add_counts(self, unigrams, bigrams, num_sentences):
+        ''' Adds the counts of one document, as returned by count_ngrams '''
+        logger = logging.getLogger(__name__)
+
+        self.num_docs += 1
+        self.num_sentences += num_sentences
+        self.num_tokens += sum(unigrams.values())
+
+        for table, counts in ((self.unigrams, unigrams), (self.bigrams, bigrams)):
+            get = table.get
+            for key, count in counts.items():
+                table[key] = get(key, 0) + count
+
+        if len(self.unigrams) > self.max_unigrams:
+            self.unigrams, threshold = prune(self.unigrams, self.max_unigrams)
+            self.unigram_error += threshold
+            logger.debug(f"Pruned unigrams with counts up to {threshold}")
+
+        if len(self.bigrams) > self.max_bigrams:
+            self.bigrams, threshold = prune(self.bigrams, self.max_bigrams)
+            self.bigram_error += threshold
+            logger.debug(f"Pruned bigrams with counts up to {threshold}")
+
+    def add_text(self, text):
+        self.add_counts(*count_ngrams(text))
+
+    def save(self, out_dir):
+        ''' Writes the tables to out_dir, created if needed, see the module
+            docstring for the layout
+        '''
+        logger = logging.getLogger(__name__)
+        os.makedirs(out_dir, exist_ok=True)
+
+        unigrams = self.unigrams
+        vocab = sorted(unigrams, key=lambda token: (-unigrams[token], token))
+        # Tokens of kept bigrams may have been pruned from the unigrams
+        index = {token: i for i, token in enumerate(vocab)}
+        for bigram in self.bigrams:
+            for token in bigram.split(" "):
+                if token not in index:
+                    index[token] = len(vocab)
+                    vocab.append(token)
+
+        with open(os.path.join(out_dir, "vocab.bin"), "wb") as out:
+            out.write("\n".join(vocab).encode("utf-8"))
+        np.save(os.path.join(out_dir, "unigram_counts.npy"),
+                np.array([unigrams.get(token, 0) for token in vocab], dtype=np.int64))
+
+        keys = np.empty(len(self.bigrams), dtype=np.uint64)
+        counts = np.empty(len(self.bigrams), dtype=np.int64)
+        for i, (bigram, count) in enumerate(self.bigrams.items()):
+            left, right = bigram.split(" ")
+            keys[i] = index[left] << 32 | index[right]
+            counts[i] = count
+        order = np.argsort(keys)
+        np.save(os.path.join(out_dir, "bigram_keys.npy"), keys[order])
+        np.save(os.path.join(out_dir, "bigram_counts.npy"), counts[order])
+
+        with open(os.path.join(out_dir, "meta.json"), "w") as out:
+            json.dump({"num_docs": self.num_docs, "num_sentences": self.num_sentences,
+                        "num_tokens": self.num_tokens, "num_unigrams": len(unigrams),
+                        "num_bigrams": len(self.bigrams), "unigram_error": self.unigram_error,
+                        "bigram_error": self.bigram_error}, out)
+
+        logger.info(f"Saved {len(unigrams)} unigrams and {len(self.bigrams)} bigrams from " \
+                    f"{self.num_docs} documents, error bounds {self.unigram_error} and " \
+                    f"{self.bigram_error}")
+
+class NgramTables:
+    ''' Reads tables saved by NgramCounter.save, the arrays are memory-mapped
+    params
+        out_dir - the directory the tables were saved to
+    '''
+    def __init__(self, out_dir):
+        def load(name):
+            return np.load(os.path.join(out_dir, f"{name}.npy"), mmap_mode="r")
+
+        with open(os.path.join(out_dir, "vocab.bin"), "rb") as handle:
+            data = handle.read()
+        self.vocab = data.decode("utf-8").split("\n") if data else []
+        self.index = {token: i for i, token in enumerate(self.vocab)}
+
+        self.unigram_counts = load("unigram_counts")
+        self.bigram_keys = load("bigram_keys")
+        self.bigram_counts = load("bigram_counts")
+
+        with open(os.path.join(out_dir, "meta.json"), "r") as handle:
+            self.meta = json.load(handle)
+
+    def unigram(self, token):
+        ''' returns the count of a token, 0 if it wasn't kept '''
+        i = self.index.get(token)
+        return 0 if i is None else int(self.unigram_counts[i])
+
+    def bigram(self, left, right):
+        ''' returns the count of a bigram, 0 if it wasn't kept '''
+        if left not in self.index or right not in self.index:
+            return 0
+        key = np.uint64(self.index[left] << 32 | self.index[right])
+        i = int(np.searchsorted(self.bigram_keys, key))
+        if i < len(self.bigram_keys) and self.bigram_keys[i] == key:
+            return int(self.bigram_counts[i])
+        return 0
+
+    def bigrams(self):
+        ''' returns a tuple of arrays (left, right, counts) of vocab indexes '''
+        keys = np.asarray(self.bigram_keys)
+        return ((keys >> shift).astype(np.int64), (keys & np.uint64(0xFFFFFFFF)).astype(np.int64),
+                np.asarray(self.bigram_counts))
+
+def main():
+    # Get command line args
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-i", "--input", help="Text or pmc_parser JSON files to count",
+                    required=True, nargs="+")
+    parser.add_argument("-o", "--output", help="Directory to save the frequency tables to",
+                    required=True, type=str)
+    parser.add_argument("--max-unigrams", help="The number of unigrams kept in memory " \
+                    "before the lowest counts are pruned", type=int, default=5000000)
+    parser.add_argument("--max-bigrams", help="The number of bigrams kept in memory " \
+                    "before the lowest counts are pruned", type=int, default=20000000)
+    parser.add_argument("-q", "--quiet", help="Suppress printing of log messages to STDOUT. " \
+                    "Warning: exceptions will not be printed to console", action="store_true")
+    args = parser.parse_args()
+
+    # Set up logging
+    logger = logging.getLogger(__name__)
+    logger.setLevel(logging.INFO)
+    handler = logging.FileHandler("text_stats.log")
+    formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+    handler.setFormatter(formatter)
+    logger.addHandler(handler)
+
+    if not args.quiet:
+        handler = logging.StreamHandler(sys.stdout)
+        handler.setLevel(logging.INFO)
+        formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+        handler.setFormatter(formatter)
+        logger.addHandler(handler)
+
+    counter = NgramCounter(args.max_unigrams, args.max_bigrams)
+    for path in args.input:
+        counter.add_text(read_text(path))
+    counter.save(args.output)
+
+if __name__ == "__main__":
+    main()